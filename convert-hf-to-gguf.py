@@ -5,10 +5,14 @@ from __future__ import annotations
 import logging
 import argparse
 import contextlib
+import functools
+import heapq
 import json
 import os
 import re
 import sys
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import IntEnum
 from pathlib import Path
 from hashlib import sha256
@@ -47,6 +51,15 @@ AnyModel = TypeVar("AnyModel", bound="type[Model]")
 class Model:
     _model_classes: dict[str, type[Model]] = {}
 
+    # file types for which the 2D weights are quantized
+    _ftype_qtypes: dict[gguf.LlamaFileType, gguf.GGMLQuantizationType] = {
+        gguf.LlamaFileType.MOSTLY_Q8_0: gguf.GGMLQuantizationType.Q8_0,
+        gguf.LlamaFileType.MOSTLY_Q5_1: gguf.GGMLQuantizationType.Q5_1,
+        gguf.LlamaFileType.MOSTLY_Q5_0: gguf.GGMLQuantizationType.Q5_0,
+        gguf.LlamaFileType.MOSTLY_Q4_1: gguf.GGMLQuantizationType.Q4_1,
+        gguf.LlamaFileType.MOSTLY_Q4_0: gguf.GGMLQuantizationType.Q4_0,
+    }
+
     dir_model: Path
     ftype: int
     is_big_endian: bool
@@ -61,11 +74,30 @@ class Model:
     tensor_names: set[str] | None
     fname_out: Path
     gguf_writer: gguf.GGUFWriter
+    threads: int
+    source_index: dict[str, str] | None
+    reused_model: gguf.GGUFSplitReader | None
+    reused_sources: dict[str, str]
+    reused_tensors: list[str]
+    _tensor_sources: dict[str, list[tuple[str, str]]]
+    _source_checksums: dict[tuple[str, str], str]
+    _safetensors_readers: dict[str, gguf.SafetensorsReader]
+    adapter_path: Path | None
+    adapter: dict[str, tuple[str, str, bool]]
+    adapter_scale: float
 
     # subclasses should define this!
     model_arch: gguf.MODEL_ARCH
 
-    def __init__(self, dir_model: Path, ftype: gguf.LlamaFileType, fname_out: Path, is_big_endian: bool, use_temp_file: bool, eager: bool):
+    # whether bf16 tensors can go through modify_tensors without being upcast to float32 first,
+    # which is only the case when it doesn't compute anything with them (e.g. it only renames, permutes or stacks them);
+    # subclasses overriding modify_tensors have to set this again
+    bf16_modify_tensors: bool = True
+
+    def __init__(self, dir_model: Path, ftype: gguf.LlamaFileType, fname_out: Path, is_big_endian: bool, use_temp_file: bool, eager: bool,
+                 threads: int = 1, split_max_tensors: int = 0, split_max_size: int = 0, resume: bool = False,
+                 source_index: bool = False, reuse: Path | None = None, adapter: Path | None = None,
+                 vocab_cache: gguf.VocabCache | None = None):
         if type(self) is Model:
             raise TypeError(f"{type(self).__name__!r} should not be directly instantiated")
         self.dir_model = dir_model
@@ -74,6 +106,8 @@ class Model:
         self.endianess = gguf.GGUFEndian.BIG if is_big_endian else gguf.GGUFEndian.LITTLE
         self.use_temp_file = use_temp_file
         self.lazy = not eager
+        self.threads = threads
+        self.vocab_cache = vocab_cache
         self.part_names = Model.get_model_part_names(self.dir_model, ".safetensors")
         self.is_safetensors = len(self.part_names) > 0
         if not self.is_safetensors:
@@ -82,6 +116,11 @@ class Model:
         self.block_count = self.find_hparam(["n_layers", "num_hidden_layers", "n_layer"])
         self.tensor_map = gguf.get_tensor_name_map(self.model_arch, self.block_count)
         self.tensor_names = None
+        self.adapter_path = adapter
+        self.adapter = {}
+        self.adapter_scale = 0.0
+        if adapter is not None:
+            self.load_adapter(adapter)
         if self.ftype == gguf.LlamaFileType.GUESSED:
             # NOTE: can't use field "torch_dtype" in config.json, because some finetunes lie.
             _, first_tensor = next(self.get_tensors())
@@ -95,7 +134,37 @@ class Model:
         ftype_lw: str = ftype_up.lower()
         # allow templating the file name with the output ftype, useful with the "auto" ftype
         self.fname_out = fname_out.parent / fname_out.name.format(ftype_lw, outtype=ftype_lw, ftype=ftype_lw, OUTTYPE=ftype_up, FTYPE=ftype_up)
-        self.gguf_writer = gguf.GGUFWriter(self.fname_out, gguf.MODEL_ARCH_NAMES[self.model_arch], endianess=self.endianess, use_temp_file=self.use_temp_file)
+        self.gguf_writer = gguf.GGUFWriter(self.fname_out, gguf.MODEL_ARCH_NAMES[self.model_arch], endianess=self.endianess, use_temp_file=self.use_temp_file,
+                                           split_max_tensors=split_max_tensors, split_max_size=split_max_size, journal=resume)
+
+        # With source_index, the checksums of the source tensors of each output tensor are saved next to the output,
+        # so that a later conversion of an updated model (e.g. after another LoRA fine-tuning round) can copy
+        # the output tensors whose sources didn't change from this one, instead of converting them again.
+        self.source_index = {} if source_index or reuse is not None else None
+        self.reused_model = None
+        self.reused_sources = {}
+        self.reused_tensors = []
+        self._tensor_sources = {}
+        self._source_checksums = {}
+        self._safetensors_readers = {}
+        if reuse is not None:
+            self.reused_model = gguf.GGUFSplitReader(reuse, lazy=True)
+            # the output files are truncated before anything is copied from the reused ones
+            out_prefix = os.path.realpath(self.fname_out).removesuffix(".gguf")
+            for reader in self.reused_model.readers:
+                reused_prefix = os.path.realpath(reader.data.filename).removesuffix(".gguf")
+                if reused_prefix == out_prefix or re.fullmatch(re.escape(out_prefix) + r"-\d{5}-of-\d{5}", reused_prefix):
+                    raise ValueError(f"Can't reuse {reader.data.filename}, it would be overwritten by the output")
+            index_path = Path(f"{reuse}.sources.json")
+            if not index_path.is_file():
+                logger.warning(f"{index_path} not found, no tensor can be reused from {reuse}")
+            else:
+                with open(index_path, "r", encoding="utf-8") as f:
+                    index = json.load(f)
+                if index["settings"] != self._source_index_settings():
+                    logger.warning(f"{reuse} was converted with other settings, no tensor can be reused from it")
+                else:
+                    self.reused_sources = index["tensors"]
 
     @classmethod
     def __init_subclass__(cls):
@@ -103,6 +172,8 @@ class Model:
         # would require using decorated functions instead of simply defining the property
         if "model_arch" not in cls.__dict__:
             raise TypeError(f"Missing property 'model_arch' for {cls.__name__!r}")
+        if "modify_tensors" in cls.__dict__ and "bf16_modify_tensors" not in cls.__dict__:
+            cls.bf16_modify_tensors = False
 
     def find_hparam(self, keys: Iterable[str], optional: bool = False) -> Any:
         key = next((k for k in keys if k in self.hparams), None)
@@ -115,9 +186,66 @@ class Model:
     def set_vocab(self):
         self._set_vocab_gpt2()
 
+    # Reads the names of the LoRA tensors of an adapter, to merge them into the base weights in get_tensors.
+    # Supports the adapters of mlx_lm.lora and of PEFT, with their adapter_config.json next to them.
+    def load_adapter(self, adapter: Path) -> None:
+        config_path = adapter.parent / "adapter_config.json"
+        with open(config_path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+
+        if "lora_parameters" in config:
+            # mlx_lm: lora_a is (in, rank) and lora_b is (rank, out)
+            if (fine_tune_type := config.get("fine_tune_type", "lora")) != "lora":
+                raise ValueError(f"Only LoRA adapters can be merged, not {fine_tune_type!r}")
+            lora_parameters = config["lora_parameters"]
+            # older versions of mlx_lm called the scale alpha
+            self.adapter_scale = float(lora_parameters.get("scale", lora_parameters.get("alpha", 20.0)))
+            prefix, suffix_a, suffix_b, transposed = "", ".lora_a", ".lora_b", True
+        elif "lora_alpha" in config:
+            # PEFT: lora_A is (rank, in) and lora_B is (out, rank)
+            rank = config["r"]
+            self.adapter_scale = config["lora_alpha"] / (math.sqrt(rank) if config.get("use_rslora") else rank)
+            prefix, suffix_a, suffix_b, transposed = "base_model.model.", ".lora_A.weight", ".lora_B.weight", False
+        else:
+            raise ValueError(f"Unknown adapter format in {config_path}")
+
+        keys = set(gguf.SafetensorsReader(adapter).keys())
+        for key in keys:
+            if not key.endswith(suffix_a):
+                continue
+            base = key[:-len(suffix_a)]
+            if base + suffix_b not in keys:
+                raise ValueError(f"Missing {base + suffix_b!r} in {adapter}")
+            self.adapter[base.removeprefix(prefix) + ".weight"] = (key, base + suffix_b, transposed)
+        logger.info(f"gguf: merging {len(self.adapter)} LoRA tensors from {adapter} with scale {self.adapter_scale}")
+
+    # W + scale * B @ A, computed in float32, in the type of the base tensor.
+    def merge_adapter(self, name: str, data: Tensor, adapter_part: Any) -> Tensor:
+        assert self.adapter_path is not None
+        key_a, key_b, transposed = self.adapter[name]
+        if self.lazy:
+            # new lazy tensors for each pass over the model, their graphs must not be shared
+            lora_a = LazyTorchTensor.from_safetensors(adapter_part.tensors[key_a], source=(str(self.adapter_path.resolve()), key_a))
+            lora_b = LazyTorchTensor.from_safetensors(adapter_part.tensors[key_b], source=(str(self.adapter_path.resolve()), key_b))
+        else:
+            lora_a = torch_from_safetensors(adapter_part.tensors[key_a])
+            lora_b = torch_from_safetensors(adapter_part.tensors[key_b])
+        if transposed:
+            lora_a, lora_b = lora_a.T, lora_b.T
+        # not the @ operator, which lazy tensors assume keeps the shape
+        delta = torch.matmul(lora_b.to(torch.float32) * self.adapter_scale, lora_a.to(torch.float32))
+        if delta.shape != data.shape:
+            raise ValueError(f"LoRA tensors of {name!r} have the shape {tuple(delta.shape)}, but the tensor has the shape {tuple(data.shape)}")
+        return (data.to(torch.float32) + delta).to(data.dtype)
+
     def get_tensors(self) -> Iterator[tuple[str, Tensor]]:
         tensor_names_from_parts: set[str] = set()
 
+        # the LoRA tensors are merged into the base tensors as they are loaded
+        adapter_part: gguf.SafetensorsReader | None = None
+        if self.adapter_path is not None:
+            adapter_part = gguf.SafetensorsReader(self.adapter_path, 'c')
+
         if len(self.part_names) > 1:
             self.tensor_names = set()
             index_name = "model.safetensors" if self.is_safetensors else "pytorch_model.bin"
@@ -136,8 +264,8 @@ class Model:
             logger.info(f"gguf: loading model part '{part_name}'")
             ctx: ContextManager[Any]
             if self.is_safetensors:
-                from safetensors import safe_open
-                ctx = cast(ContextManager[Any], safe_open(self.dir_model / part_name, framework="pt", device="cpu"))
+                # copy-on-write views of the file, so that the tensors can be modified in-place
+                ctx = contextlib.nullcontext(gguf.SafetensorsReader(self.dir_model / part_name, 'c'))
             else:
                 ctx = contextlib.nullcontext(torch.load(str(self.dir_model / part_name), map_location="cpu", mmap=True, weights_only=True))
 
@@ -145,14 +273,25 @@ class Model:
                 tensor_names_from_parts.update(model_part.keys())
 
                 for name in model_part.keys():
-                    data = model_part.get_tensor(name) if self.is_safetensors else model_part[name]
-                    if self.lazy:
-                        data = LazyTorchTensor.from_eager(data)
+                    if self.is_safetensors:
+                        if self.lazy:
+                            # defer reading the tensor data until the tensor is evaluated
+                            data = LazyTorchTensor.from_safetensors(model_part.tensors[name], source=(part_name, name))
+                        else:
+                            data = torch_from_safetensors(model_part.tensors[name])
+                    else:
+                        data = model_part[name]
+                        if self.lazy:
+                            data = LazyTorchTensor.from_eager(data)
+                    if name in self.adapter:
+                        data = self.merge_adapter(name, data, adapter_part)
                     yield name, data
 
         # only verify tensor name presence; it doesn't matter if they are not in the right files
         if len(sym_diff := tensor_names_from_parts.symmetric_difference(self.tensor_names)) > 0:
             raise ValueError(f"Mismatch between weight map and model parts for tensor names: {sym_diff}")
+        if len(missing := set(self.adapter).difference(tensor_names_from_parts)) > 0:
+            raise ValueError(f"The adapter has LoRA tensors for tensors which are not in the model: {missing}")
 
     def format_tensor_name(self, key: gguf.MODEL_TENSOR, bid: int | None = None, suffix: str = ".weight") -> str:
         if key not in gguf.MODEL_TENSORS[self.model_arch]:
@@ -241,95 +380,218 @@ class Model:
         return False
 
     def write_tensors(self):
-        max_name_len = max(len(s) for _, s in self.tensor_map.mapping.values()) + len(".weight,")
+        max_name_len = max(len(gguf.TENSOR_NAMES[t].format(bid=self.block_count - 1)) for t in gguf.MODEL_TENSORS[self.model_arch]) + len(".weight,")
 
         for name, data_torch in self.get_tensors():
             # we don't need these
             if name.endswith((".attention.masked_bias", ".attention.bias", ".rotary_emb.inv_freq")):
                 continue
 
-            old_dtype = data_torch.dtype
-
-            # convert any unsupported data types to float32
-            if data_torch.dtype not in (torch.float16, torch.float32):
-                data_torch = data_torch.to(torch.float32)
+            # in the eager conversion, this is where the tensors are transformed; in the lazy one, this only builds their graph
+            with gguf.profile_tensor(name), gguf.profile("transform"):
+                old_dtype = data_torch.dtype
+
+                # convert any unsupported data types to float32
+                # (bf16 is kept when modify_tensors only moves the values around, it's quantized without the upcast)
+                if data_torch.dtype not in (torch.float16, torch.float32) and not (data_torch.dtype == torch.bfloat16 and self.bf16_modify_tensors):
+                    data_torch = data_torch.to(torch.float32)
+
+                # use the first number-like part of the tensor name as the block id
+                bid = None
+                for part in name.split("."):
+                    if part.isdecimal():
+                        bid = int(part)
+                        break
+
+                for new_name, tensor in self.modify_tensors(data_torch, name, bid):
+                    # bf16 is passed around as its raw bits, there is no NumPy type for it
+                    src_qtype = gguf.GGMLQuantizationType.BF16 if tensor.dtype == torch.bfloat16 else None
+                    if src_qtype is not None:
+                        tensor = tensor.view(torch.int16)
+                    data: np.ndarray = tensor.squeeze().numpy()
+                    n_dims = len(data.shape)
+                    data_dtype = data.dtype
+                    data_qtype: gguf.GGMLQuantizationType | None = None
+
+                    # when both are True, f32 should win
+                    extra_f32 = self.extra_f32_tensors(name, new_name, bid, n_dims)
+                    extra_f16 = self.extra_f16_tensors(name, new_name, bid, n_dims)
+
+                    # Most of the codebase that takes in 1D tensors or norms only handles F32 tensors
+                    # Conditions should closely match those in llama_model_quantize_internal in llama.cpp
+                    extra_f32 = any(cond for cond in (
+                        extra_f32,
+                        n_dims == 1,
+                        new_name.endswith("_norm.weight"),
+                    ))
+
+                    # Some tensor types are always in float32
+                    extra_f32 = extra_f32 or any(self.match_model_tensor_name(new_name, key, bid) for key in (
+                        gguf.MODEL_TENSOR.FFN_GATE_INP,
+                        gguf.MODEL_TENSOR.POS_EMBD,
+                        gguf.MODEL_TENSOR.TOKEN_TYPES,
+                    ))
+
+                    # if f16 desired, convert any float32 2-dim weight tensors to float16
+                    extra_f16 = any(cond for cond in (
+                        extra_f16,
+                        (name.endswith(".weight") and n_dims >= 2),
+                    ))
+
+                    if self.ftype != gguf.LlamaFileType.ALL_F32 and extra_f16 and not extra_f32:
+                        if self.ftype == gguf.LlamaFileType.MOSTLY_BF16:
+                            data = gguf.quantize_bf16(data, src_qtype=src_qtype)
+                            assert data.dtype == np.int16
+                            data_qtype = gguf.GGMLQuantizationType.BF16
+
+                        elif (qtype := self._ftype_qtypes.get(self.ftype)) is not None and gguf.can_quantize(data, qtype):
+                            # like llama.cpp, keep more precision for the output tensor of the smaller types
+                            if qtype != gguf.GGMLQuantizationType.Q8_0 and self.match_model_tensor_name(new_name, gguf.MODEL_TENSOR.OUTPUT, bid) \
+                                    and gguf.can_quantize(data, gguf.GGMLQuantizationType.Q8_0):
+                                qtype = gguf.GGMLQuantizationType.Q8_0
+                            data = gguf.quantize(data, qtype, src_qtype=src_qtype)
+                            assert data.dtype == np.uint8
+                            data_qtype = qtype
+
+                        else:  # default to float16 for quantized tensors
+                            if src_qtype is not None:
+                                data = gguf.dequantize(data, src_qtype)
+                            if data_dtype != np.float16:
+                                data = data.astype(np.float16)
+                            data_qtype = gguf.GGMLQuantizationType.F16
+
+                    if data_qtype is None:  # by default, convert to float32
+                        if src_qtype is not None:
+                            data = gguf.dequantize(data, src_qtype)
+                        elif data_dtype != np.float32:
+                            data = data.astype(np.float32)
+                        data_qtype = gguf.GGMLQuantizationType.F32
+
+                    block_size, type_size = gguf.GGML_QUANT_SIZES[data_qtype]
+                    # reverse shape to make it similar to the internal ggml dimension order
+                    shape_str = f"""{{{', '.join(str(n) for n in reversed(
+                        (*data.shape[:-1], data.shape[-1] * data.dtype.itemsize // type_size * block_size))
+                    )}}}"""
+
+                    # n_dims is implicit in the shape
+                    # (the streaming pass was already logged when its tensor info was declared)
+                    streaming = self.gguf_writer.state is gguf.WriterState.TI_DATA
+                    logger.log(logging.DEBUG if streaming else logging.INFO, f"{f'%-{max_name_len}s' % f'{new_name},'} {old_dtype} --> {data_qtype.name}, shape = {shape_str}")
+
+                    self.add_tensor(new_name, data, raw_dtype=data_qtype)
+
+    # set during the streaming pass when tensors are evaluated on multiple threads
+    _executor: ThreadPoolExecutor | None = None
+    _pending: deque[Future[None]]
+
+    def add_tensor(self, name: str, data: np.ndarray, raw_dtype: gguf.GGMLQuantizationType) -> None:
+        if self.lazy and self.gguf_writer.state is gguf.WriterState.EMPTY:
+            # first pass of the streaming conversion, the data isn't needed yet
+            self.gguf_writer.add_tensor_info(name, data.shape, data.dtype, data.nbytes, raw_dtype=raw_dtype)
+            if self.source_index is not None:
+                # nothing is evaluated yet, so the whole graph of the tensor can still be walked
+                self._tensor_sources[name] = LazyTorchTensor.sources(data)
+            return
 
-            # use the first number-like part of the tensor name as the block id
-            bid = None
-            for part in name.split("."):
-                if part.isdecimal():
-                    bid = int(part)
-                    break
+        if self._executor is None:
+            self._write_tensor(name, data, raw_dtype)
+            return
 
-            for new_name, data in ((n, d.squeeze().numpy()) for n, d in self.modify_tensors(data_torch, name, bid)):
-                data: np.ndarray = data  # type hint
-                n_dims = len(data.shape)
-                data_dtype = data.dtype
-                data_qtype: gguf.GGMLQuantizationType | None = None
-
-                # when both are True, f32 should win
-                extra_f32 = self.extra_f32_tensors(name, new_name, bid, n_dims)
-                extra_f16 = self.extra_f16_tensors(name, new_name, bid, n_dims)
-
-                # Most of the codebase that takes in 1D tensors or norms only handles F32 tensors
-                # Conditions should closely match those in llama_model_quantize_internal in llama.cpp
-                extra_f32 = any(cond for cond in (
-                    extra_f32,
-                    n_dims == 1,
-                    new_name.endswith("_norm.weight"),
-                ))
-
-                # Some tensor types are always in float32
-                extra_f32 = extra_f32 or any(self.match_model_tensor_name(new_name, key, bid) for key in (
-                    gguf.MODEL_TENSOR.FFN_GATE_INP,
-                    gguf.MODEL_TENSOR.POS_EMBD,
-                    gguf.MODEL_TENSOR.TOKEN_TYPES,
-                ))
-
-                # if f16 desired, convert any float32 2-dim weight tensors to float16
-                extra_f16 = any(cond for cond in (
-                    extra_f16,
-                    (name.endswith(".weight") and n_dims >= 2),
-                ))
-
-                if self.ftype != gguf.LlamaFileType.ALL_F32 and extra_f16 and not extra_f32:
-                    if self.ftype == gguf.LlamaFileType.MOSTLY_BF16:
-                        data = gguf.quantize_bf16(data)
-                        assert data.dtype == np.int16
-                        data_qtype = gguf.GGMLQuantizationType.BF16
-
-                    elif self.ftype == gguf.LlamaFileType.MOSTLY_Q8_0 and gguf.can_quantize_to_q8_0(data):
-                        data = gguf.quantize_q8_0(data)
-                        assert data.dtype == np.uint8
-                        data_qtype = gguf.GGMLQuantizationType.Q8_0
-
-                    else:  # default to float16 for quantized tensors
-                        if data_dtype != np.float16:
-                            data = data.astype(np.float16)
-                        data_qtype = gguf.GGMLQuantizationType.F16
-
-                if data_qtype is None:  # by default, convert to float32
-                    if data_dtype != np.float32:
-                        data = data.astype(np.float32)
-                    data_qtype = gguf.GGMLQuantizationType.F32
-
-                block_size, type_size = gguf.GGML_QUANT_SIZES[data_qtype]
-                # reverse shape to make it similar to the internal ggml dimension order
-                shape_str = f"""{{{', '.join(str(n) for n in reversed(
-                    (*data.shape[:-1], data.shape[-1] * data.dtype.itemsize // type_size * block_size))
-                )}}}"""
-
-                # n_dims is implicit in the shape
-                logger.info(f"{f'%-{max_name_len}s' % f'{new_name},'} {old_dtype} --> {data_qtype.name}, shape = {shape_str}")
-
-                self.gguf_writer.add_tensor(new_name, data, raw_dtype=data_qtype)
+        # each tensor is evaluated and written at its offset by a worker thread,
+        # so that the files of a split model are also written concurrently
+        self._pending.append(self._executor.submit(self._write_tensor, name, data, raw_dtype))
+
+        # bounded look-ahead, so that only a few evaluated tensors are kept in memory
+        while len(self._pending) > self.threads:
+            self._pending.popleft().result()
+
+    def _write_tensor(self, name: str, data: np.ndarray, raw_dtype: gguf.GGMLQuantizationType) -> None:
+        if self.source_index is not None and (sources := self._tensor_sources.get(name)):
+            checksum = sha256()
+            for source in sources:
+                checksum.update(f"{source[1]}:{self._source_checksum(*source)}\n".encode("utf-8"))
+            self.source_index[name] = checksum.hexdigest()
+
+            if self.reused_model is not None and self.reused_sources.get(name) == self.source_index[name] \
+                    and name in self.reused_model.tensor_index:
+                reused = self.reused_model.get_tensor(name)
+                if reused.tensor_type == raw_dtype and reused.n_bytes == data.nbytes:
+                    logger.debug(f"Reusing {name} from {self.reused_model.tensor_path(name)}")
+                    self.gguf_writer.copy_tensor_data(name, self.reused_model.tensor_path(name), reused.data_offset)
+                    self.reused_tensors.append(name)
+                    return
+
+        self.gguf_writer.add_tensor(name, data, raw_dtype=raw_dtype)
+
+        if (budget := gguf.LazyBase.memory_budget) is not None and (peak := budget.thread_peak()) is not None:
+            logger.info(f"{name}: memory high-water mark {peak / (1024 * 1024):.0f} MiB")
+
+    # Checksum of the raw bytes of a tensor in a safetensors file, along with its type and shape.
+    def _source_checksum(self, part_name: str, name: str) -> str:
+        if (part_name, name) in self._source_checksums:
+            return self._source_checksums[(part_name, name)]
+
+        if part_name not in self._safetensors_readers:
+            self._safetensors_readers[part_name] = gguf.SafetensorsReader(self.dir_model / part_name)
+        tensor = self._safetensors_readers[part_name].tensors[name]
+
+        checksum = sha256(f"{tensor.dtype}:{list(tensor.shape)}\n".encode("utf-8"))
+        # straight from the memory map
+        checksum.update(tensor.data.reshape(-1).view(np.uint8))
+        self._source_checksums[(part_name, name)] = checksum.hexdigest()
+        return self._source_checksums[(part_name, name)]
+
+    # Anything other than the source tensors which changes the output tensors.
+    def _source_index_settings(self) -> dict[str, Any]:
+        settings: dict[str, Any] = {
+            "ftype": int(self.ftype),
+            "hparams": sha256(json.dumps(self.hparams, sort_keys=True).encode("utf-8")).hexdigest(),
+        }
+        if self.adapter_path is not None:
+            settings["adapter_scale"] = self.adapter_scale
+        return settings
+
+    def write_source_index(self):
+        assert self.source_index is not None
+        index_path = Path(f"{self.gguf_writer.shard_path(0)}.sources.json")
+        with open(index_path, "w", encoding="utf-8") as f:
+            json.dump({"settings": self._source_index_settings(), "tensors": self.source_index}, f, indent=1)
+        if self.reused_model is not None:
+            logger.info(f"Reused {len(self.reused_tensors)} of {len(self.gguf_writer.tensor_infos)} tensors from the previous conversion")
 
     def write(self):
+        if not self.lazy:
+            self.write_tensors()
+            self.gguf_writer.write_header_to_file()
+            self.gguf_writer.write_kv_data_to_file()
+            self.gguf_writer.write_tensors_to_file(progress=True)
+            self.gguf_writer.close()
+            return
+
+        # Two passes over the lazy tensors: the first one only declares the tensor infos
+        # (names, shapes, types, offsets) without reading any tensor data,
+        # the second one evaluates each tensor and writes it straight to its final offset.
         self.write_tensors()
         self.gguf_writer.write_header_to_file()
         self.gguf_writer.write_kv_data_to_file()
-        self.gguf_writer.write_tensors_to_file(progress=True)
+        self.gguf_writer.write_ti_data_to_file()
+        if self.threads > 1:
+            with ThreadPoolExecutor(max_workers=self.threads) as executor:
+                self._executor = executor
+                self._pending = deque()
+                try:
+                    self.write_tensors()
+                    while self._pending:
+                        self._pending.popleft().result()
+                finally:
+                    self._executor = None
+        else:
+            self.write_tensors()
         self.gguf_writer.close()
+        if self.source_index is not None:
+            self.write_source_index()
+        if (budget := gguf.LazyBase.memory_budget) is not None:
+            logger.info(f"Memory high-water mark of the tensors: {budget.peak / (1024 * 1024):.0f} MiB")
 
     def write_vocab(self):
         self.gguf_writer.write_header_to_file()
@@ -369,8 +631,26 @@ class Model:
         except KeyError:
             raise NotImplementedError(f'Architecture {arch!r} not supported!') from None
 
+    # Calls extract, unless the vocab cache already has its result for these tokenizer files.
+    # The key includes this script, since the extraction and e.g. the pre-tokenizer table of get_vocab_base_pre are here,
+    # and the model class, which can override the extraction.
+    def _cached_vocab(self, kind: str, extract: Callable[[], dict[str, Any]], **params: Any) -> dict[str, Any]:
+        if self.vocab_cache is None:
+            return extract()
+        params.update(converter=gguf.VocabCache.file_hash(Path(__file__)), model=type(self).__name__)
+        key = self.vocab_cache.key(kind, gguf.VocabCache.tokenizer_files(self.dir_model), **params)
+        entry = self.vocab_cache.load(key)
+        if entry is None:
+            entry = extract()
+            self.vocab_cache.store(key, entry)
+        return entry
+
     # used for GPT-2 BPE and WordPiece vocabs
     def get_vocab_base(self) -> tuple[list[str], list[int], str]:
+        vocab = self._cached_vocab("base", self._extract_vocab_base, vocab_size=self.hparams.get("vocab_size"))
+        return vocab["tokens"], vocab["toktypes"], vocab["tokpre"]
+
+    def _extract_vocab_base(self) -> dict[str, Any]:
         tokens: list[str] = []
         toktypes: list[int] = []
 
@@ -398,7 +678,7 @@ class Model:
                 tokens.append(reverse_vocab[i])
                 toktypes.append(gguf.TokenType.NORMAL)
 
-        return tokens, toktypes, tokpre
+        return {"tokens": tokens, "toktypes": [int(t) for t in toktypes], "tokpre": tokpre}
 
     # NOTE: this function is generated by convert-hf-to-gguf-update.py
     #       do not modify it manually!
@@ -506,15 +786,13 @@ class Model:
         special_vocab = gguf.SpecialVocab(self.dir_model, load_merges=True)
         special_vocab.add_to_gguf(self.gguf_writer)
 
-    def _set_vocab_qwen(self):
-        dir_model = self.dir_model
-        hparams = self.hparams
+    def _extract_vocab_qwen(self) -> dict[str, Any]:
         tokens: list[str] = []
         toktypes: list[int] = []
 
         from transformers import AutoTokenizer
-        tokenizer = AutoTokenizer.from_pretrained(dir_model, trust_remote_code=True)
-        vocab_size = hparams["vocab_size"]
+        tokenizer = AutoTokenizer.from_pretrained(self.dir_model, trust_remote_code=True)
+        vocab_size = self.hparams["vocab_size"]
         assert max(tokenizer.get_vocab().values()) < vocab_size
 
         tokpre = self.get_vocab_base_pre(tokenizer)
@@ -545,22 +823,46 @@ class Model:
                 tokens.append(reverse_vocab[i])
                 toktypes.append(gguf.TokenType.NORMAL)
 
+        return {
+            "tokpre": tokpre,
+            "tokens": tokens,
+            "toktypes": [int(t) for t in toktypes],
+            "merges": merges,
+            "endoftext": tokenizer.special_tokens["<|endoftext|>"],
+        }
+
+    def _set_vocab_qwen(self):
+        vocab = self._cached_vocab("qwen", self._extract_vocab_qwen, vocab_size=self.hparams["vocab_size"])
+
         self.gguf_writer.add_tokenizer_model("gpt2")
-        self.gguf_writer.add_tokenizer_pre(tokpre)
-        self.gguf_writer.add_token_list(tokens)
-        self.gguf_writer.add_token_types(toktypes)
+        self.gguf_writer.add_tokenizer_pre(vocab["tokpre"])
+        self.gguf_writer.add_token_list(vocab["tokens"])
+        self.gguf_writer.add_token_types(vocab["toktypes"])
 
-        special_vocab = gguf.SpecialVocab(dir_model, load_merges=False)
-        special_vocab.merges = merges
+        special_vocab = gguf.SpecialVocab(self.dir_model, load_merges=False)
+        special_vocab.merges = vocab["merges"]
         # only add special tokens when they were not already loaded from config.json
         if len(special_vocab.special_token_ids) == 0:
-            special_vocab._set_special_token("bos", tokenizer.special_tokens["<|endoftext|>"])
-            special_vocab._set_special_token("eos", tokenizer.special_tokens["<|endoftext|>"])
+            special_vocab._set_special_token("bos", vocab["endoftext"])
+            special_vocab._set_special_token("eos", vocab["endoftext"])
         # this one is usually not in config.json anyway
-        special_vocab._set_special_token("unk", tokenizer.special_tokens["<|endoftext|>"])
+        special_vocab._set_special_token("unk", vocab["endoftext"])
         special_vocab.add_to_gguf(self.gguf_writer)
 
     def _set_vocab_sentencepiece(self):
+        vocab = self._cached_vocab("sentencepiece", self._extract_vocab_sentencepiece, vocab_size=self.hparams.get("vocab_size"))
+        tokens, scores, toktypes = vocab["tokens"], vocab["scores"], vocab["toktypes"]
+
+        self.gguf_writer.add_tokenizer_model("llama")
+        self.gguf_writer.add_tokenizer_pre("default")
+        self.gguf_writer.add_token_list(tokens)
+        self.gguf_writer.add_token_scores(scores)
+        self.gguf_writer.add_token_types(toktypes)
+
+        special_vocab = gguf.SpecialVocab(self.dir_model, n_vocab=len(tokens))
+        special_vocab.add_to_gguf(self.gguf_writer)
+
+    def _extract_vocab_sentencepiece(self) -> dict[str, Any]:
         from sentencepiece import SentencePieceProcessor
 
         tokenizer_path = self.dir_model / 'tokenizer.model'
@@ -622,6 +924,12 @@ class Model:
                 scores.append(-1000.0)
                 toktypes.append(SentencePieceTokenTypes.UNUSED)
 
+        return {"tokens": tokens, "scores": scores, "toktypes": [int(t) for t in toktypes]}
+
+    def _set_vocab_llama_hf(self):
+        vocab = self._cached_vocab("llama_hf", self._extract_vocab_llama_hf)
+        tokens, scores, toktypes = vocab["tokens"], vocab["scores"], vocab["toktypes"]
+
         self.gguf_writer.add_tokenizer_model("llama")
         self.gguf_writer.add_tokenizer_pre("default")
         self.gguf_writer.add_token_list(tokens)
@@ -631,7 +939,7 @@ class Model:
         special_vocab = gguf.SpecialVocab(self.dir_model, n_vocab=len(tokens))
         special_vocab.add_to_gguf(self.gguf_writer)
 
-    def _set_vocab_llama_hf(self):
+    def _extract_vocab_llama_hf(self) -> dict[str, Any]:
         vocab = LlamaHfVocab(self.dir_model)
         tokens = []
         scores = []
@@ -640,18 +948,11 @@ class Model:
         for text, score, toktype in vocab.all_tokens():
             tokens.append(text)
             scores.append(score)
-            toktypes.append(toktype)
+            toktypes.append(int(toktype))
 
         assert len(tokens) == vocab.vocab_size
 
-        self.gguf_writer.add_tokenizer_model("llama")
-        self.gguf_writer.add_tokenizer_pre("default")
-        self.gguf_writer.add_token_list(tokens)
-        self.gguf_writer.add_token_scores(scores)
-        self.gguf_writer.add_token_types(toktypes)
-
-        special_vocab = gguf.SpecialVocab(self.dir_model, n_vocab=len(tokens))
-        special_vocab.add_to_gguf(self.gguf_writer)
+        return {"tokens": tokens, "scores": scores, "toktypes": toktypes}
 
 
 @Model.register("GPTNeoXForCausalLM")
@@ -1325,6 +1626,8 @@ class LlamaModel(Model):
 
     _experts: list[dict[str, Tensor]] | None = None
 
+    bf16_modify_tensors = True
+
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         n_head = self.hparams["num_attention_heads"]
         n_kv_head = self.hparams.get("num_key_value_heads")
@@ -1555,26 +1858,56 @@ class QwenModel(Model):
     model_arch = gguf.MODEL_ARCH.QWEN
 
     @staticmethod
-    def token_bytes_to_string(b):
+    @functools.lru_cache(maxsize=None)
+    def byte_encoder() -> dict[int, str]:
         from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
-        byte_encoder = bytes_to_unicode()
-        return ''.join([byte_encoder[ord(char)] for char in b.decode('latin-1')])
+        return bytes_to_unicode()
+
+    @staticmethod
+    def token_bytes_to_string(b):
+        # latin-1 maps each byte to the code point of the same value, which the byte encoder is keyed by
+        return b.decode('latin-1').translate(QwenModel.byte_encoder())
 
     @staticmethod
     def bpe(mergeable_ranks: dict[bytes, int], token: bytes, max_rank: int | None = None) -> list[bytes]:
-        parts = [bytes([b]) for b in token]
-        while True:
-            min_idx = None
-            min_rank = None
-            for i, pair in enumerate(zip(parts[:-1], parts[1:])):
-                rank = mergeable_ranks.get(pair[0] + pair[1])
-                if rank is not None and (min_rank is None or rank < min_rank):
-                    min_idx = i
-                    min_rank = rank
-            if min_rank is None or (max_rank is not None and min_rank >= max_rank):
-                break
-            assert min_idx is not None
-            parts = parts[:min_idx] + [parts[min_idx] + parts[min_idx + 1]] + parts[min_idx + 2:]
+        # Merges the adjacent parts with the lowest rank until no pair ranked under max_rank is left.
+        # The parts are a linked list of their offsets in the token, and the mergeable pairs are in a heap
+        # ordered by rank and then by offset, so that the leftmost of the pairs with the same rank is merged first.
+        n = len(token)
+        next_part = list(range(1, n + 1))
+        prev_part = list(range(-1, n - 1))
+        heap: list[tuple[int, int, int]] = []
+
+        def push(i: int):
+            j = next_part[i]
+            if j >= n:
+                return
+            end = next_part[j]
+            rank = mergeable_ranks.get(token[i:end])
+            if rank is not None and (max_rank is None or rank < max_rank):
+                heapq.heappush(heap, (rank, i, end))
+
+        for i in range(n - 1):
+            push(i)
+        while heap:
+            _, i, end = heapq.heappop(heap)
+            j = next_part[i]
+            # skip the pairs of which a part was merged with another one since
+            if j >= n or next_part[j] != end:
+                continue
+            next_part[i] = end
+            next_part[j] = n
+            if end < n:
+                prev_part[end] = i
+            if prev_part[i] >= 0:
+                push(prev_part[i])
+            push(i)
+
+        parts = []
+        i = 0
+        while i < n:
+            parts.append(token[i:next_part[i]])
+            i = next_part[i]
         return parts
 
     def set_vocab(self):
@@ -1615,6 +1948,8 @@ class Qwen2MoeModel(Model):
 
     _experts: list[dict[str, Tensor]] | None = None
 
+    bf16_modify_tensors = True
+
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         # process the experts separately
         if name.find("experts") != -1:
@@ -2562,6 +2897,8 @@ class ArcticModel(Model):
 
     _experts: list[dict[str, Tensor]] | None = None
 
+    bf16_modify_tensors = True
+
     def modify_tensors(self, data_torch: Tensor, name: str, bid: int | None) -> Iterable[tuple[str, Tensor]]:
         n_head = self.hparams["num_attention_heads"]
         n_kv_head = self.hparams.get("num_key_value_heads")
@@ -2627,10 +2964,15 @@ class LazyTorchTensor(gguf.LazyBase):
     dtype: torch.dtype
     shape: torch.Size
 
+    # where the tensor was loaded from, for the tensors read from safetensors files
+    _source: tuple[str, str] | None = None
+
     # only used when converting a torch.Tensor to a np.ndarray
     _dtype_map: dict[torch.dtype, type] = {
         torch.float16: np.float16,
         torch.float32: np.float32,
+        # for the raw bits of bf16 tensors
+        torch.int16: np.int16,
     }
 
     def numpy(self) -> gguf.LazyNumpyTensor:
@@ -2642,10 +2984,80 @@ class LazyTorchTensor(gguf.LazyBase):
             func=(lambda s: s[0].numpy())
         )
 
+    # used for safetensors tensors
+    # ref: https://github.com/huggingface/safetensors/blob/079781fd0dc455ba0fe851e2b4507c33d0c0d407/bindings/python/src/lib.rs#L1046
+    _dtype_str_map: dict[str, torch.dtype] = {
+        "F64": torch.float64,
+        "F32": torch.float32,
+        "BF16": torch.bfloat16,
+        "F16": torch.float16,
+        "I64": torch.int64,
+        "I32": torch.int32,
+        "I16": torch.int16,
+        "I8": torch.int8,
+        "U8": torch.uint8,
+        "BOOL": torch.bool,
+    }
+
     @classmethod
     def meta_with_dtype_and_shape(cls, dtype: torch.dtype, shape: torch.Size) -> Tensor:
         return torch.empty(size=shape, dtype=dtype, device="meta")
 
+    @classmethod
+    def from_safetensors(cls, tensor: gguf.SafetensorsTensor, source: tuple[str, str] | None = None) -> Tensor:
+        dtype = cls._dtype_str_map[tensor.dtype]
+        # only the view of the memory map, not the SafetensorsTensor tuple, which would be mistaken for args
+        lazy = cls(meta=cls.meta_with_dtype_and_shape(dtype, tensor.shape), args=(tensor.data,),
+                   func=lambda s: torch_view_of_numpy(s[0], dtype))
+        lazy._source = source
+        return cast(torch.Tensor, lazy)
+
+    # (file name, tensor name) of the safetensors tensors a lazy tensor is computed from.
+    # The args of the evaluated tensors are replaced by their data, so this is only complete before evaluation.
+    @staticmethod
+    def sources(t: Any) -> list[tuple[str, str]]:
+        sources: set[tuple[str, str]] = set()
+        seen: set[int] = set()
+        stack = [t]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, (list, tuple)):
+                stack.extend(item)
+            elif isinstance(item, dict):
+                stack.extend(item.values())
+            elif isinstance(item, gguf.LazyBase) and id(item) not in seen:
+                seen.add(id(item))
+                if isinstance(item, LazyTorchTensor) and item._source is not None:
+                    sources.add(item._source)
+                stack.extend(item._args)
+        return sorted(sources)
+
+    @classmethod
+    def data_nbytes(cls, t: Any) -> int:
+        if isinstance(t, torch.Tensor):
+            return 0 if t._is_view() else t.element_size() * t.nelement()
+        return super().data_nbytes(t)
+
+    # Like torch.stack, but the tensors are evaluated one at a time and copied into the preallocated result,
+    # so that the experts of MoE models are freed as soon as they are copied instead of all being in memory at once.
+    @classmethod
+    def stack(cls, tensors: Sequence[Any], dim: int = 0) -> Tensor:
+        first = tensors[0]
+        dim = dim if dim >= 0 else dim + len(first.shape) + 1
+        shape = (*first.shape[:dim], len(tensors), *first.shape[dim:])
+
+        def stack_one_at_a_time(args: tuple) -> Tensor:
+            # the tensors are in a dict, so that they are not evaluated before this is called
+            parts: list[Any] = args[0]["tensors"]
+            out = torch.empty(shape, dtype=first.dtype)
+            for i, part in enumerate(parts):
+                out.select(dim, i).copy_(cls.to_eager(part) if isinstance(part, LazyTorchTensor) else part)
+                parts[i] = None
+            return out
+
+        lazy = cls(meta=cls.meta_with_dtype_and_shape(first.dtype, shape), args=({"tensors": list(tensors)},), func=stack_one_at_a_time)
+        return cast(torch.Tensor, lazy)
+
     @classmethod
     def __torch_function__(cls, func, types, args=(), kwargs=None):
         del types  # unused
@@ -2656,9 +3068,29 @@ class LazyTorchTensor(gguf.LazyBase):
         if func is torch.Tensor.numpy:
             return args[0].numpy()
 
+        if func is torch.stack:
+            tensors = args[0]
+            if all(t.dtype == tensors[0].dtype and t.shape == tensors[0].shape for t in tensors):
+                return cls.stack(tensors, *args[1:], **kwargs)
+
         return LazyTorchTensor._wrap_fn(func)(*args, **kwargs)
 
 
+# Zero-copy torch tensor of a NumPy view, bf16 is viewed as uint16 in NumPy.
+def torch_view_of_numpy(data: np.ndarray, dtype: torch.dtype) -> Tensor:
+    with gguf.profile("load", data.nbytes):
+        # the view doesn't read anything, this times reading the data from the disk when profiling
+        gguf.prefault(data)
+    if dtype == torch.bfloat16:
+        return torch.from_numpy(data.view(np.int16)).view(torch.bfloat16)
+    return torch.from_numpy(data)
+
+
+def torch_from_safetensors(tensor: gguf.SafetensorsTensor) -> Tensor:
+    with gguf.profile_tensor(tensor.name):
+        return torch_view_of_numpy(tensor.data, LazyTorchTensor._dtype_str_map[tensor.dtype])
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Convert a huggingface model to a GGML compatible file")
@@ -2675,25 +3107,73 @@ def parse_args() -> argparse.Namespace:
         help="path to write to; default: based on input. {ftype} will be replaced by the outtype.",
     )
     parser.add_argument(
-        "--outtype", type=str, choices=["f32", "f16", "bf16", "q8_0", "auto"], default="f16",
-        help="output format - use f32 for float32, f16 for float16, bf16 for bfloat16, q8_0 for Q8_0, auto for the highest-fidelity 16-bit float type depending on the first loaded tensor type",
+        "--outtype", type=str, choices=["f32", "f16", "bf16", "q8_0", "q5_1", "q5_0", "q4_1", "q4_0", "auto"], default="f16",
+        help="output format - use f32 for float32, f16 for float16, bf16 for bfloat16, q8_0 for Q8_0, q5_1, q5_0, q4_1 or q4_0 for the smaller legacy quant types, auto for the highest-fidelity 16-bit float type depending on the first loaded tensor type",
     )
     parser.add_argument(
         "--bigendian", action="store_true",
         help="model is executed on big endian machine",
     )
     parser.add_argument(
-        "model", type=Path,
+        "model", type=Path, nargs="?",
         help="directory containing model file",
     )
+    parser.add_argument(
+        "--base", type=Path, default=None,
+        help="directory of the base model the --adapter is merged into (instead of the model argument)",
+    )
+    parser.add_argument(
+        "--adapter", type=Path, default=None,
+        help="LoRA adapter merged into the weights during the conversion, instead of converting a fused model: adapters.safetensors of mlx_lm.lora or adapter_model.safetensors of PEFT, with its adapter_config.json",
+    )
     parser.add_argument(
         "--use-temp-file", action="store_true",
-        help="use the tempfile library while processing (helpful when running out of memory, process killed)",
+        help="use the tempfile library while processing (helpful when running out of memory, process killed; only used with --no-lazy, lazy conversion streams tensors straight to the output file)",
     )
     parser.add_argument(
         "--no-lazy", action="store_true",
         help="use more RAM by computing all outputs before writing (use in case lazy evaluation is broken)",
     )
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="number of threads used to load and quantize tensors in parallel (output is identical to a single-threaded conversion; ignored with --no-lazy)",
+    )
+    parser.add_argument(
+        "--split-max-tensors", type=int, default=0,
+        help="split the output into files of at most this many tensors (named like model-00001-of-00003.gguf)",
+    )
+    parser.add_argument(
+        "--split-max-size", type=str, default="0",
+        help="split the output into files with at most this much tensor data, e.g. 500M or 2G",
+    )
+    parser.add_argument(
+        "--resume", action="store_true",
+        help="record the written tensors in <outfile>.journal, and continue an interrupted conversion started with --resume instead of starting over (not with --no-lazy)",
+    )
+    parser.add_argument(
+        "--source-index", action="store_true",
+        help="save checksums of the source tensors of each output tensor in <outfile>.sources.json, so that a later conversion can use this one with --reuse (not with --no-lazy)",
+    )
+    parser.add_argument(
+        "--reuse", type=Path, default=None,
+        help="GGUF file of an earlier conversion of the same model with --source-index or --reuse; output tensors whose source tensors didn't change are copied from it instead of being converted again (implies --source-index)",
+    )
+    parser.add_argument(
+        "--max-memory", type=str, default=None,
+        help="memory budget for the evaluation of the tensors, e.g. 32G, which the --threads wait for instead of going over it (0 for no limit); the actual high-water mark is reported for each tensor (not compatible with --no-lazy)",
+    )
+    parser.add_argument(
+        "--profile", type=Path, default=None,
+        help="time each stage of the conversion (load, transform, quantize, write) per tensor, log a summary and save a Chrome trace to this JSON file (for chrome://tracing or Perfetto)",
+    )
+    parser.add_argument(
+        "--vocab-cache", type=Path, default=None,
+        help="directory of the cache of extracted vocabs, keyed by the contents of the tokenizer files, so that converting another model with the same tokenizer skips the extraction (default: $XDG_CACHE_HOME/gguf-py/vocab or ~/.cache/gguf-py/vocab)",
+    )
+    parser.add_argument(
+        "--no-vocab-cache", action="store_true",
+        help="always extract the vocab, without reading or saving it in the vocab cache",
+    )
     parser.add_argument(
         "--model-name", type=str, default=None,
         help="name of the model",
@@ -2703,7 +3183,14 @@ def parse_args() -> argparse.Namespace:
         help="increase output verbosity",
     )
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.base is not None:
+        if args.model is not None:
+            parser.error("the model and --base can't be used together")
+        args.model = args.base
+    if args.model is None:
+        parser.error("the model directory is required")
+    return args
 
 
 def main() -> None:
@@ -2730,11 +3217,30 @@ def main() -> None:
         logger.error(f'Error: {args.model} is not a directory')
         sys.exit(1)
 
+    if args.resume and args.no_lazy:
+        logger.error("Error: --resume needs the lazy conversion, which writes each tensor at its final offset")
+        sys.exit(1)
+
+    if args.max_memory is not None and args.no_lazy:
+        logger.error("Error: --max-memory needs the lazy conversion, which evaluates the tensors one at a time within the budget")
+        sys.exit(1)
+
+    if args.max_memory is not None:
+        gguf.LazyBase.memory_budget = gguf.MemoryBudget(gguf.split_str_to_n_bytes(args.max_memory))
+
+    if (args.source_index or args.reuse is not None) and args.no_lazy:
+        logger.error("Error: --source-index and --reuse need the lazy conversion, which tracks the source tensors of each output tensor")
+        sys.exit(1)
+
     ftype_map: dict[str, gguf.LlamaFileType] = {
         "f32": gguf.LlamaFileType.ALL_F32,
         "f16": gguf.LlamaFileType.MOSTLY_F16,
         "bf16": gguf.LlamaFileType.MOSTLY_BF16,
         "q8_0": gguf.LlamaFileType.MOSTLY_Q8_0,
+        "q5_1": gguf.LlamaFileType.MOSTLY_Q5_1,
+        "q5_0": gguf.LlamaFileType.MOSTLY_Q5_0,
+        "q4_1": gguf.LlamaFileType.MOSTLY_Q4_1,
+        "q4_0": gguf.LlamaFileType.MOSTLY_Q4_0,
         "auto": gguf.LlamaFileType.GUESSED,
     }
 
@@ -2748,9 +3254,15 @@ def main() -> None:
 
     hparams = Model.load_hparams(dir_model)
 
-    with torch.inference_mode():
+    profiler = gguf.Profiler() if args.profile is not None else None
+
+    with torch.inference_mode(), profiler or contextlib.nullcontext():
         model_class = Model.from_model_architecture(hparams["architectures"][0])
-        model_instance = model_class(dir_model, ftype_map[args.outtype], fname_out, args.bigendian, args.use_temp_file, args.no_lazy)
+        model_instance = model_class(dir_model, ftype_map[args.outtype], fname_out, args.bigendian, args.use_temp_file, args.no_lazy,
+                                     threads=args.threads, split_max_tensors=args.split_max_tensors,
+                                     split_max_size=gguf.split_str_to_n_bytes(args.split_max_size), resume=args.resume,
+                                     source_index=args.source_index, reuse=args.reuse, adapter=args.adapter,
+                                     vocab_cache=None if args.no_vocab_cache else gguf.VocabCache(args.vocab_cache))
 
         logger.info("Set model parameters")
         model_instance.set_gguf_parameters()
@@ -2767,7 +3279,14 @@ def main() -> None:
             logger.info(f"Exporting model to '{model_instance.fname_out}'")
             model_instance.write()
 
-        logger.info(f"Model successfully exported to '{model_instance.fname_out}'")
+        gguf_writer = model_instance.gguf_writer
+        for i in range(len(gguf_writer.shards)):
+            logger.info(f"Model successfully exported to '{gguf_writer.shard_path(i)}'")
+
+    if profiler is not None:
+        logger.info(f"Profile:\n{profiler.summary()}")
+        profiler.write_chrome_trace(args.profile)
+        logger.info(f"Saved the Chrome trace to '{args.profile}'")
 
 
 if __name__ == '__main__':
@@ -4,13 +4,11 @@ from __future__ import annotations
 import logging
 import argparse
 import concurrent.futures
+import contextlib
 import enum
 import faulthandler
-import functools
 import itertools
 import json
-import math
-import mmap
 import os
 import pickle
 import re
@@ -70,10 +68,10 @@ class UnquantizedDataType(DataType):
     pass
 
 
-DT_F16  = UnquantizedDataType('F16',  dtype = np.dtype(np.float16), valid_conversions = ['F32', 'Q8_0'])
-DT_F32  = UnquantizedDataType('F32',  dtype = np.dtype(np.float32), valid_conversions = ['F16', 'Q8_0'])
+DT_F16  = UnquantizedDataType('F16',  dtype = np.dtype(np.float16), valid_conversions = ['F32', 'Q8_0', 'Q5_1', 'Q5_0', 'Q4_1', 'Q4_0'])
+DT_F32  = UnquantizedDataType('F32',  dtype = np.dtype(np.float32), valid_conversions = ['F16', 'Q8_0', 'Q5_1', 'Q5_0', 'Q4_1', 'Q4_0'])
 DT_I32  = UnquantizedDataType('I32',  dtype = np.dtype(np.int16),   valid_conversions = [])
-DT_BF16 = UnquantizedDataType('BF16', dtype = np.dtype(np.uint16),  valid_conversions = ['F32', 'F16', 'Q8_0'])
+DT_BF16 = UnquantizedDataType('BF16', dtype = np.dtype(np.uint16),  valid_conversions = ['F32', 'F16', 'Q8_0', 'Q5_1', 'Q5_0', 'Q4_1', 'Q4_0'])
 
 
 @dataclass(frozen=True)
@@ -106,7 +104,8 @@ class Q8_0QuantizedDataType(QuantizedDataType):
                 qs = (blocks / d[:, None]).round()
             qs[d == 0] = 0
             yield from zip(d, qs)
-        return np.fromiter(quantize_blocks_q8_0(blocks), count = n_blocks, dtype = self.quantized_dtype)
+        with gguf.profile("quantize", arr.nbytes):
+            return np.fromiter(quantize_blocks_q8_0(blocks), count = n_blocks, dtype = self.quantized_dtype)
 
 
 DT_Q8_0 = Q8_0QuantizedDataType('Q8_0',
@@ -114,6 +113,30 @@ DT_Q8_0 = Q8_0QuantizedDataType('Q8_0',
                                 ggml_type = gguf.GGMLQuantizationType.Q8_0, block_size = 32,
                                 quantized_dtype = np.dtype([('d', '<f2'), ('qs', 'i1', (32,))]))
 
+
+@dataclass(frozen=True)
+class GGUFQuantizedDataType(QuantizedDataType):
+    # Uses the bit-exact implementations from gguf-py
+    def quantize(self, arr: NDArray) -> NDArray:
+        assert arr.size % self.block_size == 0 and arr.size != 0, f'Bad array size {arr.size}'
+        assert arr.dtype == np.float32, f'Bad array type {arr.dtype}'
+        # already run in a process pool, one thread per tensor is enough
+        return gguf.quantize(arr.reshape((-1, self.block_size)), self.ggml_type, n_threads=1).reshape(-1)
+
+
+def _gguf_quantized_data_type(ggml_type: gguf.GGMLQuantizationType) -> GGUFQuantizedDataType:
+    block_size, type_size = gguf.GGML_QUANT_SIZES[ggml_type]
+    return GGUFQuantizedDataType(ggml_type.name,
+                                 dtype = np.dtype(np.float32), valid_conversions = [],
+                                 ggml_type = ggml_type, block_size = block_size,
+                                 quantized_dtype = np.dtype((np.uint8, (type_size,))))
+
+
+DT_Q5_1 = _gguf_quantized_data_type(gguf.GGMLQuantizationType.Q5_1)
+DT_Q5_0 = _gguf_quantized_data_type(gguf.GGMLQuantizationType.Q5_0)
+DT_Q4_1 = _gguf_quantized_data_type(gguf.GGMLQuantizationType.Q4_1)
+DT_Q4_0 = _gguf_quantized_data_type(gguf.GGMLQuantizationType.Q4_0)
+
 # Quantized types skipped here because they may also map to np.float32
 NUMPY_TYPE_TO_DATA_TYPE: dict[np.dtype[Any], DataType] = {}
 for dt in (DT_BF16, DT_F16, DT_F32, DT_I32):
@@ -136,7 +159,11 @@ SAFETENSORS_DATA_TYPES: dict[str, DataType] = {
 class GGMLFileType(enum.IntEnum):
     AllF32     = 0
     MostlyF16  = 1  # except 1d tensors
+    MostlyQ4_0 = 2  # except 1d tensors
+    MostlyQ4_1 = 3  # except 1d tensors
     MostlyQ8_0 = 7  # except 1d tensors
+    MostlyQ5_0 = 8  # except 1d tensors
+    MostlyQ5_1 = 9  # except 1d tensors
 
     def type_for_tensor(self, name: str, tensor: LazyTensor) -> DataType:
         dt = GGML_FILE_TYPE_TO_DATA_TYPE.get(self)
@@ -144,13 +171,26 @@ class GGMLFileType(enum.IntEnum):
             raise ValueError(self)
         # Convert all 1D tensors to F32.  Most of the codebase that takes in 1D tensors only handles F32 tensors, and most of the outputs tensors are F32.
         #  Also The 1d tensors aren't much of a performance/size issue.  So instead of having to have separate F32 and F16 implementations of both, just convert everything to F32 for now.
-        return dt if len(tensor.shape) > 1 else DT_F32
+        if len(tensor.shape) <= 1:
+            return DT_F32
+        if isinstance(dt, GGUFQuantizedDataType):
+            # rows which can't be split into blocks stay in F16
+            if tensor.shape[-1] % dt.block_size != 0:
+                return DT_F16
+            # like llama.cpp, keep more precision for the output tensor of the smaller types
+            if name == gguf.TENSOR_NAMES[gguf.MODEL_TENSOR.OUTPUT] + ".weight":
+                return DT_Q8_0
+        return dt
 
 
 GGML_FILE_TYPE_TO_DATA_TYPE: dict[GGMLFileType, DataType] = {
     GGMLFileType.AllF32    : DT_F32,
     GGMLFileType.MostlyF16 : DT_F16,
     GGMLFileType.MostlyQ8_0: DT_Q8_0,
+    GGMLFileType.MostlyQ5_1: DT_Q5_1,
+    GGMLFileType.MostlyQ5_0: DT_Q5_0,
+    GGMLFileType.MostlyQ4_1: DT_Q4_1,
+    GGMLFileType.MostlyQ4_0: DT_Q4_0,
 }
 
 #
@@ -680,6 +720,57 @@ class LlamaHfVocab(Vocab):
         return f"<LlamaHfVocab with {self.vocab_size_base} base tokens and {len(self.added_tokens_list)} added tokens>"
 
 
+class CachedVocab(Vocab):
+    # the type of the tokens added after loading, e.g. by --pad-vocab, like the added tokens of each vocab type
+    ADDED_TOKEN_TYPES = {
+        BpeVocab.name: gguf.TokenType.CONTROL,
+        SentencePieceVocab.name: gguf.TokenType.USER_DEFINED,
+        LlamaHfVocab.name: gguf.TokenType.USER_DEFINED,
+    }
+
+    # A vocab from the vocab cache, standing in for the vocab it was extracted from.
+    def __init__(self, entry: dict[str, Any]):
+        self.name = entry["name"]  # type: ignore[misc]
+        self.tokenizer_model = entry["tokenizer_model"]  # type: ignore[misc]
+        self.tokens: list[bytes] = entry["tokens"]
+        self.scores: list[float] = entry["scores"]
+        self.toktypes: list[int] = entry["toktypes"]
+        self.added_tokens_dict = entry["added_tokens_dict"]
+        self.added_tokens_list = entry["added_tokens_list"]
+        self.n_cached_added_tokens = len(self.added_tokens_list)
+        self.vocab_size = entry["vocab_size"]
+        self.fname_tokenizer = Path(entry["fname_tokenizer"])
+
+    @staticmethod
+    def extract(vocab: Vocab) -> dict[str, Any]:
+        tokens, scores, toktypes = [], [], []
+        for text, score, toktype in vocab.all_tokens():
+            # the base tokens of BpeVocab are str
+            tokens.append(text.encode("utf-8") if isinstance(text, str) else text)
+            scores.append(float(score))
+            toktypes.append(int(toktype))
+        return {
+            "name": vocab.name,
+            "tokenizer_model": vocab.tokenizer_model,
+            "tokens": tokens,
+            "scores": scores,
+            "toktypes": toktypes,
+            "added_tokens_dict": vocab.added_tokens_dict,
+            "added_tokens_list": vocab.added_tokens_list,
+            "vocab_size": vocab.vocab_size,
+            "fname_tokenizer": str(vocab.fname_tokenizer),
+        }
+
+    def all_tokens(self) -> Iterable[tuple[bytes, float, gguf.TokenType]]:
+        for text, score, toktype in zip(self.tokens, self.scores, self.toktypes):
+            yield text, score, gguf.TokenType(toktype)
+        for text in self.added_tokens_list[self.n_cached_added_tokens:]:
+            yield text.encode("utf-8"), -1000.0, CachedVocab.ADDED_TOKEN_TYPES[self.name]
+
+    def __repr__(self) -> str:
+        return f"<CachedVocab of type {self.name!r} with {len(self.tokens)} tokens>"
+
+
 #
 # data loading
 # TODO: reuse (probably move to gguf.py?)
@@ -825,8 +916,20 @@ def merge_sharded(models: list[LazyModel]) -> LazyModel:
         concatenated_shape[axis] = sum(tensor.shape[axis] for tensor in lazy_tensors)
 
         def load() -> UnquantizedTensor:
-            ndarrays = [load_unquantized(tensor) for tensor in lazy_tensors]
-            concatenated = np.concatenate(ndarrays, axis=axis)
+            # each part is copied to its place in the result as soon as it's loaded,
+            # so only one part at a time is in memory besides the result
+            concatenated: NDArray | None = None
+            index: list[slice] = [slice(None)] * len(concatenated_shape)
+            start = 0
+            for tensor in lazy_tensors:
+                ndarray = load_unquantized(tensor)
+                if concatenated is None:
+                    concatenated = np.empty(concatenated_shape, dtype=ndarray.dtype)
+                index[axis] = slice(start, start + ndarray.shape[axis])
+                concatenated[tuple(index)] = ndarray
+                start += ndarray.shape[axis]
+                del ndarray
+            assert concatenated is not None
             return UnquantizedTensor(concatenated)
         description = 'concatenated[[' + '] | ['.join(lt.description for lt in lazy_tensors) + ']]'
         return LazyTensor(load, concatenated_shape, lazy_tensors[0].data_type, description)
@@ -907,6 +1010,15 @@ class LazyStorage:
     description: str
 
 
+# Offset of the data of an entry of a zip file, after its local header.
+def zip_data_offset(zip_file: zipfile.ZipFile, info: zipfile.ZipInfo) -> int:
+    assert zip_file.fp is not None
+    zip_file.fp.seek(info.header_offset)
+    header = must_read(zip_file.fp, zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return info.header_offset + zipfile.sizeFileHeader + name_length + extra_length
+
+
 class LazyUnpickler(pickle.Unpickler):
     def __init__(self, fp: IO[bytes], data_base_path: str, zip_file: zipfile.ZipFile):
         super().__init__(fp)
@@ -920,10 +1032,18 @@ class LazyUnpickler(pickle.Unpickler):
         filename_stem = pid[2]
         filename = f'{self.data_base_path}/{filename_stem}'
         info = self.zip_file.getinfo(filename)
+        path = self.zip_file.filename
+        data_start = zip_data_offset(self.zip_file, info) if info.compress_type == zipfile.ZIP_STORED else None
 
+        # the file is only open while the storage is read, the zip file of the pickle isn't kept open
         def load(offset: int, elm_count: int) -> NDArray:
             dtype = data_type.dtype
-            with self.zip_file.open(info) as fp:
+            if data_start is not None:
+                # torch saves the storages uncompressed, they are read straight from the file
+                data = np.fromfile(path, dtype=dtype, count=elm_count, offset=data_start + offset * dtype.itemsize)
+                assert len(data) == elm_count
+                return data
+            with zipfile.ZipFile(path) as zf, zf.open(info) as fp:
                 fp.seek(offset * dtype.itemsize)
                 size = elm_count * dtype.itemsize
                 data = fp.read(size)
@@ -966,40 +1086,35 @@ class LazyUnpickler(pickle.Unpickler):
 
 
 def lazy_load_torch_file(outer_fp: IO[bytes], path: Path) -> ModelPlus:
-    zf = zipfile.ZipFile(outer_fp)
-    pickle_paths = [name for name in zf.namelist() if name.endswith('.pkl')]
-    assert len(pickle_paths) == 1, pickle_paths
-    pickle_fp = zf.open(pickle_paths[0], 'r')
-    unpickler = LazyUnpickler(pickle_fp,
-                              data_base_path=pickle_paths[0][:-4],
-                              zip_file=zf)
-    model = unpickler.load()
+    with zipfile.ZipFile(outer_fp) as zf:
+        pickle_paths = [name for name in zf.namelist() if name.endswith('.pkl')]
+        assert len(pickle_paths) == 1, pickle_paths
+        with zf.open(pickle_paths[0], 'r') as pickle_fp:
+            unpickler = LazyUnpickler(pickle_fp,
+                                      data_base_path=pickle_paths[0][:-4],
+                                      zip_file=zf)
+            model = unpickler.load()
     if 'model' in model: model = model['model']
     as_dict = dict(model.items())
     return ModelPlus(model=as_dict, paths=[path], format='torch', vocab=None)
 
 
 def lazy_load_safetensors_file(fp: IO[bytes], path: Path) -> ModelPlus:
-    header_size, = struct.unpack('<Q', fp.read(8))
-    header: dict[str, dict[str, Any]] = json.loads(fp.read(header_size))
-    # Use mmap for the actual data to avoid race conditions with the file offset.
-    mapped = memoryview(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ))
-    byte_buf = mapped[8 + header_size:]
-
-    def convert(info: dict[str, Any]) -> LazyTensor:
-        data_type = SAFETENSORS_DATA_TYPES[info['dtype']]
-        numpy_dtype = data_type.dtype
-        shape: list[int] = info['shape']
-        begin, end = info['data_offsets']
-        assert 0 <= begin <= end <= len(byte_buf)
-        assert end - begin == math.prod(shape) * numpy_dtype.itemsize
-        buf = byte_buf[begin:end]
+    # the tensors are views of a memory map of the file, which avoids race conditions with the file offset
+    reader = gguf.SafetensorsReader(path)
+
+    def convert(tensor: gguf.SafetensorsTensor) -> LazyTensor:
+        data_type = SAFETENSORS_DATA_TYPES[tensor.dtype]
+        begin, end = tensor.data_offset, tensor.data_offset + tensor.n_bytes
 
         def load() -> UnquantizedTensor:
-            return UnquantizedTensor(np.frombuffer(buf, dtype=numpy_dtype).reshape(shape))
+            with gguf.profile("load", tensor.n_bytes):
+                # the tensor is a view of the memory map, this times reading it from the disk when profiling
+                gguf.prefault(tensor.data)
+            return UnquantizedTensor(tensor.data)
         description = f'safetensors begin={begin} end={end} type={data_type} path={path}'
-        return LazyTensor(load, shape, data_type, description)
-    model = {name: convert(info) for (name, info) in header.items() if name != '__metadata__'}
+        return LazyTensor(load, list(tensor.shape), data_type, description)
+    model = {name: convert(tensor) for name, tensor in reader.tensors.items()}
     return ModelPlus(model=model, paths=[path], format='safetensors', vocab=None)
 
 
@@ -1010,19 +1125,20 @@ def must_read(fp: IO[bytes], length: int) -> bytes:
     return ret
 
 
-@functools.lru_cache(maxsize=None)
+# Only the header of the file is read, and the file is closed after it. The tensors open it again
+# only while they are loaded (or through a memory map, for safetensors).
 def lazy_load_file(path: Path) -> ModelPlus:
-    fp = open(path, 'rb')
-    first8 = fp.read(8)
-    fp.seek(0)
-    if first8[:2] == b'PK':
-        # A zip file, i.e. PyTorch format
-        return lazy_load_torch_file(fp, path)
-    elif struct.unpack('<Q', first8)[0] < 16 * 1024 * 1024:
-        # Probably safetensors
-        return lazy_load_safetensors_file(fp, path)
-    else:
-        raise ValueError(f"unknown format: {path}")
+    with open(path, 'rb') as fp:
+        first8 = fp.read(8)
+        fp.seek(0)
+        if first8[:2] == b'PK':
+            # A zip file, i.e. PyTorch format
+            return lazy_load_torch_file(fp, path)
+        elif struct.unpack('<Q', first8)[0] < 16 * 1024 * 1024:
+            # Probably safetensors
+            return lazy_load_safetensors_file(fp, path)
+        else:
+            raise ValueError(f"unknown format: {path}")
 
 
 In = TypeVar('In')
@@ -1100,8 +1216,14 @@ def check_vocab_size(params: Params, vocab: BaseVocab, pad_vocab: bool = False)
 
 
 class OutputFile:
-    def __init__(self, fname_out: Path, endianess:gguf.GGUFEndian = gguf.GGUFEndian.LITTLE):
-        self.gguf = gguf.GGUFWriter(fname_out, gguf.MODEL_ARCH_NAMES[ARCH], endianess=endianess)
+    def __init__(
+        self, fname_out: Path, endianess:gguf.GGUFEndian = gguf.GGUFEndian.LITTLE,
+        split_max_tensors: int = 0, split_max_size: int = 0,
+    ):
+        self.gguf = gguf.GGUFWriter(
+            fname_out, gguf.MODEL_ARCH_NAMES[ARCH], endianess=endianess,
+            split_max_tensors=split_max_tensors, split_max_size=split_max_size,
+        )
 
     def add_meta_model(self, params: Params, metadata: Metadata) -> None:
         # Metadata About The Model And Its Provenence
@@ -1217,7 +1339,14 @@ class OutputFile:
 
     def write_tensor_data(self, ftype: GGMLFileType, model: LazyModel, concurrency: int) -> None:
         ndarrays_inner = bounded_parallel_map(OutputFile.do_item, model.items(), concurrency=concurrency)
-        if ftype == GGMLFileType.MostlyQ8_0:
+        profiler = gguf.Profiler.current
+        if isinstance(GGML_FILE_TYPE_TO_DATA_TYPE[ftype], QuantizedDataType) and profiler is not None:
+            profiled = bounded_parallel_map(
+                OutputFile.maybe_do_quantize_profiled, ndarrays_inner, concurrency=concurrency, max_workers=concurrency,
+                use_processpool_executor=True,
+            )
+            ndarrays = (profiler.add_events(events, tensor=name) or arr for name, (arr, events) in zip(model, profiled))
+        elif isinstance(GGML_FILE_TYPE_TO_DATA_TYPE[ftype], QuantizedDataType):
             ndarrays = bounded_parallel_map(
                 OutputFile.maybe_do_quantize, ndarrays_inner, concurrency=concurrency, max_workers=concurrency,
                 use_processpool_executor=True,
@@ -1225,6 +1354,11 @@ class OutputFile:
         else:
             ndarrays = map(OutputFile.maybe_do_quantize, ndarrays_inner)
 
+        # the files of a split model are written from other threads, while the next tensors are converted
+        n_shards = len(self.gguf.shards)
+        executor = ThreadPoolExecutor(max_workers=min(n_shards, concurrency)) if n_shards > 1 else None
+        pending: list[concurrent.futures.Future[None]] = []
+
         start = time.time()
         for i, ((name, lazy_tensor), ndarray) in enumerate(zip(model.items(), ndarrays)):
             elapsed = time.time() - start
@@ -1233,7 +1367,17 @@ class OutputFile:
             logger.info(
                 f"[{i + 1:{padi}d}/{len(model)}] Writing tensor {name:38s} | size {size:16} | type {lazy_tensor.data_type.name:4} | T+{int(elapsed):4}"
             )
-            self.gguf.write_tensor_data(ndarray)
+            if executor is None:
+                self.gguf.write_tensor_data(ndarray, name=name)
+                continue
+            if len(pending) >= concurrency:
+                pending.pop(0).result()
+            pending.append(executor.submit(self.gguf.write_tensor_data, ndarray, name))
+
+        if executor is not None:
+            for future in pending:
+                future.result()
+            executor.shutdown()
 
     def close(self) -> None:
         self.gguf.close()
@@ -1260,7 +1404,8 @@ class OutputFile:
     @staticmethod
     def do_item(item: tuple[str, LazyTensor]) -> tuple[DataType, NDArray]:
         name, lazy_tensor = item
-        tensor = lazy_tensor.load().to_ggml()
+        with gguf.profile_tensor(name), gguf.profile("transform"):
+            tensor = lazy_tensor.load().to_ggml()
         return (lazy_tensor.data_type, tensor.ndarray)
 
     @staticmethod
@@ -1270,16 +1415,24 @@ class OutputFile:
             return arr
         return dt.quantize(arr)
 
+    # Runs in a worker process when profiling, so the events of the quantization are sent back with the result.
+    @staticmethod
+    def maybe_do_quantize_profiled(item: tuple[DataType, NDArray]) -> tuple[NDArray, list[gguf.ProfileEvent]]:
+        with gguf.Profiler() as profiler:
+            arr = OutputFile.maybe_do_quantize(item)
+        return arr, profiler.events
+
     @staticmethod
     def write_all(
         fname_out: Path, ftype: GGMLFileType, params: Params, model: LazyModel, vocab: BaseVocab, svocab: gguf.SpecialVocab,
         concurrency: int = DEFAULT_CONCURRENCY, endianess: gguf.GGUFEndian = gguf.GGUFEndian.LITTLE,
         pad_vocab: bool = False,
         metadata: Metadata = None,
-    ) -> None:
+        split_max_tensors: int = 0, split_max_size: int = 0,
+    ) -> list[str]:
         check_vocab_size(params, vocab, pad_vocab=pad_vocab)
 
-        of = OutputFile(fname_out, endianess=endianess)
+        of = OutputFile(fname_out, endianess=endianess, split_max_tensors=split_max_tensors, split_max_size=split_max_size)
 
         # meta data
         of.add_meta_model(params, metadata)
@@ -1302,6 +1455,8 @@ class OutputFile:
 
         of.close()
 
+        return [of.gguf.shard_path(i) for i in range(len(of.gguf.shards))]
+
 
 def pick_output_type(model: LazyModel, output_type_str: str | None) -> GGMLFileType:
     wq_type = model[gguf.TENSOR_NAMES[gguf.MODEL_TENSOR.ATTN_Q].format(bid=0) + ".weight"].data_type
@@ -1312,6 +1467,14 @@ def pick_output_type(model: LazyModel, output_type_str: str | None) -> GGMLFileT
         return GGMLFileType.MostlyF16
     if output_type_str == "q8_0":
         return GGMLFileType.MostlyQ8_0
+    if output_type_str == "q5_1":
+        return GGMLFileType.MostlyQ5_1
+    if output_type_str == "q5_0":
+        return GGMLFileType.MostlyQ5_0
+    if output_type_str == "q4_1":
+        return GGMLFileType.MostlyQ4_1
+    if output_type_str == "q4_0":
+        return GGMLFileType.MostlyQ4_0
 
     name_to_type = {name: lazy_tensor.data_type for (name, lazy_tensor) in model.items()}
 
@@ -1450,7 +1613,7 @@ def find_multifile_paths(path: Path) -> list[Path]:
     return ret
 
 
-def load_some_model(path: Path) -> ModelPlus:
+def load_some_model(path: Path, concurrency: int = DEFAULT_CONCURRENCY) -> ModelPlus:
     '''Load a model of any supported format.'''
     # Be extra-friendly and accept either a file or a directory:
     if path.is_dir():
@@ -1468,10 +1631,11 @@ def load_some_model(path: Path) -> ModelPlus:
         path = files[0]
 
     paths = find_multifile_paths(path)
-    models_plus: list[ModelPlus] = []
     for path in paths:
         logger.info(f"Loading model file {path}")
-        models_plus.append(lazy_load_file(path))
+    # the headers of the parts are read at once, which hides the latency of the reads (e.g. on network storage)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(paths), concurrency))) as executor:
+        models_plus = list(executor.map(lazy_load_file, paths))
 
     model_plus = merge_multifile_models(models_plus)
     return model_plus
@@ -1480,8 +1644,9 @@ def load_some_model(path: Path) -> ModelPlus:
 class VocabFactory:
     _VOCAB_CLASSES: list[type[Vocab]] = [SentencePieceVocab, BpeVocab, LlamaHfVocab]
 
-    def __init__(self, path: Path):
+    def __init__(self, path: Path, vocab_cache: gguf.VocabCache | None = None):
         self.path = path
+        self.vocab_cache = vocab_cache
 
     def _create_special_vocab(self, vocab: BaseVocab, model_parent_path: Path) -> gguf.SpecialVocab:
         load_merges = vocab.name == "bpe"
@@ -1502,6 +1667,13 @@ class VocabFactory:
             except KeyError:
                 raise ValueError(f"Unsupported vocabulary type {vtype}") from None
 
+        if self.vocab_cache is not None:
+            # the vocab classes are in this script, a change to them invalidates the entries
+            cache_key = self.vocab_cache.key("convert", gguf.VocabCache.tokenizer_files(self.path), vocab_types=list(selected_vocabs),
+                                             converter=gguf.VocabCache.file_hash(Path(__file__)))
+            if (entry := self.vocab_cache.load(cache_key)) is not None:
+                return CachedVocab(entry)
+
         for vtype, cls in selected_vocabs.items():
             try:
                 vocab = cls(self.path)
@@ -1512,6 +1684,8 @@ class VocabFactory:
             raise FileNotFoundError(f"Could not find a tokenizer matching any of {vocab_types}")
 
         logger.info(f"Loaded vocab file {vocab.fname_tokenizer!r}, type {vocab.name!r}")
+        if self.vocab_cache is not None:
+            self.vocab_cache.store(cache_key, CachedVocab.extract(vocab))
         return vocab
 
     def load_vocab(self, vocab_types: list[str] | None, model_parent_path: Path) -> tuple[BaseVocab, gguf.SpecialVocab]:
@@ -1533,6 +1707,10 @@ def default_convention_outfile(file_type: GGMLFileType, params: Params, model_pa
         GGMLFileType.AllF32:    "F32",
         GGMLFileType.MostlyF16: "F16",
         GGMLFileType.MostlyQ8_0: "Q8_0",
+        GGMLFileType.MostlyQ5_1: "Q5_1",
+        GGMLFileType.MostlyQ5_0: "Q5_0",
+        GGMLFileType.MostlyQ4_1: "Q4_1",
+        GGMLFileType.MostlyQ4_0: "Q4_0",
     }[file_type]
 
     parameters = model_parameter_count_rounded_notation(model_params_count)
@@ -1576,14 +1754,14 @@ def do_dump_model(model_plus: ModelPlus) -> None:
 def main(args_in: list[str] | None = None) -> None:
     output_choices = ["f32", "f16"]
     if np.uint32(1) == np.uint32(1).newbyteorder("<"):
-        # We currently only support Q8_0 output on little endian systems.
-        output_choices.append("q8_0")
+        # We currently only support quantized output on little endian systems.
+        output_choices.extend(["q8_0", "q5_1", "q5_0", "q4_1", "q4_0"])
     parser = argparse.ArgumentParser(description="Convert a LLaMA model to a GGML compatible file")
     parser.add_argument("--dump",         action="store_true",    help="don't convert, just show what's in the model")
     parser.add_argument("--dump-single",  action="store_true",    help="don't convert, just show what's in a single model file")
     parser.add_argument("--vocab-only",   action="store_true",    help="extract only the vocab")
     parser.add_argument("--no-vocab",     action="store_true",    help="store model without the vocab")
-    parser.add_argument("--outtype",      choices=output_choices, help="output format - note: q8_0 may be very slow (default: f16 or f32 based on input)")
+    parser.add_argument("--outtype",      choices=output_choices, help="output format - note: quantized types may be very slow (default: f16 or f32 based on input)")
     parser.add_argument("--vocab-dir",    type=Path,              help="directory containing tokenizer.model, if separate from model file")
     parser.add_argument("--vocab-type",                           help="vocab types to try in order, choose from 'spm', 'bpe', 'hfft' (default: spm,hfft)", default="spm,hfft")
     parser.add_argument("--outfile",      type=Path,              help="path to write to; default: based on input")
@@ -1596,6 +1774,11 @@ def main(args_in: list[str] | None = None) -> None:
     parser.add_argument("--verbose",      action="store_true",    help="increase output verbosity")
     parser.add_argument("--metadata",     type=Path,              help="Specify the path for a metadata file")
     parser.add_argument("--get-outfile",  action="store_true",    help="get calculated default outfile name")
+    parser.add_argument("--split-max-tensors", type=int, default=0, help="max tensors in each split file (default: no split)")
+    parser.add_argument("--split-max-size",    type=str, default="0", help="max size of the tensor data in each split file, N(K|M|G) (default: no split)")
+    parser.add_argument("--profile",           type=Path,           help="time each stage of the conversion per tensor, log a summary and save a Chrome trace to this JSON file")
+    parser.add_argument("--vocab-cache",       type=Path,           help="directory of the cache of extracted vocabs, keyed by the contents of the tokenizer files (default: $XDG_CACHE_HOME/gguf-py/vocab or ~/.cache/gguf-py/vocab)")
+    parser.add_argument("--no-vocab-cache",    action="store_true", help="always extract the vocab, without reading or saving it in the vocab cache")
 
     args = parser.parse_args(args_in)
 
@@ -1610,7 +1793,7 @@ def main(args_in: list[str] | None = None) -> None:
     metadata = Metadata.load(args.metadata)
 
     if args.get_outfile:
-        model_plus = load_some_model(args.model)
+        model_plus = load_some_model(args.model, args.concurrency)
         params = Params.load(model_plus)
         model   = convert_model_names(model_plus.model, params, args.skip_unknown)
         model_params_count = model_parameter_count(model_plus.model)
@@ -1626,8 +1809,11 @@ def main(args_in: list[str] | None = None) -> None:
         do_dump_model(model_plus)
         return
 
+    profiler = gguf.Profiler() if args.profile is not None else None
+
     if not args.vocab_only:
-        model_plus = load_some_model(args.model)
+        with profiler or contextlib.nullcontext():
+            model_plus = load_some_model(args.model, args.concurrency)
     else:
         model_plus = ModelPlus(model = {}, paths = [args.model / 'dummy'], format = 'none', vocab = None)
 
@@ -1660,13 +1846,17 @@ def main(args_in: list[str] | None = None) -> None:
                 "f32": GGMLFileType.AllF32,
                 "f16": GGMLFileType.MostlyF16,
                 "q8_0": GGMLFileType.MostlyQ8_0,
+                "q5_1": GGMLFileType.MostlyQ5_1,
+                "q5_0": GGMLFileType.MostlyQ5_0,
+                "q4_1": GGMLFileType.MostlyQ4_1,
+                "q4_0": GGMLFileType.MostlyQ4_0,
             }[args.outtype]
 
         logger.info(f"params = {params}")
 
     model_parent_path = model_plus.paths[0].parent
     vocab_path = Path(args.vocab_dir or args.model or model_parent_path)
-    vocab_factory = VocabFactory(vocab_path)
+    vocab_factory = VocabFactory(vocab_path, None if args.no_vocab_cache else gguf.VocabCache(args.vocab_cache))
     vocab_types = None if args.no_vocab else args.vocab_type.split(",")
     vocab, special_vocab = vocab_factory.load_vocab(vocab_types, model_parent_path)
 
@@ -1705,9 +1895,17 @@ def main(args_in: list[str] | None = None) -> None:
     params.ftype = ftype
     logger.info(f"Writing {outfile}, format {ftype}")
 
-    OutputFile.write_all(outfile, ftype, params, model, vocab, special_vocab,
-                         concurrency=args.concurrency, endianess=endianess, pad_vocab=args.pad_vocab, metadata=metadata)
-    logger.info(f"Wrote {outfile}")
+    with profiler or contextlib.nullcontext():
+        paths = OutputFile.write_all(outfile, ftype, params, model, vocab, special_vocab,
+                                     concurrency=args.concurrency, endianess=endianess, pad_vocab=args.pad_vocab, metadata=metadata,
+                                     split_max_tensors=args.split_max_tensors, split_max_size=gguf.split_str_to_n_bytes(args.split_max_size))
+    for path in paths:
+        logger.info(f"Wrote {path}")
+
+    if profiler is not None:
+        logger.info(f"Profile:\n{profiler.summary()}")
+        profiler.write_chrome_trace(args.profile)
+        logger.info(f"Saved the Chrome trace to {args.profile}")
 
 
 if __name__ == '__main__':
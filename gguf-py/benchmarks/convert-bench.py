@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+#
+# End-to-end benchmark of convert-hf-to-gguf.py and convert.py on synthetic checkpoints.
+#
+# The checkpoints are HF-style directories (config.json, safetensors shards, tokenizer.model) with random weights
+# in the shapes of Llama and Qwen2 models, generated once into a cache directory. Everything runs offline on the CPU.
+# Each conversion runs in its own process, with --profile for the time spent per stage;
+# the results are saved as JSON, which can be compared to the results of an earlier run with --compare.
+#
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Iterator, NamedTuple
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+logger = logging.getLogger("convert-bench")
+
+REPO_DIR = Path(__file__).parent.parent.parent
+
+CONVERTERS = {
+    "hf":      REPO_DIR / "convert-hf-to-gguf.py",
+    "convert": REPO_DIR / "convert.py",
+}
+
+# output types of each converter
+OUTTYPES = {
+    "hf":      ["f32", "f16", "bf16", "q8_0", "q5_1", "q5_0", "q4_1", "q4_0"],
+    "convert": ["f32", "f16", "q8_0", "q5_1", "q5_0", "q4_1", "q4_0"],
+}
+
+class ModelShape(NamedTuple):
+    arch: str  # "llama" or "qwen2"
+    hidden_size: int
+    intermediate_size: int
+    n_layers: int
+    n_heads: int
+    n_kv_heads: int
+    vocab_size: int
+
+    @property
+    def n_params(self) -> int:
+        return sum(int(np.prod(shape)) for _, shape in model_tensors(self))
+
+
+# scaled-down shapes of the real models, with fewer layers
+MODELS: dict[str, ModelShape] = {
+    "llama-tiny":   ModelShape("llama",  256,  688, 2,  4, 4,  2048),
+    "llama-small":  ModelShape("llama", 1024, 2816, 4, 16, 4,  8192),
+    "llama-medium": ModelShape("llama", 2048, 5632, 8, 16, 4, 32000),
+    "qwen2-tiny":   ModelShape("qwen2",  256,  704, 2,  4, 2,  2048),
+    "qwen2-small":  ModelShape("qwen2",  896, 4864, 4, 14, 2,  8192),
+    "qwen2-medium": ModelShape("qwen2", 1536, 8960, 8, 12, 2, 32000),
+}
+
+
+def model_tensors(shape: ModelShape) -> Iterator[tuple[str, tuple[int, ...]]]:
+    h, i = shape.hidden_size, shape.intermediate_size
+    kv = shape.n_kv_heads * (h // shape.n_heads)
+    yield "model.embed_tokens.weight", (shape.vocab_size, h)
+    for bid in range(shape.n_layers):
+        prefix = f"model.layers.{bid}"
+        yield f"{prefix}.input_layernorm.weight", (h,)
+        for proj, n_out in (("q_proj", h), ("k_proj", kv), ("v_proj", kv)):
+            yield f"{prefix}.self_attn.{proj}.weight", (n_out, h)
+            if shape.arch == "qwen2":
+                yield f"{prefix}.self_attn.{proj}.bias", (n_out,)
+        yield f"{prefix}.self_attn.o_proj.weight", (h, h)
+        yield f"{prefix}.post_attention_layernorm.weight", (h,)
+        yield f"{prefix}.mlp.gate_proj.weight", (i, h)
+        yield f"{prefix}.mlp.up_proj.weight", (i, h)
+        yield f"{prefix}.mlp.down_proj.weight", (h, i)
+    yield "model.norm.weight", (h,)
+    yield "lm_head.weight", (shape.vocab_size, h)
+
+
+def model_config(shape: ModelShape, dtype: str) -> dict[str, Any]:
+    config: dict[str, Any] = {
+        "hidden_size": shape.hidden_size,
+        "intermediate_size": shape.intermediate_size,
+        "num_hidden_layers": shape.n_layers,
+        "num_attention_heads": shape.n_heads,
+        "num_key_value_heads": shape.n_kv_heads,
+        "vocab_size": shape.vocab_size,
+        "max_position_embeddings": 4096,
+        "hidden_act": "silu",
+        "tie_word_embeddings": False,
+        "torch_dtype": {"bf16": "bfloat16", "f16": "float16", "f32": "float32"}[dtype],
+        "bos_token_id": 1,
+        "eos_token_id": 2,
+    }
+    if shape.arch == "llama":
+        config.update(architectures=["LlamaForCausalLM"], model_type="llama", rms_norm_eps=1e-5, rope_theta=10000.0)
+    else:
+        config.update(architectures=["Qwen2ForCausalLM"], model_type="qwen2", rms_norm_eps=1e-6, rope_theta=1000000.0)
+    return config
+
+
+# the weights are small random values, the norms are close to 1
+def tensor_chunks(rng: np.random.Generator, name: str, shape: tuple[int, ...], dtype: str) -> Iterator[bytes]:
+    n = int(np.prod(shape))
+    # in chunks, to bound the memory needed for the larger tensors
+    chunk = 1 << 22
+    for i in range(0, n, chunk):
+        data = rng.standard_normal(min(chunk, n - i), dtype=np.float32)
+        if name.endswith("norm.weight"):
+            data = 1 + data * np.float32(0.1)
+        else:
+            data *= np.float32(0.02)
+        if dtype == "bf16":
+            # truncated, which is enough for random data
+            yield (data.view(np.uint32) >> 16).astype("<u2").tobytes()
+        else:
+            yield data.astype("<f2" if dtype == "f16" else "<f4").tobytes()
+
+
+def write_safetensors(path: Path, tensors: list[tuple[str, tuple[int, ...]]], dtype: str, rng: np.random.Generator) -> None:
+    itemsize = {"bf16": 2, "f16": 2, "f32": 4}[dtype]
+    header: dict[str, Any] = {"__metadata__": {"format": "pt"}}
+    offset = 0
+    for name, shape in tensors:
+        n_bytes = int(np.prod(shape)) * itemsize
+        header[name] = {"dtype": dtype.upper(), "shape": list(shape), "data_offsets": [offset, offset + n_bytes]}
+        offset += n_bytes
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # the data starts at a multiple of 8 bytes, like with the safetensors package
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    with open(path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for name, shape in tensors:
+            for chunk in tensor_chunks(rng, name, shape, dtype):
+                f.write(chunk)
+
+
+def write_tokenizer(path: Path, rng: np.random.Generator) -> None:
+    from sentencepiece import SentencePieceTrainer
+
+    # random words, enough for a small vocab; the model vocab is padded up to vocab_size by the converters
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    sentences = [" ".join("".join(rng.choice(letters, rng.integers(2, 9))) for _ in range(12)) for _ in range(2000)]
+    with open(path, "wb") as f:
+        SentencePieceTrainer.train(sentence_iterator=iter(sentences), model_writer=f, vocab_size=512, num_threads=1,
+                                   bos_id=1, eos_id=2, unk_id=0, minloglevel=2)
+
+
+# Generate the checkpoint of a model, unless it's already in the cache.
+def make_checkpoint(cache_dir: Path, model: str, dtype: str, max_shard_size: int) -> Path:
+    shape = MODELS[model]
+    dir_model = cache_dir / f"{model}-{dtype}"
+    done_path = dir_model / ".complete"
+    if done_path.is_file():
+        return dir_model
+
+    logger.info(f"Generating {model} with {shape.n_params / 1e6:.0f}M {dtype} parameters in {dir_model}")
+    dir_model.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(0)
+    itemsize = {"bf16": 2, "f16": 2, "f32": 4}[dtype]
+
+    shards: list[list[tuple[str, tuple[int, ...]]]] = [[]]
+    shard_size = 0
+    for name, tshape in model_tensors(shape):
+        n_bytes = int(np.prod(tshape)) * itemsize
+        if shards[-1] and shard_size + n_bytes > max_shard_size:
+            shards.append([])
+            shard_size = 0
+        shards[-1].append((name, tshape))
+        shard_size += n_bytes
+
+    if len(shards) == 1:
+        write_safetensors(dir_model / "model.safetensors", shards[0], dtype, rng)
+    else:
+        weight_map: dict[str, str] = {}
+        for i, tensors in enumerate(shards):
+            shard_name = f"model-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+            write_safetensors(dir_model / shard_name, tensors, dtype, rng)
+            weight_map.update((name, shard_name) for name, _ in tensors)
+        with open(dir_model / "model.safetensors.index.json", "w") as f:
+            json.dump({"metadata": {"total_size": shape.n_params * itemsize}, "weight_map": weight_map}, f, indent=2)
+
+    with open(dir_model / "config.json", "w") as f:
+        json.dump(model_config(shape, dtype), f, indent=2)
+    write_tokenizer(dir_model / "tokenizer.model", rng)
+    done_path.touch()
+    return dir_model
+
+
+def run_conversion(converter: str, dir_model: Path, outtype: str, work_dir: Path, extra_args: list[str]) -> dict[str, Any]:
+    out_dir = Path(tempfile.mkdtemp(prefix=f"{converter}-{outtype}-", dir=work_dir))
+    try:
+        trace_path = out_dir / "trace.json"
+        log_path = out_dir / "convert.log"
+        args = [str(dir_model), "--outtype", outtype, "--outfile", str(out_dir / "model.gguf"), "--profile", str(trace_path), *extra_args]
+        if converter == "convert":
+            # the tokenizer has fewer tokens than the synthetic models
+            args.append("--pad-vocab")
+
+        start = time.perf_counter()
+        with open(log_path, "w") as log:
+            process = subprocess.Popen([sys.executable, str(CONVERTERS[converter]), *args], stdout=log, stderr=subprocess.STDOUT)
+            # the peak RSS of the conversion and of its worker processes, like the quantization processes of convert.py
+            _, status, rusage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start
+        returncode = os.waitstatus_to_exitcode(status)
+        process.returncode = returncode
+        if returncode != 0:
+            with open(log_path) as log:
+                tail = log.readlines()[-20:]
+            raise RuntimeError(f"{CONVERTERS[converter].name} failed with exit code {returncode}:\n{''.join(tail)}")
+
+        # time spent in each stage, summed over the threads and processes of the conversion
+        stages = dict.fromkeys(gguf.PROFILE_STAGES, 0.0)
+        with open(trace_path) as f:
+            for event in json.load(f)["traceEvents"]:
+                stages[event["cat"]] = stages.get(event["cat"], 0.0) + event["args"]["self_time"]
+
+        bytes_written = sum(path.stat().st_size for path in out_dir.glob("*.gguf"))
+        # in bytes on macOS, in kilobytes elsewhere
+        peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+        return {"wall_time": wall_time, "peak_rss": peak_rss, "bytes_written": bytes_written, "stages": stages}
+    finally:
+        for path in out_dir.iterdir():
+            path.unlink()
+        out_dir.rmdir()
+
+
+def machine_info() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "commit": commit or None,
+    }
+
+
+def result_key(result: dict[str, Any]) -> tuple[str, str, str, str]:
+    return (result["model"], result["dtype"], result["converter"], result["outtype"])
+
+
+# Compare with the results of an earlier run, returns whether something is slower or bigger than the threshold allows.
+def compare(results: list[dict[str, Any]], baseline: list[dict[str, Any]], threshold: float) -> bool:
+    baseline_by_key = {result_key(r): r for r in baseline}
+    regressed = False
+    print(f"{'model':<14} | {'dtype':<5} | {'converter':<9} | {'outtype':<7} | {'time':>7} | {'peak RSS':>8} | {'size':>7}")  # noqa: NP100
+    for result in results:
+        base = baseline_by_key.get(result_key(result))
+        if base is None:
+            continue
+        ratios = [result[k] / base[k] if base[k] else 1.0 for k in ("wall_time", "peak_rss", "bytes_written")]
+        marks = ["!" if r > 1 + threshold else " " for r in ratios]
+        regressed = regressed or "!" in marks
+        cells = " | ".join(f"{r:6.2f}x{m}" for r, m in zip(ratios, marks))
+        print(f"{result['model']:<14} | {result['dtype']:<5} | {result['converter']:<9} | {result['outtype']:<7} | {cells}")  # noqa: NP100
+    return regressed
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Measure the end-to-end conversion of synthetic HF checkpoints, offline on the CPU")
+    parser.add_argument("--models",     type=str, nargs="+", default=["llama-tiny", "qwen2-tiny"], choices=list(MODELS), help="synthetic models to convert")
+    parser.add_argument("--dtype",      type=str, default="bf16", choices=["bf16", "f16", "f32"], help="type of the weights of the synthetic checkpoints")
+    parser.add_argument("--converters", type=str, nargs="+", default=list(CONVERTERS), choices=list(CONVERTERS),
+                        help="converters to run: hf for convert-hf-to-gguf.py (needs torch), convert for convert.py")
+    parser.add_argument("--outtypes",   type=str, nargs="+", default=["f16", "q8_0"], help="output types to convert to, those a converter doesn't support are skipped")
+    parser.add_argument("--repeat",     type=int, default=1, help="number of runs per conversion, the fastest one is reported")
+    parser.add_argument("--cache-dir",  type=Path, default=Path(tempfile.gettempdir()) / "gguf-convert-bench", help="where the synthetic checkpoints are generated and kept")
+    parser.add_argument("--work-dir",   type=Path, help="where the outputs are written, they are deleted after each run (default: the cache directory)")
+    parser.add_argument("--max-shard-size", type=str, default="1G", help="max size of the safetensors files of the checkpoints, N(K|M|G)")
+    parser.add_argument("--hf-args",      type=str, default="", help="extra arguments for convert-hf-to-gguf.py, e.g. \"--threads 4\"")
+    parser.add_argument("--convert-args", type=str, default="", help="extra arguments for convert.py")
+    parser.add_argument("--output",     type=Path, help="JSON file to save the results to")
+    parser.add_argument("--compare",    type=Path, help="JSON results of an earlier run to compare with, exits with 1 when a ratio goes over the threshold")
+    parser.add_argument("--threshold",  type=float, default=0.1, help="allowed relative increase of the time, peak RSS and size over --compare")
+    parser.add_argument("--verbose",    action="store_true", help="increase output verbosity")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    converters: list[str] = args.converters
+    if "hf" in converters and importlib.util.find_spec("torch") is None:
+        logger.warning("Skipping convert-hf-to-gguf.py, torch is not installed")
+        converters = [c for c in converters if c != "hf"]
+
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    max_shard_size = args.max_shard_size.upper()
+    max_shard_size = int(max_shard_size[:-1]) * units[max_shard_size[-1]] if max_shard_size[-1:] in units else int(max_shard_size)
+
+    args.cache_dir.mkdir(parents=True, exist_ok=True)
+    work_dir: Path = args.work_dir or args.cache_dir
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    results: list[dict[str, Any]] = []
+    for model in args.models:
+        dir_model = make_checkpoint(args.cache_dir, model, args.dtype, max_shard_size)
+        for converter in converters:
+            extra_args = (args.hf_args if converter == "hf" else args.convert_args).split()
+            for outtype in args.outtypes:
+                if outtype not in OUTTYPES[converter]:
+                    logger.warning(f"Skipping {outtype} for {CONVERTERS[converter].name}, which doesn't support it")
+                    continue
+                logger.info(f"* {model} ({args.dtype}) -> {outtype} with {CONVERTERS[converter].name}")
+                runs = [run_conversion(converter, dir_model, outtype, work_dir, extra_args) for _ in range(args.repeat)]
+                best = min(runs, key=lambda r: r["wall_time"])
+                stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in best["stages"].items())
+                logger.info(f"  {best['wall_time']:.2f}s, peak RSS {best['peak_rss'] / 1024**2:.0f} MiB, "
+                            f"{best['bytes_written'] / 1024**2:.1f} MiB written ({stages})")
+                results.append({
+                    "model": model, "dtype": args.dtype, "n_params": MODELS[model].n_params,
+                    "converter": converter, "outtype": outtype, "args": extra_args, **best,
+                })
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"machine": machine_info(), "results": results}, f, indent=2)
+        logger.info(f"Saved the results to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
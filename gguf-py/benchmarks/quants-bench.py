@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import logging
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+logger = logging.getLogger("quants-bench")
+
+
+def bench_quantize(data: np.ndarray, qtype: gguf.GGMLQuantizationType, n_threads: int, repeat: int) -> float:
+    # best of `repeat`, to hide warm-up and noise from other processes
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        gguf.quantize(data, qtype, n_threads=n_threads)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the throughput of the NumPy quantization per thread count")
+    parser.add_argument("--type",    type=str, default="q8_0", choices=["q8_0", "q5_1", "q5_0", "q4_1", "q4_0"], help="quantization type to measure")
+    parser.add_argument("--rows",    type=int, default=8192, help="number of rows of the test tensor")
+    parser.add_argument("--cols",    type=int, default=8192, help="number of columns of the test tensor (multiple of 32)")
+    parser.add_argument("--threads", type=int, nargs="+",    help="thread counts to measure (default: powers of two up to the number of cores)")
+    parser.add_argument("--repeat",  type=int, default=3,    help="number of runs per thread count, the fastest one is reported")
+    parser.add_argument("--verbose", action="store_true",    help="increase output verbosity")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    n_cores = os.cpu_count() or 1
+    threads: list[int] = args.threads or sorted({1 << i for i in range(n_cores.bit_length()) if 1 << i <= n_cores} | {n_cores})
+
+    qtype = gguf.GGMLQuantizationType[args.type.upper()]
+    data = np.random.default_rng(0).standard_normal((args.rows, args.cols), dtype=np.float32)
+    reference = gguf.quantize(data, qtype, n_threads=1)
+    gbytes = data.nbytes / 1e9
+
+    logger.info(f"* Quantizing a {args.rows}x{args.cols} F32 tensor ({gbytes:.2f} GB) to {qtype.name} on {n_cores} core(s)")
+    print(f"{'threads':>7} | {'seconds':>8} | {'GB/s':>7} | {'GB/s/thread':>11}")  # noqa: NP100
+    for n_threads in threads:
+        if not np.array_equal(gguf.quantize(data, qtype, n_threads=n_threads), reference):
+            raise ValueError(f"{qtype.name} output with {n_threads} threads differs from the single-threaded output")
+        seconds = bench_quantize(data, qtype, n_threads, args.repeat)
+        print(f"{n_threads:7} | {seconds:8.3f} | {gbytes / seconds:7.2f} | {gbytes / seconds / n_threads:11.2f}")  # noqa: NP100
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 from .constants import *
+from .profiling import *
 from .lazy import *
 from .gguf_reader import *
 from .gguf_writer import *
 from .quants import *
+from .safetensors_reader import *
 from .tensor_mapping import *
 from .vocab import *
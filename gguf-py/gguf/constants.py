@@ -100,6 +100,11 @@ class Keys:
         MIDDLE_ID        = "tokenizer.ggml.middle_token_id"
         EOT_ID           = "tokenizer.ggml.eot_token_id"
 
+    class Split:
+        NO            = "split.no"
+        COUNT         = "split.count"
+        TENSORS_COUNT = "split.tensors.count"
+
 
 #
 # recommended mapping of model tensor names for storage in gguf
@@ -6,14 +6,17 @@ from __future__ import annotations
 
 import logging
 import os
+import re
+import struct
+import sys
 from collections import OrderedDict
+from collections.abc import Iterator, MutableMapping, Sequence
 from typing import Any, Literal, NamedTuple, TypeVar, Union
 
 import numpy as np
 import numpy.typing as npt
 
 if __name__ == "__main__":
-    import sys
     from pathlib import Path
 
     # Allow running file in package as a script.
@@ -26,7 +29,9 @@ from gguf.constants import (
     GGUF_VERSION,
     GGMLQuantizationType,
     GGUFValueType,
+    Keys,
 )
+from gguf.quants import dequantize
 
 logger = logging.getLogger(__name__)
 
@@ -51,6 +56,117 @@ class ReaderField(NamedTuple):
 
     types: list[GGUFValueType] = []
 
+    # Decode the value of the field: a Python scalar or str, or a list of those for arrays.
+    def contents(self) -> Any:
+        if not self.types:
+            return None
+        if self.types[0] == GGUFValueType.ARRAY:
+            if isinstance(self.parts, _ArrayParts):
+                return self.parts.contents()
+            if self.types[-1] == GGUFValueType.STRING:
+                return [str(bytes(self.parts[idx]), encoding = 'utf-8') for idx in self.data]
+            return [pv for idx in self.data for pv in self.parts[idx].tolist()]
+        if self.types[0] == GGUFValueType.STRING:
+            return str(bytes(self.parts[-1]), encoding = 'utf-8')
+        return self.parts[-1].tolist()[0]
+
+
+# Where a key/value field is in the file, recorded without decoding it.
+class _FieldInfo(NamedTuple):
+    offset: int
+    name: str
+    # Offset of the value, right after its type.
+    value_offset: int
+    # Size of the whole field, from its offset.
+    size: int
+    gtype: GGUFValueType
+    # Type and length of arrays.
+    item_type: GGUFValueType | None = None
+    count: int = 0
+    # Offsets of the strings (of their lengths) of arrays of strings.
+    string_offsets: npt.NDArray[np.int64] | None = None
+
+
+# The parts of an array field, same as they would be in ReaderField.parts,
+# but each element is only viewed when accessed.
+class _ArrayParts(Sequence):
+    def __init__(self, reader: GGUFReader, head: list[npt.NDArray[Any]], info: _FieldInfo):
+        self._reader = reader
+        self._head = head
+        self._info = info
+        self._parts_per_item = 2 if info.item_type == GGUFValueType.STRING else 1
+
+    def __len__(self) -> int:
+        return len(self._head) + self._info.count * self._parts_per_item
+
+    def __getitem__(self, idx: Any) -> Any:
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError('array part index out of range')
+        if idx < len(self._head):
+            return self._head[idx]
+        item, sub = divmod(idx - len(self._head), self._parts_per_item)
+        info = self._info
+        if info.string_offsets is not None:
+            offs = int(info.string_offsets[item])
+            if sub == 0:
+                return self._reader._get(offs, np.uint64)
+            return self._reader._get(offs + 8, np.uint8, self._string_end(item) - offs - 8)
+        nptype = self._reader.gguf_scalar_to_np[info.item_type]
+        return self._reader._get(info.value_offset + 12 + item * np.dtype(nptype).itemsize, nptype)
+
+    def __iter__(self) -> Iterator[npt.NDArray[Any]]:
+        return (self[i] for i in range(len(self)))
+
+    def _string_end(self, item: int) -> int:
+        info = self._info
+        assert info.string_offsets is not None
+        if item + 1 < info.count:
+            return int(info.string_offsets[item + 1])
+        return info.offset + info.size
+
+    def contents(self) -> list[Any]:
+        info = self._info
+        if info.string_offsets is None:
+            assert info.item_type is not None
+            return self._reader._get(info.value_offset + 12, self._reader.gguf_scalar_to_np[info.item_type], info.count).tolist()
+        if info.count == 0:
+            return []
+        # decode all the strings from a single copy of the array
+        base = int(info.string_offsets[0])
+        raw = bytes(self._reader.data[base:info.offset + info.size])
+        starts = info.string_offsets - base
+        ends = np.append(starts[1:], len(raw))
+        return [raw[start + 8:end].decode('utf-8') for start, end in zip(starts.tolist(), ends.tolist())]
+
+
+# The key/value fields of a lazy reader, decoded on first access.
+class _LazyFields(MutableMapping):
+    def __init__(self, reader: GGUFReader):
+        self._reader = reader
+        self._fields: OrderedDict[str, ReaderField | _FieldInfo] = OrderedDict()
+
+    def __getitem__(self, key: str) -> ReaderField:
+        field = self._fields[key]
+        if isinstance(field, _FieldInfo):
+            field = self._fields[key] = self._reader._build_field(field, lazy = True)
+        return field
+
+    def __setitem__(self, key: str, field: ReaderField | _FieldInfo) -> None:
+        self._fields[key] = field
+
+    def __delitem__(self, key: str) -> None:
+        del self._fields[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
 
 class ReaderTensor(NamedTuple):
     name: str
@@ -61,6 +177,22 @@ class ReaderTensor(NamedTuple):
     data_offset: int
     data: npt.NDArray[Any]
     field: ReaderField
+    # of the file, the raw bytes of quantized and BF16 tensors are swapped when it's 'S'
+    byte_order: Literal['I'] | Literal['S'] = 'I'
+
+    # Decode the tensor to float32, in the usual numpy dimension order.
+    # With `rows`, only the selected rows (of shape[0] elements each) are decoded,
+    # the others are never read from the file. The result then has two dimensions.
+    def to_float(self, rows: slice | None = None) -> npt.NDArray[np.float32]:
+        block_size, type_size = GGML_QUANT_SIZES[self.tensor_type]
+        row_size = int(self.shape[0])
+        n_rows = self.n_elements // row_size
+        # quantized data is raw bytes, the rest has one item per element
+        row_items = row_size // block_size * type_size if self.data.dtype == np.uint8 else row_size
+        data = self.data.reshape((n_rows, row_items))
+        if rows is not None:
+            return dequantize(data[rows], self.tensor_type, self.byte_order)
+        return dequantize(data, self.tensor_type, self.byte_order).reshape(tuple(int(d) for d in reversed(self.shape)))
 
 
 class GGUFReader:
@@ -83,8 +215,11 @@ class GGUFReader:
         GGUFValueType.BOOL:    np.bool_,
     }
 
-    def __init__(self, path: os.PathLike[str] | str, mode: Literal['r'] | Literal['r+'] | Literal['c'] = 'r'):
+    # With lazy=True, opening only records where the fields and tensor infos are,
+    # they are decoded on first access, which makes opening big files (almost) instant.
+    def __init__(self, path: os.PathLike[str] | str, mode: Literal['r'] | Literal['r+'] | Literal['c'] = 'r', lazy: bool = False):
         self.data = np.memmap(path, mode = mode)
+        self.lazy = lazy
         offs = 0
         if self._get(offs, np.uint32, override_order = '<')[0] != GGUF_MAGIC:
             raise ValueError('GGUF magic invalid')
@@ -98,15 +233,18 @@ class GGUFReader:
         version = temp_version[0]
         if version not in READER_SUPPORTED_VERSIONS:
             raise ValueError(f'Sorry, file appears to be version {version} which we cannot handle')
-        self.fields: OrderedDict[str, ReaderField] = OrderedDict()
-        self.tensors: list[ReaderTensor] = []
+        file_little_endian = (sys.byteorder == 'little') == (self.byte_order == 'I')
+        self._u32 = struct.Struct('<I' if file_little_endian else '>I')
+        self._u64 = struct.Struct('<Q' if file_little_endian else '>Q')
+        self.fields: MutableMapping[str, ReaderField] = _LazyFields(self) if lazy else OrderedDict()
+        self._tensors: list[ReaderTensor | None] = []
         offs += self._push_field(ReaderField(offs, 'GGUF.version', [temp_version], [0], [GGUFValueType.UINT32]))
         temp_counts = self._get(offs, np.uint64, 2)
         offs += self._push_field(ReaderField(offs, 'GGUF.tensor_count', [temp_counts[:1]], [0], [GGUFValueType.UINT64]))
         offs += self._push_field(ReaderField(offs, 'GGUF.kv_count', [temp_counts[1:]], [0], [GGUFValueType.UINT64]))
         tensor_count, kv_count = temp_counts
         offs = self._build_fields(offs, kv_count)
-        offs, tensors_fields = self._build_tensors_fields(offs, tensor_count)
+        offs = self._scan_tensors(offs, tensor_count)
         new_align = self.fields.get('general.alignment')
         if new_align is not None:
             if new_align.types != [GGUFValueType.UINT32]:
@@ -115,7 +253,24 @@ class GGUFReader:
         padding = offs % self.alignment
         if padding != 0:
             offs += self.alignment - padding
-        self._build_tensors(offs, tensors_fields)
+        self._data_offset = offs
+        self._n_built_tensors = 0
+        if not lazy:
+            for idx in range(len(self._tensors)):
+                self.get_tensor(idx)
+
+    # Offset of the tensor data in the file, right after the padding following the tensor infos.
+    @property
+    def data_offset(self) -> int:
+        return self._data_offset
+
+    # All the tensors, in file order.
+    @property
+    def tensors(self) -> list[ReaderTensor]:
+        if self._n_built_tensors < len(self._tensors):
+            for idx in range(len(self._tensors)):
+                self.get_tensor(idx)
+        return self._tensors  # type: ignore[return-value]
 
     _DT = TypeVar('_DT', bound = npt.DTypeLike)
 
@@ -123,9 +278,34 @@ class GGUFReader:
     def get_field(self, key: str) -> Union[ReaderField, None]:
         return self.fields.get(key, None)
 
-    # Fetch a tensor from the list by index.
-    def get_tensor(self, idx: int) -> ReaderTensor:
-        return self.tensors[idx]
+    # Fetch a tensor by index or by name, only that tensor gets decoded.
+    def get_tensor(self, idx: int | str) -> ReaderTensor:
+        if isinstance(idx, str):
+            idx = self.tensor_index[idx]
+        tensor = self._tensors[idx]
+        if tensor is None:
+            tensor = self._tensors[idx] = self._build_tensor(self._get_tensor(self._tensor_offsets[idx]))
+            self._n_built_tensors += 1
+        return tensor
+
+    # Read rows `start` to `stop` of a tensor (of shape[0] elements each), in the same
+    # format as ReaderTensor.data, through a mapping of only the pages holding them.
+    # Use dequantize() to get floats from quantized rows.
+    def read_rows(self, name: str, start: int, stop: int) -> npt.NDArray[Any]:
+        tensor = self.get_tensor(name)
+        block_size, type_size = GGML_QUANT_SIZES[tensor.tensor_type]
+        row_size = int(tensor.shape[0])
+        n_rows = tensor.n_elements // row_size
+        if not 0 <= start <= stop <= n_rows:
+            raise ValueError(f'Invalid row range {start}:{stop} for tensor {name} with {n_rows} rows')
+        row_nbytes = row_size // block_size * type_size
+        row_items = row_nbytes // tensor.data.dtype.itemsize
+        if start == stop:
+            return tensor.data[:0].reshape((0, row_items))
+        return np.memmap(
+            self.data.filename, dtype = tensor.data.dtype, mode = 'r',
+            offset = tensor.data_offset + start * row_nbytes, shape = (stop - start, row_items),
+        )
 
     def _get(
         self, offset: int, dtype: npt.DTypeLike, count: int = 1, override_order: None | Literal['I'] | Literal['S'] | Literal['<'] = None,
@@ -139,16 +319,16 @@ class GGUFReader:
             .newbyteorder(override_order or self.byte_order)
         )
 
-    def _push_field(self, field: ReaderField, skip_sum: bool = False) -> int:
+    def _push_field(self, field: ReaderField | _FieldInfo, skip_sum: bool = False) -> int:
         if field.name in self.fields:
             # TODO: add option to generate error on duplicate keys
             # raise KeyError(f'Duplicate {field.name} already in list at offset {field.offset}')
 
             logger.warning(f'Duplicate key {field.name} at offset {field.offset}')
-            self.fields[field.name + '_{}'.format(field.offset)] = field
+            self.fields[field.name + '_{}'.format(field.offset)] = field  # type: ignore[assignment]
         else:
-            self.fields[field.name] = field
-        return 0 if skip_sum else sum(int(part.nbytes) for part in field.parts)
+            self.fields[field.name] = field  # type: ignore[assignment]
+        return 0 if skip_sum or isinstance(field, _FieldInfo) else sum(int(part.nbytes) for part in field.parts)
 
     def _get_str(self, offset: int) -> tuple[npt.NDArray[np.uint64], npt.NDArray[np.uint8]]:
         slen = self._get(offset, np.uint64)
@@ -210,83 +390,192 @@ class GGUFReader:
             [1, 3, 4, 5],
         )
 
+    # Find the end of a value without viewing it, struct is much faster than numpy for single values.
+    def _skip_value(self, offs: int, gtype: GGUFValueType) -> tuple[int, GGUFValueType | None, int, npt.NDArray[np.int64] | None]:
+        if gtype == GGUFValueType.STRING:
+            return offs + 8 + self._u64.unpack_from(self.data, offs)[0], None, 0, None
+        nptype = self.gguf_scalar_to_np.get(gtype)
+        if nptype is not None:
+            return offs + np.dtype(nptype).itemsize, None, 0, None
+        if gtype != GGUFValueType.ARRAY:
+            raise ValueError(f'Unknown/unhandled field type {gtype}')
+        item_type = GGUFValueType(self._u32.unpack_from(self.data, offs)[0])
+        count = self._u64.unpack_from(self.data, offs + 4)[0]
+        items_offs = offs + 12
+        if item_type == GGUFValueType.STRING:
+            unpack_from = self._u64.unpack_from
+            data = self.data
+            string_offsets = []
+            for _ in range(count):
+                string_offsets.append(items_offs)
+                items_offs += 8 + unpack_from(data, items_offs)[0]
+            return items_offs, item_type, count, np.array(string_offsets, dtype = np.int64)
+        nptype = self.gguf_scalar_to_np.get(item_type)
+        if nptype is not None:
+            return items_offs + count * np.dtype(nptype).itemsize, item_type, count, None
+        # nested arrays are rare, these are always decoded the slow way
+        size, _, _, _ = self._get_field_parts(offs, GGUFValueType.ARRAY)
+        return offs + size, GGUFValueType.ARRAY, count, None
+
+    def _build_field(self, info: _FieldInfo, lazy: bool) -> ReaderField:
+        kv_klen, kv_kdata = self._get_str(info.offset)
+        raw_kv_type = self._get(info.value_offset - 4, np.uint32)
+        parts: list[npt.NDArray[Any]] = [kv_klen, kv_kdata, raw_kv_type]
+        idxs_offs = len(parts)
+        if info.item_type is None or info.item_type == GGUFValueType.ARRAY:
+            _, field_parts, field_idxs, field_types = self._get_field_parts(info.value_offset, info.gtype)
+            return ReaderField(info.offset, info.name, parts + field_parts, [idx + idxs_offs for idx in field_idxs], field_types)
+        raw_itype = self._get(info.value_offset, np.uint32)
+        alen = self._get(info.value_offset + 4, np.uint64)
+        array_parts = _ArrayParts(self, parts + [raw_itype, alen], info)
+        if info.item_type == GGUFValueType.STRING:
+            data = range(idxs_offs + 3, idxs_offs + 3 + 2 * info.count, 2)
+        else:
+            data = range(idxs_offs + 2, idxs_offs + 2 + info.count)
+        types = [GGUFValueType.ARRAY, info.item_type] if info.count else [GGUFValueType.ARRAY]
+        if lazy:
+            return ReaderField(info.offset, info.name, array_parts, data, types)  # type: ignore[arg-type]
+        return ReaderField(info.offset, info.name, list(array_parts), list(data), types)
+
     def _build_fields(self, offs: int, count: int) -> int:
         for _ in range(count):
             orig_offs = offs
-            kv_klen, kv_kdata = self._get_str(offs)
-            offs += int(kv_klen.nbytes + kv_kdata.nbytes)
-            raw_kv_type = self._get(offs, np.uint32)
-            offs += int(raw_kv_type.nbytes)
-            parts: list[npt.NDArray[Any]] = [kv_klen, kv_kdata, raw_kv_type]
-            idxs_offs = len(parts)
-            field_size, field_parts, field_idxs, field_types = self._get_field_parts(offs, raw_kv_type[0])
-            parts += field_parts
-            self._push_field(ReaderField(
-                orig_offs,
-                str(bytes(kv_kdata), encoding = 'utf-8'),
-                parts,
-                [idx + idxs_offs for idx in field_idxs],
-                field_types,
-            ), skip_sum = True)
-            offs += field_size
+            klen = self._u64.unpack_from(self.data, offs)[0]
+            name = str(bytes(self.data[offs + 8:offs + 8 + klen]), encoding = 'utf-8')
+            offs += 8 + klen
+            gtype = GGUFValueType(self._u32.unpack_from(self.data, offs)[0])
+            offs += 4
+            end_offs, item_type, item_count, string_offsets = self._skip_value(offs, gtype)
+            info = _FieldInfo(orig_offs, name, offs, end_offs - orig_offs, gtype, item_type, item_count, string_offsets)
+            self._push_field(info if self.lazy else self._build_field(info, lazy = False), skip_sum = True)
+            offs = end_offs
         return offs
 
-    def _build_tensors_fields(self, offs: int, count: int) -> tuple[int, list[ReaderField]]:
-        tensor_fields = []
-        for _ in range(count):
-            field = self._get_tensor(offs)
-            offs += sum(int(part.nbytes) for part in field.parts)
-            tensor_fields.append(field)
-        return offs, tensor_fields
-
-    def _build_tensors(self, start_offs: int, fields: list[ReaderField]) -> None:
-        tensors = []
-        tensor_names = set() # keep track of name to prevent duplicated tensors
-        for field in fields:
-            _name_len, name_data, _n_dims, dims, raw_dtype, offset_tensor = field.parts
-            # check if there's any tensor having same name already in the list
-            tensor_name = str(bytes(name_data), encoding = 'utf-8')
-            if tensor_name in tensor_names:
+    def _scan_tensors(self, offs: int, count: int) -> int:
+        self._tensor_offsets: list[int] = []
+        # the index of each tensor by name
+        self.tensor_index: dict[str, int] = {}
+        for idx in range(count):
+            name_len = self._u64.unpack_from(self.data, offs)[0]
+            tensor_name = str(bytes(self.data[offs + 8:offs + 8 + name_len]), encoding = 'utf-8')
+            if tensor_name in self.tensor_index:
                 raise ValueError(f'Found duplicated tensor with name {tensor_name}')
-            tensor_names.add(tensor_name)
-            ggml_type = GGMLQuantizationType(raw_dtype[0])
-            n_elems = int(np.prod(dims))
-            block_size, type_size = GGML_QUANT_SIZES[ggml_type]
-            n_bytes = n_elems * type_size // block_size
-            data_offs = int(start_offs + offset_tensor[0])
-            item_type: npt.DTypeLike
-            if ggml_type == GGMLQuantizationType.F16:
-                item_count = n_elems
-                item_type = np.float16
-            elif ggml_type == GGMLQuantizationType.F32:
-                item_count = n_elems
-                item_type = np.float32
-            elif ggml_type == GGMLQuantizationType.F64:
-                item_count = n_elems
-                item_type = np.float64
-            elif ggml_type == GGMLQuantizationType.I8:
-                item_count = n_elems
-                item_type = np.int8
-            elif ggml_type == GGMLQuantizationType.I16:
-                item_count = n_elems
-                item_type = np.int16
-            elif ggml_type == GGMLQuantizationType.I32:
-                item_count = n_elems
-                item_type = np.int32
-            elif ggml_type == GGMLQuantizationType.I64:
-                item_count = n_elems
-                item_type = np.int64
-            else:
-                item_count = n_bytes
-                item_type = np.uint8
-            tensors.append(ReaderTensor(
-                name = tensor_name,
-                tensor_type = ggml_type,
-                shape = dims,
-                n_elements = n_elems,
-                n_bytes = n_bytes,
-                data_offset = data_offs,
-                data = self._get(data_offs, item_type, item_count),
-                field = field,
-            ))
-        self.tensors = tensors
+            self.tensor_index[tensor_name] = idx
+            self._tensor_offsets.append(offs)
+            offs += 8 + name_len
+            n_dims = self._u32.unpack_from(self.data, offs)[0]
+            # dims, type and offset
+            offs += 4 + 8 * n_dims + 4 + 8
+        self._tensors = [None] * count
+        return offs
+
+    def _build_tensor(self, field: ReaderField) -> ReaderTensor:
+        _name_len, name_data, _n_dims, dims, raw_dtype, offset_tensor = field.parts
+        ggml_type = GGMLQuantizationType(raw_dtype[0])
+        n_elems = int(np.prod(dims))
+        block_size, type_size = GGML_QUANT_SIZES[ggml_type]
+        n_bytes = n_elems * type_size // block_size
+        data_offs = int(self._data_offset + offset_tensor[0])
+        item_type: npt.DTypeLike
+        if ggml_type == GGMLQuantizationType.F16:
+            item_count = n_elems
+            item_type = np.float16
+        elif ggml_type == GGMLQuantizationType.F32:
+            item_count = n_elems
+            item_type = np.float32
+        elif ggml_type == GGMLQuantizationType.F64:
+            item_count = n_elems
+            item_type = np.float64
+        elif ggml_type == GGMLQuantizationType.I8:
+            item_count = n_elems
+            item_type = np.int8
+        elif ggml_type == GGMLQuantizationType.I16:
+            item_count = n_elems
+            item_type = np.int16
+        elif ggml_type == GGMLQuantizationType.I32:
+            item_count = n_elems
+            item_type = np.int32
+        elif ggml_type == GGMLQuantizationType.I64:
+            item_count = n_elems
+            item_type = np.int64
+        else:
+            item_count = n_bytes
+            item_type = np.uint8
+        return ReaderTensor(
+            name = str(bytes(name_data), encoding = 'utf-8'),
+            tensor_type = ggml_type,
+            shape = dims,
+            n_elements = n_elems,
+            n_bytes = n_bytes,
+            data_offset = data_offs,
+            data = self._get(data_offs, item_type, item_count),
+            field = field,
+            byte_order = self.byte_order,
+        )
+
+
+# names of the files of a split model, as written by GGUFWriter and llama.cpp's gguf-split
+_SPLIT_PATH_RE = re.compile(r'^(?P<prefix>.*)-(?P<no>\d{5})-of-(?P<count>\d{5})\.gguf$')
+
+
+# Opens all the files of a split model, from the path of any of them, as one model.
+# The metadata is the one of the first file, the tensors are those of all the files.
+# Also works with models which aren't split.
+class GGUFSplitReader:
+    def __init__(self, path: os.PathLike[str] | str, mode: Literal['r'] | Literal['r+'] | Literal['c'] = 'r', lazy: bool = False):
+        paths = [os.fspath(path)]
+        match = _SPLIT_PATH_RE.match(paths[0])
+        if match is not None:
+            count = int(match['count'])
+            paths = [f"{match['prefix']}-{no:05d}-of-{count:05d}.gguf" for no in range(1, count + 1)]
+        self.readers = [GGUFReader(path, mode, lazy = lazy) for path in paths]
+
+        if len(self.readers) > 1:
+            for no, (path, reader) in enumerate(zip(paths, self.readers)):
+                split_no, split_count = reader.get_field(Keys.Split.NO), reader.get_field(Keys.Split.COUNT)
+                if split_no is None or split_count is None:
+                    raise ValueError(f'Missing split metadata in {path}')
+                if split_no.contents() != no or split_count.contents() != len(self.readers):
+                    raise ValueError(f'{path} is file {split_no.contents()} of {split_count.contents()}, expected {no} of {len(self.readers)}')
+
+        self.fields = self.readers[0].fields
+        # index of the tensors of all the files, by name
+        self.tensor_index: dict[str, int] = {}
+        self._tensor_locations: list[tuple[GGUFReader, int]] = []
+        for reader in self.readers:
+            for name, idx in reader.tensor_index.items():
+                if name in self.tensor_index:
+                    raise ValueError(f'Found duplicated tensor with name {name}')
+                self.tensor_index[name] = len(self._tensor_locations)
+                self._tensor_locations.append((reader, idx))
+
+        tensors_count = self.readers[0].get_field(Keys.Split.TENSORS_COUNT)
+        if tensors_count is not None and tensors_count.contents() != len(self.tensor_index):
+            raise ValueError(f'Expected {tensors_count.contents()} tensors in total, found {len(self.tensor_index)}')
+
+    @property
+    def byte_order(self) -> Literal['I'] | Literal['S']:
+        return self.readers[0].byte_order
+
+    @property
+    def tensors(self) -> list[ReaderTensor]:
+        return [tensor for reader in self.readers for tensor in reader.tensors]
+
+    def get_field(self, key: str) -> Union[ReaderField, None]:
+        return self.readers[0].get_field(key)
+
+    def get_tensor(self, idx: int | str) -> ReaderTensor:
+        if isinstance(idx, str):
+            idx = self.tensor_index[idx]
+        reader, reader_idx = self._tensor_locations[idx]
+        return reader.get_tensor(reader_idx)
+
+    def read_rows(self, name: str, start: int, stop: int) -> npt.NDArray[Any]:
+        reader, _ = self._tensor_locations[self.tensor_index[name]]
+        return reader.read_rows(name, start, stop)
+
+    # Path of the file holding a tensor, its data_offset is relative to the start of that file.
+    def tensor_path(self, name: str) -> str:
+        reader, _ = self._tensor_locations[self.tensor_index[name]]
+        assert reader.data.filename is not None
+        return reader.data.filename
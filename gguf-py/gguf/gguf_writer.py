@@ -1,17 +1,25 @@
 from __future__ import annotations
 
+import hashlib
+import itertools
+import json
 import logging
 import os
 import shutil
 import struct
+import sys
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, auto
 from io import BufferedWriter
-from typing import IO, Any, Sequence, Mapping
+from typing import IO, Any, NamedTuple, Sequence, Mapping
 from string import ascii_letters, digits
 
 import numpy as np
 
+from .lazy import LazyBase
+from .profiling import Profiler, profile, profile_tensor
 from .constants import (
     GGML_QUANT_SIZES,
     GGUF_DEFAULT_ALIGNMENT,
@@ -36,10 +44,91 @@ class WriterState(Enum):
     TI_DATA = auto()
 
 
+class TensorInfo(NamedTuple):
+    # Offset of the tensor data, relative to the start of the data section.
+    offset: int
+
+    # Size of the tensor data, without the alignment padding.
+    nbytes: int
+
+    # Index of the file holding the tensor, when the model is split.
+    shard: int = 0
+
+
+# One of the output files. There is only one unless the model is split.
+class _Shard:
+    def __init__(self) -> None:
+        self.fout: BufferedWriter | None = None
+        self.ti_data = bytearray()
+        self.ti_data_count = 0
+        # size of the data section so far
+        self.offset_tensor = 0
+        self.data_offset = 0
+        self.tensors: list[np.ndarray[Any, Any]] = []
+        self.temp_file: tempfile.SpooledTemporaryFile[bytes] | None = None
+        # the names of the tensors added with add_tensor, in order, and whether they are in temp_file or in tensors
+        self.tensor_names: list[tuple[str, bool]] = []
+        # tensors can be written to different files from different threads
+        self.lock = threading.Lock()
+
+
+# Copies a range of bytes between files, in the kernel when the OS supports it: with copy_file_range,
+# which file systems with reflinks can even do without copying the blocks, or else with sendfile.
+# The output file must be flushed before, and its position is undefined after.
+def copy_file_data(fin: IO[bytes], fout: IO[bytes], src_offset: int, dst_offset: int, nbytes: int) -> None:
+    copy_file_range = getattr(os, "copy_file_range", None)
+    # only Linux can sendfile to a regular file
+    sendfile = getattr(os, "sendfile", None) if sys.platform == "linux" else None
+    while nbytes > 0:
+        n = 0
+        if copy_file_range is not None:
+            try:
+                n = copy_file_range(fin.fileno(), fout.fileno(), nbytes, src_offset, dst_offset)
+            except OSError:
+                # e.g. not supported between these file systems
+                copy_file_range = None
+                continue
+        elif sendfile is not None:
+            try:
+                os.lseek(fout.fileno(), dst_offset, os.SEEK_SET)
+                n = sendfile(fout.fileno(), fin.fileno(), src_offset, nbytes)
+            except OSError:
+                sendfile = None
+                continue
+        else:
+            fin.seek(src_offset)
+            chunk = fin.read(min(nbytes, 16 * 1024 * 1024))
+            fout.seek(dst_offset)
+            n = fout.write(chunk)
+        if n == 0:
+            raise EOFError(f"Expected {nbytes} more bytes at offset {src_offset} of {fin.name}")
+        src_offset += n
+        dst_offset += n
+        nbytes -= n
+
+
+# Parses a size in bytes like the --split-max-size option of the converters, e.g. "4G" or "500M".
+def split_str_to_n_bytes(split_str: str) -> int:
+    if split_str.endswith("K"):
+        n = int(split_str[:-1]) * 1000
+    elif split_str.endswith("M"):
+        n = int(split_str[:-1]) * 1000 * 1000
+    elif split_str.endswith("G"):
+        n = int(split_str[:-1]) * 1000 * 1000 * 1000
+    elif split_str.isnumeric():
+        n = int(split_str)
+    else:
+        raise ValueError(f"Invalid split size: {split_str}, must be a number, optionally followed by K, M, or G")
+
+    if n < 0:
+        raise ValueError(f"Invalid split size: {split_str}, must be positive")
+
+    return n
+
+
 class GGUFWriter:
-    fout: BufferedWriter
-    temp_file: tempfile.SpooledTemporaryFile[bytes] | None
-    tensors: list[np.ndarray[Any, Any]]
+    shards: list[_Shard]
+    tensor_infos: dict[str, TensorInfo]
     _simple_value_packing = {
         GGUFValueType.UINT8:   "B",
         GGUFValueType.INT8:    "b",
@@ -54,23 +143,37 @@ class GGUFWriter:
         GGUFValueType.BOOL:    "?",
     }
 
+    # With split_max_tensors or split_max_size (in bytes of tensor data), the model is split
+    # into files named like <path without .gguf>-00001-of-00003.gguf, like with llama.cpp's gguf-split.
+    # The first file has all the metadata, each file has the split.* keys.
+    # With journal, the tensors written by name are recorded with their offset and checksum in <path>.journal,
+    # and when the files of an interrupted run with the same layout are found, the tensors it completed are kept
+    # and skipped by write_tensor_data. The journal is removed once all the tensors are written.
     def __init__(
         self, path: os.PathLike[str] | str, arch: str, use_temp_file: bool = True,
-        endianess: GGUFEndian = GGUFEndian.LITTLE,
+        endianess: GGUFEndian = GGUFEndian.LITTLE, split_max_tensors: int = 0, split_max_size: int = 0,
+        journal: bool = False,
     ):
-        self.fout = open(path, "wb")
+        self.path = path
         self.arch = arch
         self.endianess = endianess
-        self.offset_tensor = 0
         self.data_alignment = GGUF_DEFAULT_ALIGNMENT
         self.kv_data = bytearray()
         self.kv_data_count = 0
-        self.ti_data = bytearray()
-        self.ti_data_count = 0
-        self.ti_names = set()
+        self.tensor_infos = {}
         self.use_temp_file = use_temp_file
-        self.temp_file = None
-        self.tensors = []
+        self.split_max_tensors = split_max_tensors
+        self.split_max_size = split_max_size
+        self.shards = [_Shard()]
+        self.journal = journal
+        self.journal_file: IO[str] | None = None
+        self.journal_lock = threading.Lock()
+        # names of the tensors already in the output files
+        self.written_tensors: set[str] = set()
+        self._resumed: dict[str, str] = {}
+        # the files are opened by write_header_to_file: the names of split files are only known once all the tensor
+        # infos are added, an interrupted run can only be resumed once its layout is known, and the header of
+        # an existing file can be built without touching it (see header_data)
         logger.info("gguf: This GGUF file is for {0} Endian only".format(
             "Big" if self.endianess == GGUFEndian.BIG else "Little",
         ))
@@ -78,31 +181,185 @@ class GGUFWriter:
 
         self.add_architecture()
 
+    @property
+    def split(self) -> bool:
+        return self.split_max_tensors > 0 or self.split_max_size > 0
+
+    # The first output file.
+    @property
+    def fout(self) -> BufferedWriter:
+        assert self.shards[0].fout is not None
+        return self.shards[0].fout
+
+    def shard_path(self, shard: int) -> str:
+        path = os.fspath(self.path)
+        if len(self.shards) == 1:
+            return path
+        prefix = path[:-len(".gguf")] if path.endswith(".gguf") else path
+        return f"{prefix}-{shard + 1:05d}-of-{len(self.shards):05d}.gguf"
+
+    @property
+    def journal_path(self) -> str:
+        return f"{os.fspath(self.path)}.journal"
+
+    # Everything which determines where the tensor data ends up in the files.
+    def _layout_checksum(self) -> str:
+        checksum = hashlib.sha256(self._pack("I", self.data_alignment))
+        checksum.update(self._pack("Q", self.kv_data_count))
+        checksum.update(self.kv_data)
+        for i, shard in enumerate(self.shards):
+            checksum.update(self._pack("Q", shard.ti_data_count))
+            checksum.update(self._split_kv_data(i)[0])
+            checksum.update(shard.ti_data)
+        return checksum.hexdigest()
+
+    # The tensors recorded by the journal of an interrupted run, with their checksums,
+    # or None when there is nothing to resume.
+    def _read_journal(self) -> dict[str, str] | None:
+        if not os.path.exists(self.journal_path):
+            return None
+        if not all(os.path.exists(self.shard_path(i)) for i in range(len(self.shards))):
+            return None
+        entries: dict[str, str] = {}
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line can be incomplete
+                    break
+                if i == 0:
+                    if entry.get("layout") != self._layout_checksum():
+                        logger.info(f"gguf: Ignoring {self.journal_path}, it is for a different layout")
+                        return None
+                    continue
+                entries[entry["name"]] = entry["sha256"]
+        return entries
+
+    def _file_checksum(self, path: str, offset: int, nbytes: int) -> str:
+        checksum = hashlib.sha256()
+        with open(path, "rb") as f:
+            f.seek(offset)
+            while nbytes > 0:
+                chunk = f.read(min(nbytes, 16 * 1024 * 1024))
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                nbytes -= len(chunk)
+        return checksum.hexdigest()
+
+    # Keep the tensors of the interrupted run whose data is intact, and start a new journal with them.
+    def _start_journal(self) -> None:
+        layout = {"layout": self._layout_checksum()}
+        entries: list[dict[str, Any]] = []
+        for name, sha256 in self._resumed.items():
+            info = self.tensor_infos.get(name)
+            if info is None:
+                continue
+            shard = self.shards[info.shard]
+            if self._file_checksum(self.shard_path(info.shard), shard.data_offset + info.offset, info.nbytes) != sha256:
+                continue
+            self.written_tensors.add(name)
+            entries.append({"name": name, "shard": info.shard, "offset": info.offset, "nbytes": info.nbytes, "sha256": sha256})
+        if self._resumed:
+            logger.info(f"gguf: Resuming, {len(self.written_tensors)} of {len(self.tensor_infos)} tensors already written")
+
+        self.journal_file = open(self.journal_path, "w", encoding="utf-8")
+        for entry in [layout, *entries]:
+            self.journal_file.write(json.dumps(entry) + "\n")
+        self.journal_file.flush()
+
+    def _journal_tensor(self, name: str, info: TensorInfo, sha256: str) -> None:
+        assert self.journal_file is not None
+        entry = {"name": name, "shard": info.shard, "offset": info.offset, "nbytes": info.nbytes, "sha256": sha256}
+        with self.journal_lock:
+            self.written_tensors.add(name)
+            self.journal_file.write(json.dumps(entry) + "\n")
+            self.journal_file.flush()
+
+    # The split.* keys of a file, and their count.
+    def _split_kv_data(self, shard: int) -> tuple[bytes, int]:
+        if len(self.shards) == 1:
+            return b"", 0
+        split_kv = [
+            (Keys.Split.NO, shard, GGUFValueType.UINT16),
+            (Keys.Split.COUNT, len(self.shards), GGUFValueType.UINT16),
+            (Keys.Split.TENSORS_COUNT, len(self.tensor_infos), GGUFValueType.INT32),
+        ]
+        if shard > 0 and self.data_alignment != GGUF_DEFAULT_ALIGNMENT:
+            # the other files don't have the rest of the metadata
+            split_kv.append((Keys.General.ALIGNMENT, self.data_alignment, GGUFValueType.UINT32))
+        kv_data = bytearray()
+        for key, val, vtype in split_kv:
+            kv_data += self._pack_val(key, GGUFValueType.STRING, add_vtype=False)
+            kv_data += self._pack_val(val, vtype)
+        return bytes(kv_data), len(split_kv)
+
     def write_header_to_file(self) -> None:
         if self.state is not WriterState.EMPTY:
             raise ValueError(f'Expected output file to be empty, got {self.state}')
 
-        self._write_packed("<I", GGUF_MAGIC, skip_pack_prefix = True)
-        self._write_packed("I", GGUF_VERSION)
-        self._write_packed("Q", self.ti_data_count)
-        self._write_packed("Q", self.kv_data_count)
+        if self.journal:
+            resumed = self._read_journal()
+            if resumed is not None:
+                # keep the data of the interrupted run, the rest of the files is written again as before
+                self._resumed = resumed
+        for i, shard in enumerate(self.shards):
+            shard.fout = open(self.shard_path(i), "r+b" if self._resumed else "wb")
+        if len(self.shards) > 1:
+            logger.info(f"gguf: Splitting the model into {len(self.shards)} files")
+
+        for i, shard in enumerate(self.shards):
+            assert shard.fout is not None
+            shard.fout.write(self._pack_header(i))
         self.flush()
         self.state = WriterState.HEADER
 
+    def _pack_header(self, shard: int) -> bytes:
+        return b"".join((
+            self._pack("<I", GGUF_MAGIC, skip_pack_prefix = True),
+            self._pack("I", GGUF_VERSION),
+            self._pack("Q", self.shards[shard].ti_data_count),
+            self._pack("Q", (self.kv_data_count if shard == 0 else 0) + self._split_kv_data(shard)[1]),
+        ))
+
+    # Everything write_header_to_file, write_kv_data_to_file and write_ti_data_to_file would write
+    # before the padding up to the tensor data, without writing anything, e.g. to rewrite only
+    # the metadata of an existing file when the tensor data can stay where it is.
+    def header_data(self) -> bytes:
+        if len(self.shards) > 1:
+            raise ValueError('The header of a split model is in multiple files')
+        return self._pack_header(0) + self.kv_data + self.shards[0].ti_data
+
     def write_kv_data_to_file(self) -> None:
         if self.state is not WriterState.HEADER:
             raise ValueError(f'Expected output file to contain the header, got {self.state}')
 
-        self.fout.write(self.kv_data)
+        for i, shard in enumerate(self.shards):
+            assert shard.fout is not None
+            if i == 0:
+                shard.fout.write(self.kv_data)
+            shard.fout.write(self._split_kv_data(i)[0])
         self.flush()
         self.state = WriterState.KV_DATA
 
+    # In streaming mode, the tensors added with add_tensor before are written here, at their offsets.
     def write_ti_data_to_file(self) -> None:
+        self._write_ti_data()
+        self._write_buffered_tensors()
+
+    def _write_ti_data(self) -> None:
         if self.state is not WriterState.KV_DATA:
             raise ValueError(f'Expected output file to contain KV data, got {self.state}')
 
-        self.fout.write(self.ti_data)
+        for shard in self.shards:
+            assert shard.fout is not None
+            shard.fout.write(shard.ti_data)
+            self.write_padding(shard.fout, shard.fout.tell())
+            shard.data_offset = shard.fout.tell()
         self.flush()
+        if self.journal:
+            self._start_journal()
         self.state = WriterState.TI_DATA
 
     def add_key(self, key: str) -> None:
@@ -166,31 +423,70 @@ class GGUFWriter:
         self.add_val(val, GGUFValueType.ARRAY)
 
     def add_val(self, val: Any, vtype: GGUFValueType | None = None, add_vtype: bool = True) -> None:
+        self._add_val_to(self.kv_data, val, vtype, add_vtype)
+        if add_vtype:
+            self.kv_data_count += 1
+
+    def _pack_val(self, val: Any, vtype: GGUFValueType | None = None, add_vtype: bool = True) -> bytes:
+        kv_data = bytearray()
+        self._add_val_to(kv_data, val, vtype, add_vtype)
+        return bytes(kv_data)
+
+    def _add_val_to(self, kv_data: bytearray, val: Any, vtype: GGUFValueType | None = None, add_vtype: bool = True) -> None:
         if vtype is None:
             vtype = GGUFValueType.get_type(val)
 
         if add_vtype:
-            self.kv_data += self._pack("I", vtype)
-            self.kv_data_count += 1
+            kv_data += self._pack("I", vtype)
 
         pack_fmt = self._simple_value_packing.get(vtype)
         if pack_fmt is not None:
-            self.kv_data += self._pack(pack_fmt, val, skip_pack_prefix = vtype == GGUFValueType.BOOL)
+            kv_data += self._pack(pack_fmt, val, skip_pack_prefix = vtype == GGUFValueType.BOOL)
         elif vtype == GGUFValueType.STRING:
             encoded_val = val.encode("utf-8") if isinstance(val, str) else val
-            self.kv_data += self._pack("Q", len(encoded_val))
-            self.kv_data += encoded_val
+            kv_data += self._pack("Q", len(encoded_val))
+            kv_data += encoded_val
         elif vtype == GGUFValueType.ARRAY and isinstance(val, Sequence) and val:
             ltype = GGUFValueType.get_type(val[0])
-            if not all(GGUFValueType.get_type(i) is ltype for i in val[1:]):
+            # the type only depends on the class of the item, so one item of each class is enough to check
+            if not all(GGUFValueType.get_type(i) is ltype for i in dict(zip(map(type, val), val)).values()):
                 raise ValueError("All items in a GGUF array should be of the same type")
-            self.kv_data += self._pack("I", ltype)
-            self.kv_data += self._pack("Q", len(val))
-            for item in val:
-                self.add_val(item, add_vtype=False)
+            kv_data += self._pack("I", ltype)
+            kv_data += self._pack("Q", len(val))
+            packed = self._pack_array_items(val, ltype)
+            if packed is not None:
+                kv_data += packed
+            else:
+                for item in val:
+                    self._add_val_to(kv_data, item, add_vtype=False)
         else:
             raise ValueError("Invalid GGUF metadata value type or value")
 
+    # Packs all the items of an array at once, which is much faster than an _add_val_to per item
+    # for the token lists of the vocabs. None when they have to be packed one by one, e.g. for nested arrays,
+    # or out of range values for which packing them one by one raises the error.
+    def _pack_array_items(self, val: Sequence[Any], ltype: GGUFValueType) -> bytes | None:
+        endian = '<' if self.endianess == GGUFEndian.LITTLE else '>'
+        if ltype == GGUFValueType.STRING:
+            encoded = [v.encode("utf-8") if isinstance(v, str) else v for v in val]
+            pack_len = struct.Struct(f"{endian}Q").pack
+            return b"".join(itertools.chain.from_iterable(zip(map(pack_len, map(len, encoded)), encoded)))
+
+        pack_fmt = self._simple_value_packing.get(ltype)
+        if pack_fmt is None:
+            return None
+        items = np.array(val)
+        if items.dtype.kind not in "biuf":
+            return None
+        with np.errstate(over="ignore", invalid="ignore"):
+            packed = items.astype(np.dtype(f"{endian}{pack_fmt}"))
+        if packed.dtype.kind == "f":
+            if (np.isinf(packed) & ~np.isinf(items)).any():
+                return None
+        elif not (packed == items).all():
+            return None
+        return packed.tobytes()
+
     @staticmethod
     def ggml_pad(x: int, n: int) -> int:
         return ((x + n - 1) // n) * n
@@ -202,13 +498,24 @@ class GGUFWriter:
         if self.state is not WriterState.EMPTY:
             raise ValueError(f'Expected output file to be empty, got {self.state}')
 
-        if name in self.ti_names:
+        if name in self.tensor_infos:
             raise ValueError(f'Duplicated tensor name {name}')
-        self.ti_names.add(name)
+
+        shard = self.shards[-1]
+        if shard.ti_data_count > 0 and (
+            (self.split_max_tensors > 0 and shard.ti_data_count >= self.split_max_tensors)
+            or (self.split_max_size > 0 and shard.offset_tensor + tensor_nbytes > self.split_max_size)
+        ):
+            # the previous file is complete, its buffered data no longer needs to stay in memory
+            if shard.temp_file is not None:
+                shard.temp_file.rollover()
+            shard = _Shard()
+            self.shards.append(shard)
+        self.tensor_infos[name] = TensorInfo(shard.offset_tensor, tensor_nbytes, len(self.shards) - 1)
 
         encoded_name = name.encode("utf-8")
-        self.ti_data += self._pack("Q", len(encoded_name))
-        self.ti_data += encoded_name
+        shard.ti_data += self._pack("Q", len(encoded_name))
+        shard.ti_data += encoded_name
         if raw_dtype is None:
             if tensor_dtype == np.float16:
                 dtype = GGMLQuantizationType.F16
@@ -234,94 +541,219 @@ class GGUFWriter:
                     raise ValueError(f"Quantized tensor row size ({tensor_shape[-1]}) is not a multiple of {dtype.name} type size ({type_size})")
                 tensor_shape = tuple(tensor_shape[:-1]) + (tensor_shape[-1] // type_size * block_size,)
         n_dims = len(tensor_shape)
-        self.ti_data += self._pack("I", n_dims)
+        shard.ti_data += self._pack("I", n_dims)
         for i in range(n_dims):
-            self.ti_data += self._pack("Q", tensor_shape[n_dims - 1 - i])
-        self.ti_data += self._pack("I", dtype)
-        self.ti_data += self._pack("Q", self.offset_tensor)
-        self.offset_tensor += GGUFWriter.ggml_pad(tensor_nbytes, self.data_alignment)
-        self.ti_data_count += 1
+            shard.ti_data += self._pack("Q", tensor_shape[n_dims - 1 - i])
+        shard.ti_data += self._pack("I", dtype)
+        shard.ti_data += self._pack("Q", shard.offset_tensor)
+        shard.offset_tensor += GGUFWriter.ggml_pad(tensor_nbytes, self.data_alignment)
+        shard.ti_data_count += 1
 
     def add_tensor(
         self, name: str, tensor: np.ndarray[Any, Any], raw_shape: Sequence[int] | None = None,
         raw_dtype: GGMLQuantizationType | None = None,
     ) -> None:
+        if self.state is WriterState.TI_DATA:
+            # streaming mode: the tensor info was declared up front, write the data at its final offset
+            self.write_tensor_data(tensor, name=name)
+            return
+
         if self.endianess == GGUFEndian.BIG:
             tensor.byteswap(inplace=True)
-        if self.use_temp_file and self.temp_file is None:
-            fp = tempfile.SpooledTemporaryFile(mode="w+b", max_size=256 * 1024 * 1024)
-            fp.seek(0)
-            self.temp_file = fp
 
         shape: Sequence[int] = raw_shape if raw_shape is not None else tensor.shape
         self.add_tensor_info(name, shape, tensor.dtype, tensor.nbytes, raw_dtype = raw_dtype)
 
-        if self.temp_file is None:
-            self.tensors.append(tensor)
+        shard = self.shards[self.tensor_infos[name].shard]
+        # lazy tensors hold no data yet, spooling them would only evaluate them early and write them twice
+        if self.use_temp_file and shard.temp_file is None and not isinstance(tensor, LazyBase):
+            fp = tempfile.SpooledTemporaryFile(mode="w+b", max_size=256 * 1024 * 1024)
+            fp.seek(0)
+            shard.temp_file = fp
+
+        shard.tensor_names.append((name, shard.temp_file is not None))
+        if shard.temp_file is None:
+            shard.tensors.append(tensor)
             return
 
-        tensor.tofile(self.temp_file)
-        self.write_padding(self.temp_file, tensor.nbytes)
+        tensor.tofile(shard.temp_file)
+        self.write_padding(shard.temp_file, tensor.nbytes)
+
+    # Writes the tensors buffered by add_tensor at the offsets of their tensor infos,
+    # for when the other tensors are then written by name.
+    def _write_buffered_tensors(self) -> None:
+        for shard in self.shards:
+            assert shard.fout is not None
+            tensors = iter(shard.tensors)
+            if shard.temp_file is not None:
+                shard.temp_file.seek(0)
+            for name, spooled in shard.tensor_names:
+                info = self.tensor_infos[name]
+                if spooled:
+                    assert shard.temp_file is not None
+                    data = shard.temp_file.read(self.ggml_pad(info.nbytes, self.data_alignment))[:info.nbytes]
+                else:
+                    tensor = next(tensors)
+                    if isinstance(tensor, LazyBase):
+                        tensor = type(tensor).to_eager(tensor)
+                    # already byte-swapped by add_tensor
+                    data = np.ascontiguousarray(tensor).tobytes()
+                if name in self.written_tensors:
+                    continue
+                with shard.lock, profile("write", info.nbytes, tensor=name):
+                    shard.fout.seek(shard.data_offset + info.offset)
+                    shard.fout.write(data)
+                    self.write_padding(shard.fout, info.nbytes)
+                    if self.journal_file is not None:
+                        shard.fout.flush()
+                if self.journal_file is not None:
+                    self._journal_tensor(name, info, hashlib.sha256(data).hexdigest())
+            shard.tensors.clear()
+            shard.tensor_names.clear()
+            if shard.temp_file is not None:
+                shard.temp_file.close()
+                shard.temp_file = None
 
     def write_padding(self, fp: IO[bytes], n: int, align: int | None = None) -> None:
         pad = GGUFWriter.ggml_pad(n, align if align is not None else self.data_alignment) - n
         if pad != 0:
             fp.write(bytes([0] * pad))
 
-    def write_tensor_data(self, tensor: np.ndarray[Any, Any]) -> None:
+    # With a name, the data is written at the offset declared in its tensor info, in any order,
+    # and this can be called from multiple threads. Otherwise the tensors are expected in order.
+    def write_tensor_data(self, tensor: np.ndarray[Any, Any], name: str | None = None) -> None:
         if self.state is not WriterState.TI_DATA:
             raise ValueError(f'Expected output file to contain tensor info, got {self.state}')
 
-        if self.endianess == GGUFEndian.BIG:
-            tensor.byteswap(inplace=True)
-        self.write_padding(self.fout, self.fout.tell())
-        tensor.tofile(self.fout)
-        self.write_padding(self.fout, tensor.nbytes)
+        if name is None:
+            if len(self.shards) > 1:
+                raise ValueError('The tensors of a split model must be written by name')
+            if isinstance(tensor, LazyBase):
+                tensor = type(tensor).to_eager(tensor)
+            if self.endianess == GGUFEndian.BIG:
+                tensor.byteswap(inplace=True)
+            with profile("write", tensor.nbytes):
+                self.write_padding(self.fout, self.fout.tell())
+                tensor.tofile(self.fout)
+                self.write_padding(self.fout, tensor.nbytes)
+            return
+
+        info = self.tensor_infos.get(name)
+        if info is None:
+            raise ValueError(f'Missing tensor info for {name!r}')
+        if tensor.nbytes != info.nbytes:
+            raise ValueError(f'Tensor {name!r} has {tensor.nbytes} bytes, but its tensor info declares {info.nbytes}')
+        if name in self.written_tensors:
+            # already written by an interrupted run, no need to evaluate it
+            return
+
+        with profile_tensor(name):
+            if isinstance(tensor, LazyBase):
+                tensor = type(tensor).to_eager(tensor)
+            if self.endianess == GGUFEndian.BIG:
+                tensor.byteswap(inplace=True)
+            shard = self.shards[info.shard]
+            assert shard.fout is not None
+            with shard.lock, profile("write", tensor.nbytes):
+                shard.fout.seek(shard.data_offset + info.offset)
+                tensor.tofile(shard.fout)
+                self.write_padding(shard.fout, tensor.nbytes)
+                if self.journal_file is not None:
+                    shard.fout.flush()
+        if self.journal_file is not None:
+            # only recorded once the data is out of the file buffer
+            self._journal_tensor(name, info, hashlib.sha256(np.ascontiguousarray(tensor).data).hexdigest())
+
+    # Copies the data of a tensor from another file, e.g. from an earlier conversion of the same model,
+    # without reading it into memory. Like write_tensor_data with a name, this can be called from multiple threads.
+    def copy_tensor_data(self, name: str, src_path: os.PathLike[str] | str, src_offset: int) -> None:
+        if self.state is not WriterState.TI_DATA:
+            raise ValueError(f'Expected output file to contain tensor info, got {self.state}')
+
+        info = self.tensor_infos.get(name)
+        if info is None:
+            raise ValueError(f'Missing tensor info for {name!r}')
+        if name in self.written_tensors:
+            return
+
+        shard = self.shards[info.shard]
+        assert shard.fout is not None
+        with shard.lock, open(src_path, "rb") as fin, profile("write", info.nbytes, tensor=name):
+            shard.fout.flush()
+            copy_file_data(fin, shard.fout, src_offset, shard.data_offset + info.offset, info.nbytes)
+            shard.fout.seek(shard.data_offset + info.offset + info.nbytes)
+            self.write_padding(shard.fout, info.nbytes)
+            if self.journal_file is not None:
+                shard.fout.flush()
+        if self.journal_file is not None:
+            self._journal_tensor(name, info, self._file_checksum(self.shard_path(info.shard), shard.data_offset + info.offset, info.nbytes))
 
     def write_tensors_to_file(self, *, progress: bool = False) -> None:
-        self.write_ti_data_to_file()
+        self._write_ti_data()
 
-        self.write_padding(self.fout, self.fout.tell())
+        bar = None
+        if progress:
+            from tqdm import tqdm
 
-        if self.temp_file is None:
-            self.tensors.reverse()  # to pop from the "beginning" in constant time
+            total_bytes = sum(t.nbytes for shard in self.shards for t in shard.tensors)
 
-            if progress:
-                from tqdm import tqdm
+            bar = tqdm(desc="Writing", total=total_bytes, unit="byte", unit_scale=True)
 
-                total_bytes = sum(t.nbytes for t in self.tensors)
+        if len(self.shards) == 1:
+            self._write_shard_tensors(self.shards[0], bar)
+            return
 
-                bar = tqdm(desc="Writing", total=total_bytes, unit="byte", unit_scale=True)
+        # each file is written by its own thread
+        with ThreadPoolExecutor(max_workers=min(len(self.shards), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(self._write_shard_tensors, shard, bar) for shard in self.shards]
+            for future in futures:
+                future.result()
+
+    def _write_shard_tensors(self, shard: _Shard, bar: Any = None) -> None:
+        assert shard.fout is not None
+        self.write_padding(shard.fout, shard.fout.tell())
+
+        if shard.temp_file is None:
+            shard.tensors.reverse()  # to pop from the "beginning" in constant time
+            # the tensors of the shard were added in the order of their tensor info
+            names: list[str | None] = [None] * len(shard.tensors)
+            if Profiler.current is not None:
+                infos = [name for name, info in self.tensor_infos.items() if self.shards[info.shard] is shard]
+                if len(infos) == len(names):
+                    names = infos[::-1]
 
-                while True:
-                    try:
-                        tensor = self.tensors.pop()
-                    except IndexError:
-                        break
-                    tensor.tofile(self.fout)
-                    bar.update(tensor.nbytes)
-                    self.write_padding(self.fout, tensor.nbytes)
-                return
             while True:
                 try:
-                    tensor = self.tensors.pop()
+                    tensor = shard.tensors.pop()
                 except IndexError:
                     break
-                tensor.tofile(self.fout)
-                self.write_padding(self.fout, tensor.nbytes)
+                with profile("write", tensor.nbytes, tensor=names.pop()):
+                    tensor.tofile(shard.fout)
+                if bar is not None:
+                    bar.update(tensor.nbytes)
+                self.write_padding(shard.fout, tensor.nbytes)
             return
 
-        self.temp_file.seek(0)
+        shard.temp_file.seek(0)
 
-        shutil.copyfileobj(self.temp_file, self.fout)
-        self.flush()
-        self.temp_file.close()
+        shutil.copyfileobj(shard.temp_file, shard.fout)
+        shard.fout.flush()
+        shard.temp_file.close()
 
     def flush(self) -> None:
-        self.fout.flush()
+        for shard in self.shards:
+            if shard.fout is not None:
+                shard.fout.flush()
 
     def close(self) -> None:
-        self.fout.close()
+        for shard in self.shards:
+            if shard.fout is not None:
+                shard.fout.close()
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+            if len(self.written_tensors) == len(self.tensor_infos):
+                os.remove(self.journal_path)
 
     def add_architecture(self) -> None:
         self.add_string(Keys.General.ARCHITECTURE, self.arch)
@@ -1,14 +1,19 @@
 from __future__ import annotations
 from abc import ABC, ABCMeta, abstractmethod
 
+import contextlib
 import logging
-from typing import Any, Callable
+import threading
+import weakref
+from typing import Any, Callable, Iterator
 from collections import deque
 
 import numpy as np
 from numpy._typing import _Shape
 from numpy.typing import DTypeLike
 
+from .profiling import profile
+
 
 logger = logging.getLogger(__name__)
 
@@ -70,20 +75,86 @@ class LazyMeta(ABCMeta):
         return super().__new__(cls, name, bases, namespace, **kwargs)
 
 
+# Queue of the lazy tensors of a graph, with a lock so that a graph is only evaluated by one thread at a time.
+# Different graphs can still be evaluated concurrently.
+class LazyQueue(deque):
+    def __init__(self, *args: Any):
+        super().__init__(*args)
+        self.lock = threading.RLock()
+
+
+# Memory budget of the evaluation of lazy tensors, shared by all the threads.
+# Before evaluating a graph, its size is reserved, and a thread waits while the graphs evaluated by the other threads
+# would go over max_bytes (0 means no limit). A graph bigger than the budget is still evaluated, but alone.
+# The memory of the evaluated tensors is tracked until they are freed, to report the actual high-water mark.
+class MemoryBudget:
+    def __init__(self, max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.reserved = 0
+        self.in_use = 0
+        self.peak = 0
+        # the condition's RLock is needed, tensors can be freed (and untracked) while it's held
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        # per thread high-water mark of the memory in use, while the thread evaluates something
+        self._thread_peaks: dict[int, int] = {}
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes: int) -> Iterator[None]:
+        depth = getattr(self._local, "depth", 0)
+        with self._cond:
+            # nested evaluations of the same thread are part of the outer reservation
+            while depth == 0 and self.max_bytes > 0 and self.reserved > 0 and self.reserved + nbytes > self.max_bytes:
+                self._cond.wait()
+            self.reserved += nbytes
+            if depth == 0:
+                self._thread_peaks[threading.get_ident()] = self.in_use
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            with self._cond:
+                self.reserved -= nbytes
+                self._cond.notify_all()
+
+    def track(self, data: Any, nbytes: int) -> None:
+        if nbytes == 0:
+            return
+        with self._cond:
+            self.in_use += nbytes
+            self.peak = max(self.peak, self.in_use)
+            for ident, peak in self._thread_peaks.items():
+                self._thread_peaks[ident] = max(peak, self.in_use)
+        weakref.finalize(data, self._untrack, nbytes)
+
+    def _untrack(self, nbytes: int) -> None:
+        with self._cond:
+            self.in_use -= nbytes
+
+    # High-water mark of the memory used by all the threads during the evaluations of the current thread
+    # since the last call, or None when it has evaluated nothing.
+    def thread_peak(self) -> int | None:
+        with self._cond:
+            return self._thread_peaks.pop(threading.get_ident(), None)
+
+
 # Tree of lazy tensors
 class LazyBase(ABC, metaclass=LazyMeta):
     _tensor_type: type
     _meta: Any
     _data: Any | None
-    _lazy: deque[LazyBase]  # shared within a graph, to avoid deep recursion when making eager
+    _lazy: LazyQueue  # shared within a graph, to avoid deep recursion when making eager
     _args: tuple
     _func: Callable[[tuple], Any] | None
+    # shared by all the lazy tensor types
+    memory_budget: MemoryBudget | None = None
 
-    def __init__(self, *, meta: Any, data: Any | None = None, lazy: deque[LazyBase] | None = None, args: tuple = (), func: Callable[[tuple], Any] | None = None):
+    def __init__(self, *, meta: Any, data: Any | None = None, lazy: LazyQueue | None = None, args: tuple = (), func: Callable[[tuple], Any] | None = None):
         super().__init__()
         self._meta = meta
         self._data = data
-        self._lazy = lazy if lazy is not None else deque()
+        self._lazy = lazy if lazy is not None else LazyQueue()
         self._args = args
         self._func = func
         assert self._func is not None or self._data is not None
@@ -171,27 +242,49 @@ class LazyBase(ABC, metaclass=LazyMeta):
                 assert _t._data is not None
                 return _t._data
 
-            while _t._data is None:
-                lt = _t._lazy.popleft()
-                if lt._data is not None:
-                    # Lazy tensor did not belong in the lazy queue.
-                    # Weirdly only happens with Bloom models...
-                    # likely because tensors aren't unique in the queue.
-                    # The final output is still the same as in eager mode,
-                    # so it's safe to ignore this.
-                    continue
-                assert lt._func is not None
-                lt._args = cls._recurse_apply(lt._args, already_eager_to_eager)
-                lt._data = lt._func(lt._args)
-                # sanity check
-                assert lt._data.dtype == lt._meta.dtype
-                assert lt._data.shape == lt._meta.shape
+            lazy = _t._lazy
+            budget = LazyBase.memory_budget
+            with lazy.lock:
+                if _t._data is not None:
+                    return _t._data
+                reserve = contextlib.nullcontext()
+                if budget is not None:
+                    # everything which is not evaluated yet in the graph, which is more than what's needed at once.
+                    # Other threads can add to the graph meanwhile (without the lock), so it's summed from
+                    # a copy, which tuple() makes without releasing the GIL.
+                    reserve = budget.reserve(sum(lt._meta.nbytes for lt in tuple(lazy) if lt._data is None))
+                with reserve, profile("transform", _t._meta.nbytes):
+                    while _t._data is None:
+                        lt = lazy.popleft()
+                        if lt._data is not None:
+                            # Lazy tensor did not belong in the lazy queue.
+                            # Weirdly only happens with Bloom models...
+                            # likely because tensors aren't unique in the queue.
+                            # The final output is still the same as in eager mode,
+                            # so it's safe to ignore this.
+                            continue
+                        assert lt._func is not None
+                        lt._args = cls._recurse_apply(lt._args, already_eager_to_eager)
+                        lt._data = lt._func(lt._args)
+                        # sanity check
+                        assert lt._data.dtype == lt._meta.dtype
+                        assert lt._data.shape == lt._meta.shape
+                        if budget is not None:
+                            budget.track(lt._data, type(lt).data_nbytes(lt._data))
+                        # the args are no longer needed, the intermediate results which were only used here can be freed
+                        lt._args = ()
+                        lt._func = None
 
             return _t._data
 
         # recurse into lists and/or tuples, keeping their structure
         return cls._recurse_apply(t, simple_to_eager)
 
+    # Memory allocated for an evaluated tensor, views of other tensors don't count.
+    @classmethod
+    def data_nbytes(cls, t: Any) -> int:
+        return 0 if getattr(t, "base", None) is not None else t.nbytes
+
     @classmethod
     def eager_to_meta(cls, t: Any) -> Any:
         return cls.meta_with_dtype_and_shape(t.dtype, t.shape)
@@ -0,0 +1,168 @@
+#
+# Timing of the stages of a conversion, per tensor, for the --profile option of the converters.
+# The stages are timed by the code doing them (e.g. the quantization in quants.py), but only when a Profiler is active,
+# otherwise profile() and profile_tensor() do nothing.
+#
+from __future__ import annotations
+
+import contextlib
+import json
+import mmap
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Iterable, Iterator, NamedTuple
+
+import numpy as np
+
+# in the order of a conversion
+PROFILE_STAGES = ("load", "transform", "quantize", "write")
+
+
+class ProfileEvent(NamedTuple):
+    stage: str
+    tensor: str | None
+    # time.perf_counter(), which is comparable between the processes of a conversion on Linux
+    start: float
+    duration: float
+    # duration, without the nested stages
+    self_time: float
+    nbytes: int
+    pid: int
+    tid: int
+
+
+class Profiler:
+    # the active profiler, if any
+    current: Profiler | None = None
+
+    def __init__(self):
+        self.events: list[ProfileEvent] = []
+        self.start = time.perf_counter()
+        self.end: float | None = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._previous: Profiler | None = None
+
+    def __enter__(self) -> Profiler:
+        self._previous = Profiler.current
+        Profiler.current = self
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        Profiler.current = self._previous
+        self.end = time.perf_counter()
+
+    def _state(self) -> Any:
+        local = self._local
+        # a forked process starts with a copy of the state of the forking thread, which isn't its own
+        if getattr(local, "pid", None) != os.getpid():
+            local.pid = os.getpid()
+            # the stage stack holds the time spent in the nested stages of each entry
+            local.stack = []
+            local.tensor = None
+        return local
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, nbytes: int = 0, tensor: str | None = None) -> Iterator[None]:
+        state = self._state()
+        state.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            nested = state.stack.pop()
+            if state.stack:
+                state.stack[-1] += duration
+            event = ProfileEvent(stage, tensor if tensor is not None else state.tensor, start, duration,
+                                 duration - nested, nbytes, os.getpid(), threading.get_ident())
+            with self._lock:
+                self.events.append(event)
+
+    # The stages of the current thread are attributed to this tensor.
+    @contextlib.contextmanager
+    def tensor(self, name: str) -> Iterator[None]:
+        state = self._state()
+        previous = state.tensor
+        state.tensor = name
+        try:
+            yield
+        finally:
+            state.tensor = previous
+
+    # For the events of another process, e.g. of a worker process which returned them with its result.
+    def add_events(self, events: Iterable[ProfileEvent], tensor: str | None = None) -> None:
+        with self._lock:
+            self.events.extend(e if tensor is None or e.tensor is not None else e._replace(tensor=tensor) for e in events)
+
+    def summary(self, n_tensors: int = 10) -> str:
+        wall_time = (self.end if self.end is not None else time.perf_counter()) - self.start
+        times: dict[str, float] = defaultdict(float)
+        nbytes: dict[str, int] = defaultdict(int)
+        counts: dict[str, int] = defaultdict(int)
+        tensor_times: dict[str, dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        for e in self.events:
+            times[e.stage] += e.self_time
+            nbytes[e.stage] += e.nbytes
+            counts[e.stage] += 1
+            if e.tensor is not None:
+                tensor_times[e.tensor][e.stage] += e.self_time
+
+        stages = [s for s in PROFILE_STAGES if s in times] + sorted(s for s in times if s not in PROFILE_STAGES)
+        total = sum(times.values())
+        lines = [
+            f"Wall time: {wall_time:.2f}s, time in the stages: {total:.2f}s (summed over threads and processes)",
+            "",
+            f"{'stage':<10} | {'calls':>7} | {'seconds':>9} | {'%':>5} | {'MiB':>10} | {'MiB/s':>8}",
+        ]
+        for s in stages:
+            mib = nbytes[s] / 1024**2
+            rate = f"{mib / times[s]:8.1f}" if nbytes[s] and times[s] > 0 else f"{'-':>8}"
+            lines.append(f"{s:<10} | {counts[s]:7} | {times[s]:9.3f} | {100 * times[s] / (total or 1):5.1f} | {mib:10.1f} | {rate}")
+
+        slowest = sorted(tensor_times.items(), key=lambda item: -sum(item[1].values()))[:n_tensors]
+        if slowest:
+            width = max(len("tensor"), *(len(name) for name, _ in slowest))
+            lines += ["", f"Slowest {len(slowest)} tensors:", f"{'tensor':<{width}} | " + " | ".join(f"{s:>9}" for s in stages)]
+            for name, per_stage in slowest:
+                lines.append(f"{name:<{width}} | " + " | ".join(f"{per_stage.get(s, 0.0):9.3f}" for s in stages))
+        return "\n".join(lines)
+
+    # ref: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    def write_chrome_trace(self, path: os.PathLike[str] | str) -> None:
+        events: list[dict[str, Any]] = [{
+            "name": e.tensor if e.tensor is not None else e.stage,
+            "cat": e.stage,
+            "ph": "X",
+            "ts": (e.start - self.start) * 1e6,
+            "dur": e.duration * 1e6,
+            "pid": e.pid,
+            "tid": e.tid,
+            "args": {"stage": e.stage, "tensor": e.tensor, "bytes": e.nbytes, "self_time": e.self_time},
+        } for e in self.events]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def profile(stage: str, nbytes: int = 0, tensor: str | None = None) -> contextlib.AbstractContextManager[None]:
+    profiler = Profiler.current
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.stage(stage, nbytes, tensor)
+
+
+def profile_tensor(name: str) -> contextlib.AbstractContextManager[None]:
+    profiler = Profiler.current
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.tensor(name)
+
+
+# Reads one byte per page of a memory-mapped array while profiling, so that reading it from the disk
+# is timed in the current stage, and not in whichever stage happens to use the data first.
+def prefault(data: np.ndarray) -> None:
+    if Profiler.current is None or data.size == 0 or not data.flags.c_contiguous:
+        return
+    data.reshape(-1).view(np.uint8)[::mmap.PAGESIZE].max()
@@ -1,10 +1,15 @@
 from __future__ import annotations
-from typing import Callable
+from typing import Callable, Literal
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from numpy.typing import DTypeLike
 
 from .constants import GGML_QUANT_SIZES, GGMLQuantizationType
 from .lazy import LazyNumpyTensor
+from .profiling import profile
 
 import numpy as np
 
@@ -21,6 +26,21 @@ def __compute_fp32_to_bf16(n: np.ndarray) -> np.ndarray:
     return n.astype(np.int16)
 
 
+# same as __compute_fp32_to_bf16 on the F32 values of BF16 data, without converting it to F32;
+# BF16 already has no bits to round off, but its NaNs and subnormals are handled the same way
+def __compute_bf16_to_bf16(n: np.ndarray) -> np.ndarray:
+    n = n.view(np.int16)
+    # force nan to quiet
+    n = np.where((n & 0x7fff) > 0x7f80, n | 64, n)
+    # flush subnormals to zero
+    return np.where((n & 0x7f80) == 0, n & -0x8000, n).astype(np.int16, copy=False)
+
+
+# BF16 is the upper half of F32
+def __bf16_to_fp32(n: np.ndarray) -> np.ndarray:
+    return (n.view(np.uint16).astype(np.uint32) << 16).view(np.float32)
+
+
 # This is faster than np.vectorize and np.apply_along_axis because it works on more than one row at a time
 def __apply_over_grouped_rows(func: Callable[[np.ndarray], np.ndarray], arr: np.ndarray, otype: DTypeLike, oshape: tuple[int, ...]) -> np.ndarray:
     rows = arr.reshape((-1, arr.shape[-1]))
@@ -29,23 +49,33 @@ def __apply_over_grouped_rows(func: Callable[[np.ndarray], np.ndarray], arr: np.
         osize *= dim
     out = np.empty(shape=osize, dtype=otype)
     # compute over groups of 16 rows (arbitrary, but seems good for performance)
-    n_groups = rows.shape[0] // 16
+    n_groups = max(1, rows.shape[0] // 16)
     np.concatenate([func(group).ravel() for group in np.array_split(rows, n_groups)], axis=0, out=out)
     return out.reshape(oshape)
 
 
-def __quantize_bf16_array(n: np.ndarray) -> np.ndarray:
-    return __apply_over_grouped_rows(__compute_fp32_to_bf16, arr=n, otype=np.int16, oshape=n.shape)
+def __check_src_qtype(src_qtype: GGMLQuantizationType | None) -> None:
+    if src_qtype not in (None, GGMLQuantizationType.BF16):
+        raise NotImplementedError(f"Quantization from {src_qtype.name} is not implemented")
+
+
+def __quantize_bf16_array(n: np.ndarray, src_qtype: GGMLQuantizationType | None = None) -> np.ndarray:
+    func = __compute_bf16_to_bf16 if src_qtype == GGMLQuantizationType.BF16 else __compute_fp32_to_bf16
+    with profile("quantize", n.nbytes):
+        return __apply_over_grouped_rows(func, arr=n, otype=np.int16, oshape=n.shape)
 
 
 __quantize_bf16_lazy = LazyNumpyTensor._wrap_fn(__quantize_bf16_array, meta_noop=np.int16)
 
 
-def quantize_bf16(n: np.ndarray):
+# With src_qtype=BF16, `n` holds the raw bits of BF16 values (as int16 or uint16, there is no NumPy type for BF16).
+# The result is the same as for the F32 values, but the data is never converted to F32.
+def quantize_bf16(n: np.ndarray, src_qtype: GGMLQuantizationType | None = None):
+    __check_src_qtype(src_qtype)
     if type(n) is LazyNumpyTensor:
-        return __quantize_bf16_lazy(n)
+        return __quantize_bf16_lazy(n, src_qtype=src_qtype)
     else:
-        return __quantize_bf16_array(n)
+        return __quantize_bf16_array(n, src_qtype=src_qtype)
 
 
 __q8_block_size, __q8_type_size = GGML_QUANT_SIZES[GGMLQuantizationType.Q8_0]
@@ -64,46 +94,355 @@ def np_roundf(n: np.ndarray) -> np.ndarray:
     return np.sign(n) * b
 
 
-def __quantize_q8_0_shape_change(s: tuple[int, ...]) -> tuple[int, ...]:
-    return (*s[:-1], s[-1] // __q8_block_size * __q8_type_size)
+# same as np_roundf, but without temporaries;
+# `out` and `scratch` must have the same shape as `n`, and must not overlap with it
+def __roundf_into(n: np.ndarray, out: np.ndarray, scratch: np.ndarray) -> np.ndarray:
+    np.abs(n, out=out)
+    np.floor(out, out=scratch)
+    np.subtract(out, scratch, out=out)
+    np.multiply(out, 2, out=out)
+    np.floor(out, out=out)
+    np.add(out, scratch, out=out)
+    return np.copysign(out, n, out=out)
 
 
-# Implementation of Q8_0 with bit-exact same results as reference implementation in ggml-quants.c
-def __quantize_q8_0_rows(n: np.ndarray) -> np.ndarray:
-    shape = n.shape
-    assert shape[-1] % __q8_block_size == 0
+def __quantize_shape_change(qtype: GGMLQuantizationType) -> Callable[[tuple[int, ...]], tuple[int, ...]]:
+    block_size, type_size = GGML_QUANT_SIZES[qtype]
 
-    n_blocks = n.size // __q8_block_size
+    def shape_change(s: tuple[int, ...]) -> tuple[int, ...]:
+        return (*s[:-1], s[-1] // block_size * type_size)
+    return shape_change
 
-    blocks = n.reshape((n_blocks, __q8_block_size)).astype(np.float32, copy=False)
 
-    d = abs(blocks).max(axis=1, keepdims=True) / 127
+# layout of the blocks, same as the structs in ggml-common.h
+__block_dtypes: dict[GGMLQuantizationType, np.dtype] = {
+    GGMLQuantizationType.Q4_0: np.dtype([("d", np.float16), ("qs", np.uint8, (16,))]),
+    GGMLQuantizationType.Q4_1: np.dtype([("d", np.float16), ("m", np.float16), ("qs", np.uint8, (16,))]),
+    GGMLQuantizationType.Q5_0: np.dtype([("d", np.float16), ("qh", np.uint8, (4,)), ("qs", np.uint8, (16,))]),
+    GGMLQuantizationType.Q5_1: np.dtype([("d", np.float16), ("m", np.float16), ("qh", np.uint8, (4,)), ("qs", np.uint8, (16,))]),
+    GGMLQuantizationType.Q8_0: np.dtype([("d", np.float16), ("qs", np.int8, (__q8_block_size,))]),
+}
+
+assert all(dt.itemsize == GGML_QUANT_SIZES[qt][1] for qt, dt in __block_dtypes.items())
+
+
+# value of the first element with the largest magnitude in each block, like the loops in ggml-quants.c
+def __signed_absmax(blocks: np.ndarray) -> np.ndarray:
+    a = abs(blocks)
+    imax = a.argmax(axis=1)[:, None]
+    amax = np.take_along_axis(a, imax, axis=1)
+    # a block of zeros keeps the initial max of +0.0
+    return np.where(amax == 0, np.float32(0), np.take_along_axis(blocks, imax, axis=1))
+
+
+# first occurrences of the min and max of each block, like the loops in ggml-quants.c
+def __min_max(blocks: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    min = np.take_along_axis(blocks, blocks.argmin(axis=1)[:, None], axis=1)
+    max = np.take_along_axis(blocks, blocks.argmax(axis=1)[:, None], axis=1)
+    return min, max
+
+
+def __inverse(d: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore"):
+        return np.where(d == 0, 0, 1 / d).astype(np.float32, copy=False)
+
+
+# the low nibbles of the first and second half of each block share bytes
+def __pack_nibbles(qi: np.ndarray) -> np.ndarray:
+    half = qi.shape[1] // 2
+    return (qi[:, :half] & 0x0F) | ((qi[:, half:] & 0x0F) << 4)
+
+
+# the 5th bit of each value of a block, as a little-endian uint32
+def __pack_high_bits(qi: np.ndarray) -> np.ndarray:
+    return np.packbits((qi >> 4) & 1, axis=1, bitorder="little")
+
+
+# Implementations with bit-exact same results as the reference implementations in ggml-quants.c.
+# These all quantize a chunk of blocks of shape (n_blocks, block_size) into the given array of blocks.
+
+def __quantize_q8_0_blocks(blocks: np.ndarray, out_blocks: np.ndarray) -> None:
+    scratch = np.empty_like(blocks)
+    scaled = np.empty_like(blocks)
+    rounded = np.empty_like(blocks)
+
+    d = np.abs(blocks, out=scratch).max(axis=1, keepdims=True)
+    np.divide(d, 127, out=d)
     with np.errstate(divide="ignore"):
         id = np.where(d == 0, 0, 1 / d)
-    qs = np_roundf(blocks * id)
+    np.multiply(blocks, id, out=scaled)
 
-    # (n_blocks, 2)
-    d = d.astype(np.float16).view(np.uint8)
-    # (n_blocks, block_size)
-    qs = qs.astype(np.int8).view(np.uint8)
+    out_blocks["d"] = d.reshape(-1)
+    out_blocks["qs"] = __roundf_into(scaled, out=rounded, scratch=scratch)
 
-    assert d.shape[1] + qs.shape[1] == __q8_type_size
 
-    return np.concatenate([d, qs], axis=1).reshape(__quantize_q8_0_shape_change(shape))
+def __quantize_q4_0_blocks(blocks: np.ndarray, out_blocks: np.ndarray) -> None:
+    d = __signed_absmax(blocks) / -8
+    q = blocks * __inverse(d)
+    q += np.float32(8.5)
+    qi = np.minimum(q.astype(np.int8), 15).astype(np.uint8)
 
+    out_blocks["d"] = d.reshape(-1)
+    out_blocks["qs"] = __pack_nibbles(qi)
 
-def __quantize_q8_0_array(n: np.ndarray) -> np.ndarray:
-    return __apply_over_grouped_rows(__quantize_q8_0_rows, arr=n, otype=np.uint8, oshape=__quantize_q8_0_shape_change(n.shape))
 
+def __quantize_q4_1_blocks(blocks: np.ndarray, out_blocks: np.ndarray) -> None:
+    min, max = __min_max(blocks)
+    d = (max - min) / np.float32((1 << 4) - 1)
+    q = blocks - min
+    q *= __inverse(d)
+    q += np.float32(0.5)
+    qi = np.minimum(q.astype(np.int8), 15).astype(np.uint8)
+
+    out_blocks["d"] = d.reshape(-1)
+    out_blocks["m"] = min.reshape(-1)
+    out_blocks["qs"] = __pack_nibbles(qi)
+
+
+def __quantize_q5_0_blocks(blocks: np.ndarray, out_blocks: np.ndarray) -> None:
+    d = __signed_absmax(blocks) / -16
+    q = blocks * __inverse(d)
+    q += np.float32(16.5)
+    qi = np.minimum(q.astype(np.int8), 31).astype(np.uint8)
+
+    out_blocks["d"] = d.reshape(-1)
+    out_blocks["qh"] = __pack_high_bits(qi)
+    out_blocks["qs"] = __pack_nibbles(qi)
+
+
+def __quantize_q5_1_blocks(blocks: np.ndarray, out_blocks: np.ndarray) -> None:
+    min, max = __min_max(blocks)
+    d = (max - min) / np.float32((1 << 5) - 1)
+    q = blocks - min
+    q *= __inverse(d)
+    q += np.float32(0.5)
+    qi = q.astype(np.uint8)
+
+    out_blocks["d"] = d.reshape(-1)
+    out_blocks["m"] = min.reshape(-1)
+    out_blocks["qh"] = __pack_high_bits(qi)
+    out_blocks["qs"] = __pack_nibbles(qi)
+
+
+__quantize_blocks_fns: dict[GGMLQuantizationType, Callable[[np.ndarray, np.ndarray], None]] = {
+    GGMLQuantizationType.Q4_0: __quantize_q4_0_blocks,
+    GGMLQuantizationType.Q4_1: __quantize_q4_1_blocks,
+    GGMLQuantizationType.Q5_0: __quantize_q5_0_blocks,
+    GGMLQuantizationType.Q5_1: __quantize_q5_1_blocks,
+    GGMLQuantizationType.Q8_0: __quantize_q8_0_blocks,
+}
+
+
+# number of blocks processed at once, small enough for the scratch buffers to stay in cache
+__chunk_blocks = 16 * 1024
+
+# tensors smaller than this are not worth splitting across threads
+__min_parallel_blocks = 4 * __chunk_blocks
+
+__executor: ThreadPoolExecutor | None = None
+__executor_lock = threading.Lock()
+
+
+def __get_executor() -> ThreadPoolExecutor:
+    global __executor
+    with __executor_lock:
+        if __executor is None:
+            # shared by all callers, so that concurrent conversions don't oversubscribe the cores
+            __executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="quantize")
+        return __executor
+
+
+def __quantize_row_range(qtype: GGMLQuantizationType, rows: np.ndarray, out: np.ndarray, start: int, stop: int, chunk_rows: int,
+                         src_qtype: GGMLQuantizationType | None = None) -> None:
+    block_size = GGML_QUANT_SIZES[qtype][0]
+    block_dtype = __block_dtypes[qtype]
+    quantize_blocks = __quantize_blocks_fns[qtype]
+    for i in range(start, stop, chunk_rows):
+        j = min(i + chunk_rows, stop)
+        if src_qtype == GGMLQuantizationType.BF16:
+            # only one chunk at a time is converted to F32
+            blocks = __bf16_to_fp32(rows[i:j]).reshape((-1, block_size))
+        else:
+            blocks = rows[i:j].reshape((-1, block_size)).astype(np.float32, copy=False)
+        # preallocated output, as an array of blocks
+        quantize_blocks(blocks, out[i:j].reshape(-1).view(block_dtype))
+
+
+def __quantize_array(n: np.ndarray, qtype: GGMLQuantizationType, n_threads: int | None = None,
+                     src_qtype: GGMLQuantizationType | None = None) -> np.ndarray:
+    with profile("quantize", n.nbytes):
+        return __quantize_rows(n, qtype, n_threads, src_qtype)
+
+
+def __quantize_rows(n: np.ndarray, qtype: GGMLQuantizationType, n_threads: int | None, src_qtype: GGMLQuantizationType | None) -> np.ndarray:
+    block_size = GGML_QUANT_SIZES[qtype][0]
+    assert n.shape[-1] % block_size == 0
+    oshape = __quantize_shape_change(qtype)(n.shape)
+
+    rows = n.reshape((-1, n.shape[-1]))
+    out = np.empty((rows.shape[0], oshape[-1]), dtype=np.uint8)
+    n_rows = rows.shape[0]
+    chunk_rows = max(1, __chunk_blocks * block_size // max(1, rows.shape[1]))
+
+    if n_threads is None:
+        n_threads = os.cpu_count() or 1
+    n_threads = min(n_threads, -(-n_rows // chunk_rows))
+
+    if n_threads <= 1 or n.size // block_size < __min_parallel_blocks:
+        __quantize_row_range(qtype, rows, out, 0, n_rows, chunk_rows, src_qtype)
+        return out.reshape(oshape)
+
+    # split the rows into one contiguous range per thread, each range writes into its own part of the output
+    bounds = [n_rows * i // n_threads for i in range(n_threads + 1)]
+    executor = __get_executor()
+    futures = [
+        executor.submit(__quantize_row_range, qtype, rows, out, start, stop, chunk_rows, src_qtype)
+        for start, stop in zip(bounds[:-1], bounds[1:])
+    ]
+    for future in futures:
+        future.result()
+    return out.reshape(oshape)
+
+
+__quantize_lazy_fns = {
+    qtype: LazyNumpyTensor._wrap_fn(
+        (lambda n, qtype=qtype, **kwargs: __quantize_array(n, qtype, **kwargs)),
+        meta_noop=(np.uint8, __quantize_shape_change(qtype)),
+    )
+    for qtype in __quantize_blocks_fns
+}
 
-__quantize_q8_0_lazy = LazyNumpyTensor._wrap_fn(
-    __quantize_q8_0_array,
-    meta_noop=(np.uint8, __quantize_q8_0_shape_change),
-)
 
+def can_quantize(n: np.ndarray, qtype: GGMLQuantizationType) -> bool:
+    return qtype in __quantize_blocks_fns and n.shape[-1] % GGML_QUANT_SIZES[qtype][0] == 0
 
-def quantize_q8_0(data: np.ndarray):
+
+# Like for quantize_bf16, src_qtype=BF16 is for the raw bits of BF16 values,
+# which are then converted to F32 in chunks instead of all at once.
+def quantize(data: np.ndarray, qtype: GGMLQuantizationType, n_threads: int | None = None, src_qtype: GGMLQuantizationType | None = None):
+    if qtype not in __quantize_blocks_fns:
+        raise NotImplementedError(f"Quantization to {qtype.name} is not implemented")
+    __check_src_qtype(src_qtype)
     if type(data) is LazyNumpyTensor:
-        return __quantize_q8_0_lazy(data)
+        return __quantize_lazy_fns[qtype](data, n_threads=n_threads, src_qtype=src_qtype)
     else:
-        return __quantize_q8_0_array(data)
+        return __quantize_array(data, qtype, n_threads=n_threads, src_qtype=src_qtype)
+
+
+def quantize_q8_0(data: np.ndarray, n_threads: int | None = None):
+    return quantize(data, GGMLQuantizationType.Q8_0, n_threads=n_threads)
+
+
+def quantize_q4_0(data: np.ndarray, n_threads: int | None = None):
+    return quantize(data, GGMLQuantizationType.Q4_0, n_threads=n_threads)
+
+
+def quantize_q4_1(data: np.ndarray, n_threads: int | None = None):
+    return quantize(data, GGMLQuantizationType.Q4_1, n_threads=n_threads)
+
+
+def quantize_q5_0(data: np.ndarray, n_threads: int | None = None):
+    return quantize(data, GGMLQuantizationType.Q5_0, n_threads=n_threads)
+
+
+def quantize_q5_1(data: np.ndarray, n_threads: int | None = None):
+    return quantize(data, GGMLQuantizationType.Q5_1, n_threads=n_threads)
+
+
+# Dequantization, the inverse of the above. Used to read back the tensors of GGUF files.
+
+def __dequantize_q8_0_blocks(blocks: np.ndarray, out: np.ndarray) -> None:
+    np.multiply(blocks["d"].astype(np.float32)[:, None], blocks["qs"], out=out)
+
+
+# the low nibbles hold the first half of each block, the high nibbles the second half
+def __unpack_nibbles(qs: np.ndarray) -> np.ndarray:
+    return np.concatenate([qs & 0x0F, qs >> 4], axis=1)
+
+
+def __unpack_high_bits(qh: np.ndarray) -> np.ndarray:
+    return np.unpackbits(qh, axis=1, bitorder="little") << 4
+
+
+def __dequantize_q4_0_blocks(blocks: np.ndarray, out: np.ndarray) -> None:
+    q = __unpack_nibbles(blocks["qs"]).astype(np.int8)
+    q -= 8
+    np.multiply(blocks["d"].astype(np.float32)[:, None], q, out=out)
+
+
+def __dequantize_q4_1_blocks(blocks: np.ndarray, out: np.ndarray) -> None:
+    np.multiply(blocks["d"].astype(np.float32)[:, None], __unpack_nibbles(blocks["qs"]), out=out)
+    out += blocks["m"].astype(np.float32)[:, None]
+
+
+def __dequantize_q5_0_blocks(blocks: np.ndarray, out: np.ndarray) -> None:
+    q = (__unpack_nibbles(blocks["qs"]) | __unpack_high_bits(blocks["qh"])).astype(np.int8)
+    q -= 16
+    np.multiply(blocks["d"].astype(np.float32)[:, None], q, out=out)
+
+
+def __dequantize_q5_1_blocks(blocks: np.ndarray, out: np.ndarray) -> None:
+    q = __unpack_nibbles(blocks["qs"]) | __unpack_high_bits(blocks["qh"])
+    np.multiply(blocks["d"].astype(np.float32)[:, None], q, out=out)
+    out += blocks["m"].astype(np.float32)[:, None]
+
+
+__dequantize_blocks_fns: dict[GGMLQuantizationType, Callable[[np.ndarray, np.ndarray], None]] = {
+    GGMLQuantizationType.Q4_0: __dequantize_q4_0_blocks,
+    GGMLQuantizationType.Q4_1: __dequantize_q4_1_blocks,
+    GGMLQuantizationType.Q5_0: __dequantize_q5_0_blocks,
+    GGMLQuantizationType.Q5_1: __dequantize_q5_1_blocks,
+    GGMLQuantizationType.Q8_0: __dequantize_q8_0_blocks,
+}
+
+__unquantized_dtypes: dict[GGMLQuantizationType, np.dtype] = {
+    GGMLQuantizationType.F32: np.dtype(np.float32),
+    GGMLQuantizationType.F16: np.dtype(np.float16),
+    GGMLQuantizationType.F64: np.dtype(np.float64),
+    GGMLQuantizationType.I8:  np.dtype(np.int8),
+    GGMLQuantizationType.I16: np.dtype(np.int16),
+    GGMLQuantizationType.I32: np.dtype(np.int32),
+    GGMLQuantizationType.I64: np.dtype(np.int64),
+}
+
+
+def __dequantize_blocks(data: np.ndarray, qtype: GGMLQuantizationType, byte_order: Literal['I', 'S']) -> np.ndarray:
+    block_size, type_size = GGML_QUANT_SIZES[qtype]
+    # the scales of the blocks of byte-swapped data are swapped too, the quants are bytes
+    block_dtype = __block_dtypes[qtype].newbyteorder(byte_order)
+    dequantize_blocks = __dequantize_blocks_fns[qtype]
+
+    rows = data.reshape((-1, data.shape[-1]))
+    if rows.shape[1] % type_size != 0:
+        raise ValueError(f"Rows of {rows.shape[1]} bytes are not made of whole {qtype.name} blocks")
+    oshape = (*data.shape[:-1], data.shape[-1] // type_size * block_size)
+
+    # as an array of blocks, this doesn't copy contiguous data like memmapped tensors
+    blocks = np.ascontiguousarray(rows).reshape(-1).view(block_dtype)
+    out = np.empty((blocks.shape[0], block_size), dtype=np.float32)
+    # in chunks, to bound the size of the temporaries
+    for i in range(0, blocks.shape[0], __chunk_blocks):
+        j = min(i + __chunk_blocks, blocks.shape[0])
+        dequantize_blocks(blocks[i:j], out[i:j])
+    return out.reshape(oshape)
+
+
+def can_dequantize(qtype: GGMLQuantizationType) -> bool:
+    return qtype in __dequantize_blocks_fns or qtype in __unquantized_dtypes or qtype == GGMLQuantizationType.BF16
+
+
+# Quantized and BF16 data can also be passed as raw bytes, with the last dimension
+# being the number of bytes per row, like the data of quantized tensors from GGUFReader.
+# Raw bytes in the byte order of another host are decoded with byte_order 'S', like GGUFReader.byte_order.
+def dequantize(data: np.ndarray, qtype: GGMLQuantizationType, byte_order: Literal['I', 'S'] = 'I') -> np.ndarray:
+    if qtype == GGMLQuantizationType.BF16:
+        if byte_order == 'S':
+            data = data.view(np.uint8).view(np.dtype(np.uint16).newbyteorder('S')).astype(np.uint16)
+        return __bf16_to_fp32(data)
+    if (dtype := __unquantized_dtypes.get(qtype)) is not None:
+        if data.dtype == np.uint8:
+            data = data.view(dtype.newbyteorder(byte_order))
+        return data.astype(np.float32)
+    if qtype not in __dequantize_blocks_fns:
+        raise NotImplementedError(f"Dequantization of {qtype.name} is not implemented")
+    return __dequantize_blocks(data.view(np.uint8), qtype, byte_order)
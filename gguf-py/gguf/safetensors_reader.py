@@ -0,0 +1,74 @@
+#
+# Zero-copy reading of safetensors files, without torch or the safetensors package.
+# The tensors are NumPy views of a memory map of the file.
+#
+from __future__ import annotations
+
+import json
+import logging
+import os
+from typing import Any, Literal, NamedTuple
+
+import numpy as np
+import numpy.typing as npt
+
+from .profiling import profile
+
+logger = logging.getLogger(__name__)
+
+
+class SafetensorsTensor(NamedTuple):
+    name: str
+    # type name in the file, e.g. 'BF16'
+    dtype: str
+    shape: tuple[int, ...]
+    # offset of the data from the start of the file
+    data_offset: int
+    n_bytes: int
+    # bf16 is viewed as uint16, there is no NumPy type for it
+    data: npt.NDArray[Any]
+
+
+class SafetensorsReader:
+    # ref: https://github.com/huggingface/safetensors#format
+    safetensors_to_np: dict[str, np.dtype[Any]] = {
+        "F64":  np.dtype("<f8"),
+        "F32":  np.dtype("<f4"),
+        "F16":  np.dtype("<f2"),
+        "BF16": np.dtype("<u2"),
+        "I64":  np.dtype("<i8"),
+        "I32":  np.dtype("<i4"),
+        "I16":  np.dtype("<i2"),
+        "I8":   np.dtype("i1"),
+        "U8":   np.dtype("u1"),
+        "BOOL": np.dtype("?"),
+    }
+
+    # With mode 'c', the views are writable, and writing to them doesn't change the file (copy-on-write).
+    def __init__(self, path: os.PathLike[str] | str, mode: Literal['r'] | Literal['c'] = 'r'):
+        self.path = path
+        with open(path, "rb") as f, profile("load"):
+            header_size = int.from_bytes(f.read(8), "little")
+            header: dict[str, Any] = json.loads(f.read(header_size))
+        self.metadata: dict[str, str] = header.pop("__metadata__", None) or {}
+        self.data = np.memmap(path, mode = mode)
+        data_start = 8 + header_size
+
+        self.tensors: dict[str, SafetensorsTensor] = {}
+        for name, info in header.items():
+            dtype = self.safetensors_to_np.get(info["dtype"])
+            if dtype is None:
+                raise ValueError(f"Unsupported type {info['dtype']} of tensor {name!r} in {path}")
+            shape = tuple(info["shape"])
+            begin, end = info["data_offsets"]
+            n_bytes = int(np.prod(shape, dtype = np.int64)) * dtype.itemsize
+            if not 0 <= begin <= end <= len(self.data) - data_start or end - begin != n_bytes:
+                raise ValueError(f"Invalid data offsets {begin}, {end} of tensor {name!r} in {path}")
+            data = self.data[data_start + begin:data_start + end].view(dtype).reshape(shape)
+            self.tensors[name] = SafetensorsTensor(name, info["dtype"], shape, data_start + begin, n_bytes, data)
+
+    def keys(self) -> list[str]:
+        return list(self.tensors.keys())
+
+    def get_tensor(self, name: str) -> npt.NDArray[Any]:
+        return self.tensors[name].data
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from typing import Sequence
+import functools
+import re
+from typing import NamedTuple, Sequence
 
 from .constants import MODEL_ARCH, MODEL_TENSOR, MODEL_TENSORS, TENSOR_NAMES
 
@@ -397,39 +399,42 @@ class TensorNameMap:
         },
     }
 
-    mapping: dict[str, tuple[MODEL_TENSOR, str]]
-
     def __init__(self, arch: MODEL_ARCH, n_blocks: int):
-        self.mapping = {}
-        for tensor, keys in self.mappings_cfg.items():
-            if tensor not in MODEL_TENSORS[arch]:
-                continue
-            tensor_name = TENSOR_NAMES[tensor]
-            self.mapping[tensor_name] = (tensor, tensor_name)
-            for key in keys:
-                self.mapping[key] = (tensor, tensor_name)
-        if arch in self.arch_block_mappings_cfg:
-            self.block_mappings_cfg.update(self.arch_block_mappings_cfg[arch])
-        for bid in range(n_blocks):
-            for tensor, keys in self.block_mappings_cfg.items():
-                if tensor not in MODEL_TENSORS[arch]:
+        self.arch = arch
+        self.n_blocks = n_blocks
+        # shared by all the maps of the same architecture, whatever their number of blocks
+        self._patterns = _compile_patterns(arch)
+
+    # All the names of the map. This is built on demand, lookups don't need it.
+    @functools.cached_property
+    def mapping(self) -> dict[str, tuple[MODEL_TENSOR, str]]:
+        mapping = dict(self._patterns.names)
+        for bid in range(self.n_blocks):
+            for template, (tensor, tensor_name) in self._patterns.block_names.items():
+                mapping[template.format(bid = bid)] = (tensor, tensor_name.format(bid = bid))
+        return mapping
+
+    def _lookup(self, key: str) -> tuple[MODEL_TENSOR, str] | None:
+        # like the original mapping of all the names, where the names of the blocks came after the others
+        candidates = self._patterns.block_patterns.get(_DIGITS_SEGMENT.sub("#", key))
+        if candidates is not None:
+            for pattern, tensor, tensor_name in candidates:
+                match = pattern.fullmatch(key)
+                if match is None:
                     continue
-                # TODO: make this configurable
-                n_experts = 128
-                for xid in range(n_experts):
-                    tensor_name = TENSOR_NAMES[tensor].format(bid = bid, xid = xid)
-                    self.mapping[tensor_name] = (tensor, tensor_name)
-                    for key in keys:
-                        key = key.format(bid = bid, xid = xid)
-                        self.mapping[key] = (tensor, tensor_name)
+                ids = match.groupdict()
+                # (a few of them, like the rope frequencies, have the same name in every block)
+                if int(ids.get("bid", 0)) < self.n_blocks:
+                    return tensor, tensor_name.format(**ids)
+        return self._patterns.names.get(key)
 
     def get_type_and_name(self, key: str, try_suffixes: Sequence[str] = ()) -> tuple[MODEL_TENSOR, str] | None:
-        result = self.mapping.get(key)
+        result = self._lookup(key)
         if result is not None:
             return result
         for suffix in try_suffixes:
             if key.endswith(suffix):
-                result = self.mapping.get(key[:-len(suffix)])
+                result = self._lookup(key[:-len(suffix)])
                 if result is not None:
                     return result[0], result[1] + suffix
         return None
@@ -447,17 +452,69 @@ class TensorNameMap:
         return result[0]
 
     def __getitem__(self, key: str) -> str:
-        try:
-            return self.mapping[key][1]
-        except KeyError:
+        result = self._lookup(key)
+        if result is None:
             raise KeyError(key)
+        return result[1]
 
     def __contains__(self, key: str) -> bool:
-        return key in self.mapping
+        return self._lookup(key) is not None
 
     def __repr__(self) -> str:
         return repr(self.mapping)
 
 
+# the block and expert numbers are whole components of the names
+_DIGITS_SEGMENT = re.compile(r"(?<![^.])\d+(?![^.])")
+_ID_SEGMENT = re.compile(r"(?<![^.])\{(bid|xid)\}(?![^.])")
+
+
+class _TensorNamePatterns(NamedTuple):
+    # names without a block number
+    names: dict[str, tuple[MODEL_TENSOR, str]]
+    # templates of the names of the blocks, with {bid}
+    block_names: dict[str, tuple[MODEL_TENSOR, str]]
+    # the templates as regexes, by the shape of the names they match, which is the name with its numbers replaced by #
+    block_patterns: dict[str, list[tuple[re.Pattern[str], MODEL_TENSOR, str]]]
+
+
+def _template_to_pattern(template: str) -> re.Pattern[str]:
+    pattern = ""
+    pos = 0
+    for match in _ID_SEGMENT.finditer(template):
+        # no leading zeros, like the formatted numbers
+        pattern += re.escape(template[pos:match.start()]) + f"(?P<{match[1]}>0|[1-9][0-9]*)"
+        pos = match.end()
+    return re.compile(pattern + re.escape(template[pos:]))
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_patterns(arch: MODEL_ARCH) -> _TensorNamePatterns:
+    names: dict[str, tuple[MODEL_TENSOR, str]] = {}
+    for tensor, keys in TensorNameMap.mappings_cfg.items():
+        if tensor not in MODEL_TENSORS[arch]:
+            continue
+        tensor_name = TENSOR_NAMES[tensor]
+        names[tensor_name] = (tensor, tensor_name)
+        for key in keys:
+            names[key] = (tensor, tensor_name)
+
+    block_mappings_cfg = {**TensorNameMap.block_mappings_cfg, **TensorNameMap.arch_block_mappings_cfg.get(arch, {})}
+    block_names: dict[str, tuple[MODEL_TENSOR, str]] = {}
+    for tensor, keys in block_mappings_cfg.items():
+        if tensor not in MODEL_TENSORS[arch]:
+            continue
+        tensor_name = TENSOR_NAMES[tensor]
+        block_names[tensor_name] = (tensor, tensor_name)
+        for key in keys:
+            block_names[key] = (tensor, tensor_name)
+
+    block_patterns: dict[str, list[tuple[re.Pattern[str], MODEL_TENSOR, str]]] = {}
+    for template, (tensor, tensor_name) in block_names.items():
+        shape = _DIGITS_SEGMENT.sub("#", _ID_SEGMENT.sub("#", template))
+        block_patterns.setdefault(shape, []).append((_template_to_pattern(template), tensor, tensor_name))
+    return _TensorNamePatterns(names, block_names, block_patterns)
+
+
 def get_tensor_name_map(arch: MODEL_ARCH, n_blocks: int) -> TensorNameMap:
     return TensorNameMap(arch, n_blocks)
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
+import hashlib
 import logging
 import json
 import os
+import tempfile
 from pathlib import Path
 from typing import Any, Callable, Sequence, Mapping, Iterable
 
+import numpy as np
+
 from .gguf_writer import GGUFWriter
 
 logger = logging.getLogger(__name__)
@@ -163,3 +167,128 @@ class SpecialVocab:
         for typ in self.special_token_types:
             self._set_special_token(typ, config.get(f'{typ}_token_id'))
         return True
+
+
+# Cache of the vocab extracted from the tokenizer files of a model, so that converting another model with the same
+# tokenizer (e.g. another fine-tune of the same base model) can skip the extraction.
+# The entries are keyed by the contents of the tokenizer files, and by whatever else the extraction depends on.
+# They are stored in .npz files: the lists of strings, bytes or numbers as arrays (the strings as one buffer with
+# their end offsets), and the other values as JSON, so that even vocabs of a few hundred thousand tokens load quickly.
+class VocabCache:
+    # bump when the extracted entries change
+    VERSION = 1
+
+    # the files the tokenizers supported by the converters are loaded from
+    TOKENIZER_FILES = (
+        'tokenizer*.json', 'tokenizer.model', 'tokenization_*.py', '*.tiktoken', 'vocab.json', 'merges.txt',
+        'added_tokens.json', 'special_tokens_map.json',
+    )
+
+    def __init__(self, cache_dir: str | os.PathLike[str] | None = None):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else VocabCache.default_dir()
+
+    @staticmethod
+    def default_dir() -> Path:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+        return Path(cache_home) / 'gguf-py' / 'vocab'
+
+    @staticmethod
+    def tokenizer_files(path: Path) -> list[Path]:
+        return sorted({p for pattern in VocabCache.TOKENIZER_FILES for p in path.glob(pattern) if p.is_file()})
+
+    # the sha256 of a file, e.g. of the converter itself, whose code and tables the extraction depends on
+    @staticmethod
+    def file_hash(path: Path) -> str:
+        checksum = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                checksum.update(chunk)
+        return checksum.hexdigest()
+
+    def key(self, kind: str, files: Iterable[Path], **params: Any) -> str:
+        checksum = hashlib.sha256(json.dumps([VocabCache.VERSION, kind, params], sort_keys = True).encode())
+        for path in sorted(files):
+            checksum.update(path.name.encode() + b'\0')
+            checksum.update(VocabCache.file_hash(path).encode() + b'\0')
+        return f'{kind}-{checksum.hexdigest()}'
+
+    def load(self, key: str) -> dict[str, Any] | None:
+        path = self.cache_dir / f'{key}.npz'
+        try:
+            with np.load(path, allow_pickle = False) as arrays:
+                entry = VocabCache._decode(arrays)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f'Ignoring unreadable vocab cache entry {path}: {e}')
+            return None
+        logger.info(f'Using the cached vocab from {path}')
+        return entry
+
+    def store(self, key: str, entry: dict[str, Any]) -> None:
+        # written to a temporary file first, so that concurrent conversions never read a partial entry
+        tmp_path = None
+        try:
+            arrays = VocabCache._encode(entry)
+            self.cache_dir.mkdir(parents = True, exist_ok = True)
+            with tempfile.NamedTemporaryFile('wb', dir = self.cache_dir, suffix = '.tmp', delete = False) as f:
+                tmp_path = f.name
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.cache_dir / f'{key}.npz')
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f'Could not save the vocab to the cache in {self.cache_dir}: {e}')
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    @staticmethod
+    def _encode(entry: dict[str, Any]) -> dict[str, np.ndarray]:
+        arrays: dict[str, np.ndarray] = {}
+        kinds: dict[str, str] = {}
+        values: dict[str, Any] = {}
+        for name, value in entry.items():
+            kind = VocabCache._list_kind(value)
+            if kind is None:
+                values[name] = value
+                continue
+            kinds[name] = kind
+            if kind in ('str', 'bytes'):
+                items = [v.encode('utf-8', 'surrogatepass') for v in value] if kind == 'str' else value
+                ends = np.cumsum([len(v) for v in items])
+                arrays[f'{name}.data'] = np.frombuffer(b''.join(items), dtype = np.uint8)
+                arrays[f'{name}.ends'] = ends.astype(np.min_scalar_type(ends[-1]))
+            elif kind == 'int':
+                a = np.array(value, dtype = np.int64)
+                arrays[name] = a.astype(np.result_type(np.min_scalar_type(a.min()), np.min_scalar_type(a.max())))
+            else:
+                a = np.array(value, dtype = np.float64)
+                # the scores are usually float32 values
+                arrays[name] = a32 if ((a32 := a.astype(np.float32)) == a).all() else a
+        header = json.dumps({'kinds': kinds, 'values': values}, ensure_ascii = False).encode('utf-8')
+        arrays['header'] = np.frombuffer(header, dtype = np.uint8)
+        return arrays
+
+    @staticmethod
+    def _decode(arrays: Mapping[str, np.ndarray]) -> dict[str, Any]:
+        header = json.loads(arrays['header'].tobytes().decode('utf-8'))
+        entry: dict[str, Any] = dict(header['values'])
+        for name, kind in header['kinds'].items():
+            if kind in ('str', 'bytes'):
+                data = arrays[f'{name}.data'].tobytes()
+                ends = arrays[f'{name}.ends'].tolist()
+                items = [data[start:end] for start, end in zip([0] + ends[:-1], ends)]
+                entry[name] = [v.decode('utf-8', 'surrogatepass') for v in items] if kind == 'str' else items
+            else:
+                entry[name] = arrays[name].tolist()
+        return entry
+
+    # The kind of the non-empty lists stored as arrays, or None for the values stored as JSON.
+    @staticmethod
+    def _list_kind(value: Any) -> str | None:
+        if not isinstance(value, list) or not value:
+            return None
+        for kind, types in (('str', str), ('bytes', bytes), ('int', int), ('float', float)):
+            if all(isinstance(v, types) and not isinstance(v, bool) for v in value):
+                if kind == 'int' and not all(-2**63 <= v < 2**63 for v in value):
+                    return None
+                return kind
+        return None
@@ -9,5 +9,6 @@ gguf_convert_endian_entrypoint = import_module("scripts.gguf-convert-endian").ma
 gguf_dump_entrypoint           = import_module("scripts.gguf-dump").main
 gguf_set_metadata_entrypoint   = import_module("scripts.gguf-set-metadata").main
 gguf_new_metadata_entrypoint   = import_module("scripts.gguf-new-metadata").main
+gguf_dedup_entrypoint          = import_module("scripts.gguf-dedup").main
 
 del import_module, os
@@ -4,7 +4,10 @@ from __future__ import annotations
 import logging
 import argparse
 import os
+import shutil
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
 
@@ -18,8 +21,34 @@ import gguf
 
 logger = logging.getLogger("gguf-convert-endian")
 
+# Each block_q8_0 consists of an f16 delta (scaling factor) followed by 32 int8 quantizations.
+BLOCK_Q8_0 = np.dtype([("d", np.uint16), ("qs", np.int8, 32)])
 
-def convert_byteorder(reader: gguf.GGUFReader, args: argparse.Namespace) -> None:
+# bytes of tensor data byte-swapped per task of the threads
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+# Swaps the bytes of the items of a (possibly strided) view of the file in place.
+# Unlike ndarray.byteswap, the cast from the swapped byte order releases the GIL, so the threads run in parallel.
+def byteswap_inplace(items: np.ndarray) -> None:
+    np.copyto(items, items.view(items.dtype.newbyteorder()), casting="equiv")
+
+
+# The views of the tensor data to byte-swap, in chunks of about CHUNK_SIZE bytes.
+def tensor_chunks(tensor: gguf.ReaderTensor) -> list[tuple[np.ndarray, int]]:
+    data = tensor.data.reshape(-1)
+    if tensor.tensor_type == gguf.GGMLQuantizationType.Q8_0:
+        # only the deltas of the blocks, in a strided view
+        items = data.view(np.uint8).view(BLOCK_Q8_0)["d"]
+        itemsize = BLOCK_Q8_0.itemsize
+    else:
+        items = data
+        itemsize = data.itemsize
+    step = max(1, CHUNK_SIZE // itemsize)
+    return [(items[i:i + step], min(step, len(items) - i) * itemsize) for i in range(0, len(items), step)]
+
+
+def check_byteorder(reader: gguf.GGUFReader, args: argparse.Namespace) -> None:
     if np.uint32(1) == np.uint32(1).newbyteorder("<"):
         # Host is little endian
         host_endian = "little"
@@ -46,63 +75,75 @@ def convert_byteorder(reader: gguf.GGUFReader, args: argparse.Namespace) -> None
         ):
             raise ValueError(f"Cannot handle type {tensor.tensor_type.name} for tensor {repr(tensor.name)}")
     logger.info(f"* Preparing to convert from {file_endian.upper()} to {order.upper()}")
+    if order != host_endian:
+        logger.warning("* Requested endian differs from host, you will not be able to load the model on this machine.")
+
+
+def convert_byteorder(reader: gguf.GGUFReader, args: argparse.Namespace) -> None:
+    check_byteorder(reader, args)
     if args.dry_run:
         return
     logger.warning("*** Warning *** Warning *** Warning **")
-    logger.warning("* This conversion process may damage the file. Ensure you have a backup.")
-    if order != host_endian:
-        logger.warning("* Requested endian differs from host, you will not be able to load the model on this machine.")
+    logger.warning("* This conversion process may damage the file. Ensure you have a backup,")
+    logger.warning("* or use --outfile to write the converted model to a new file instead.")
     logger.warning("* The file will be modified immediately, so if conversion fails or is interrupted")
     logger.warning("* the file will be corrupted. Enter exactly YES if you are positive you want to proceed:")
     response = input("YES, I am sure> ")
     if response != "YES":
         logger.warning("You didn't enter YES. Okay then, see ya!")
         sys.exit(0)
+    swap_byteorder(reader, args.threads)
+
+
+def swap_byteorder(reader: gguf.GGUFReader, threads: int) -> None:
     logger.info(f"* Converting fields ({len(reader.fields)})")
     for idx, field in enumerate(reader.fields.values()):
         logger.info(f"- {idx:4}: Converting field {repr(field.name)}, part count: {len(field.parts)}")
         for part in field.parts:
             part.byteswap(inplace=True)
-    logger.info(f"* Converting tensors ({len(reader.tensors)})")
-
-    for idx, tensor in enumerate(pbar := tqdm(reader.tensors, desc="Converting tensor")):
-        log_message = (
-            f"Converting tensor {repr(tensor.name)}, "
-            f"type={tensor.tensor_type.name}, "
-            f"elements={tensor.n_elements} "
-        )
 
+    logger.info(f"* Converting tensors ({len(reader.tensors)})")
+    chunks = []
+    for tensor in reader.tensors:
+        logger.debug(f"Converting tensor {repr(tensor.name)}, type={tensor.tensor_type.name}, elements={tensor.n_elements}")
         # Byte-swap each part of the tensor's field
         for part in tensor.field.parts:
             part.byteswap(inplace=True)
+        chunks += tensor_chunks(tensor)
 
-        # Byte-swap tensor data if necessary
-        if tensor.tensor_type == gguf.GGMLQuantizationType.Q8_0:
-            # Handle Q8_0 tensor blocks (block_q8_0)
-            # Specific handling of block_q8_0 is required.
-            # Each block_q8_0 consists of an f16 delta (scaling factor) followed by 32 int8 quantizations.
-
-            block_size = 34 # 34 bytes = <f16 delta scaling factor> + 32 * <int8 quant>
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        with tqdm(total=sum(nbytes for _, nbytes in chunks), desc="Converting tensors", unit="byte", unit_scale=True) as pbar:
+            futures = {executor.submit(byteswap_inplace, items): nbytes for items, nbytes in chunks}
+            for future in as_completed(futures):
+                future.result()
+                pbar.update(futures[future])
 
-            n_blocks = len(tensor.data) // block_size
-            for block_num in (inner_pbar := tqdm(range(n_blocks), desc="Byte-swapping Blocks", leave=False)):
-                block_offs = block_num * block_size
-
-                # Byte-Swap f16 sized delta field
-                delta = tensor.data[block_offs:block_offs + 2].view(dtype=np.uint16)
-                delta.byteswap(inplace=True)
-
-                # Byte-Swap Q8 weights
-                if block_num % 100000 == 0:
-                    inner_pbar.set_description(f"Byte-swapping Blocks [{(n_blocks - block_num) // n_blocks}]")
-
-        else:
-            # Handle other tensor types
-            tensor.data.byteswap(inplace=True)
+    logger.info("* Completion")
 
-        pbar.set_description(log_message)
 
-    logger.info("* Completion")
+# The conversion is done on a copy next to the output file, which replaces it only once complete,
+# so that an interrupted conversion leaves the input (and any previous output) intact.
+def convert_to_new_file(reader: gguf.GGUFReader, args: argparse.Namespace) -> None:
+    check_byteorder(reader, args)
+    if args.dry_run:
+        return
+    outfile = Path(args.outfile)
+    fd, tmp_name = tempfile.mkstemp(dir=outfile.parent, prefix=f".{outfile.name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        logger.info(f"* Copying {args.model} to {tmp_name}")
+        shutil.copyfile(args.model, tmp_name)
+        shutil.copymode(args.model, tmp_name)
+        converted = gguf.GGUFReader(tmp_name, 'r+')
+        swap_byteorder(converted, args.threads)
+        converted.data.flush()
+        with open(tmp_name, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_name, outfile)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    logger.info(f"* Wrote {outfile}")
 
 
 def main() -> None:
@@ -119,6 +160,14 @@ def main() -> None:
         "--dry-run", action="store_true",
         help="Don't actually change anything",
     )
+    parser.add_argument(
+        "--outfile", type=str, default=None,
+        help="write the converted model to this file instead of modifying the model in place; it is only created (or replaced) once the conversion is complete, and can be the model itself",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=os.cpu_count() or 1,
+        help="number of threads byte-swapping the tensor data (default: number of CPUs)",
+    )
     parser.add_argument("--verbose", action="store_true", help="increase output verbosity")
 
     args = parser.parse_args(None if len(sys.argv) > 1 else ["--help"])
@@ -126,8 +175,11 @@ def main() -> None:
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 
     logger.info(f'* Loading: {args.model}')
-    reader = gguf.GGUFReader(args.model, 'r' if args.dry_run else 'r+')
-    convert_byteorder(reader, args)
+    if args.outfile is not None:
+        convert_to_new_file(gguf.GGUFReader(args.model, 'r'), args)
+    else:
+        reader = gguf.GGUFReader(args.model, 'r' if args.dry_run else 'r+')
+        convert_byteorder(reader, args)
 
 
 if __name__ == "__main__":
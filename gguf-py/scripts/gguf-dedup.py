@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import logging
+import argparse
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+# Necessary to load the local gguf package
+if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
+    sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import gguf
+
+logger = logging.getLogger("gguf-dedup")
+
+INDEX_VERSION = 1
+
+# names of the chunks of a file which aren't tensors
+HEADER_CHUNK = "<header>"
+PADDING_CHUNK = "<padding>"
+
+
+# The byte ranges making up a GGUF file, as (name, offset, nbytes): the header (metadata and tensor infos),
+# then the data of each tensor. The padding between them is only included when it isn't zeros.
+def file_chunks(reader: gguf.GGUFReader) -> list[tuple[str, int, int]]:
+    chunks = [(HEADER_CHUNK, 0, reader.data_offset)]
+    end = reader.data_offset
+    for tensor in sorted(reader.tensors, key=lambda t: t.data_offset):
+        if tensor.data_offset > end and np.any(reader.data[end:tensor.data_offset]):
+            chunks.append((PADDING_CHUNK, end, tensor.data_offset - end))
+        chunks.append((tensor.name, tensor.data_offset, tensor.n_bytes))
+        end = max(end, tensor.data_offset + tensor.n_bytes)
+    if len(reader.data) > end and np.any(reader.data[end:]):
+        chunks.append((PADDING_CHUNK, end, len(reader.data) - end))
+    return chunks
+
+
+def hash_chunk(reader: gguf.GGUFReader, offset: int, nbytes: int) -> str:
+    # hashlib releases the GIL while hashing big buffers, so the threads hash in parallel
+    return hashlib.sha256(memoryview(reader.data[offset:offset + nbytes])).hexdigest()
+
+
+# Hashes the chunks of a file on a thread pool. Each chunk is passed to `process`, if any,
+# from the thread which hashed it, e.g. to store it.
+def make_index(path: Path, threads: int, process: Callable[[dict[str, Any]], None] | None = None) -> dict[str, Any]:
+    reader = gguf.GGUFReader(path, 'r', lazy=True)
+    chunks = file_chunks(reader)
+
+    def hash_and_process(chunk: tuple[str, int, int]) -> dict[str, Any]:
+        name, offset, nbytes = chunk
+        entry = {"name": name, "offset": offset, "nbytes": nbytes, "sha256": hash_chunk(reader, offset, nbytes)}
+        if process is not None:
+            process(entry)
+        pbar.update(nbytes)
+        return entry
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        with tqdm(total=sum(nbytes for _, _, nbytes in chunks), desc=f"Hashing {path.name}", unit="byte", unit_scale=True) as pbar:
+            entries = list(executor.map(hash_and_process, chunks))
+    return {"version": INDEX_VERSION, "size": len(reader.data), "chunks": entries}
+
+
+def write_json(index: dict[str, Any], path: Path) -> None:
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_name, path)
+
+
+def read_index(path: Path) -> dict[str, Any]:
+    with open(path) as f:
+        index = json.load(f)
+    if index.get("version") != INDEX_VERSION:
+        raise ValueError(f"{path} is an index of version {index.get('version')}, expected {INDEX_VERSION}")
+    return index
+
+
+# A directory of the chunks of GGUF files, each stored once by the sha256 of its content
+# under objects/, and of the index of each file stored in it under models/.
+class TensorStore:
+    def __init__(self, path: Path):
+        self.path = path
+        self.objects_dir = path / "objects"
+        self.models_dir = path / "models"
+
+    def object_path(self, sha256: str) -> Path:
+        return self.objects_dir / sha256[:2] / sha256
+
+    def index_path(self, name: str) -> Path:
+        return self.models_dir / f"{name}.json"
+
+    def models(self) -> list[str]:
+        return sorted(p.name[:-len(".json")] for p in self.models_dir.glob("*.json"))
+
+    # Adds a file to the store under `name` (by default its file name), copying only the chunks the store doesn't have yet.
+    # A different file already stored under the same name is only replaced with `force`. Returns the number of bytes copied.
+    def add(self, model: Path, threads: int, name: str | None = None, force: bool = False) -> int:
+        name = name if name is not None else model.name
+        index_path = self.index_path(name)
+        old_index = read_index(index_path) if index_path.exists() else None
+        if old_index is not None and not force and old_index["size"] != model.stat().st_size:
+            raise FileExistsError(f"A different file is already stored as {name}, use --name to store {model} under another name, or --force to replace it")
+        self.models_dir.mkdir(parents=True, exist_ok=True)
+        copied = 0
+        lock = threading.Lock()
+
+        def store_chunk(entry: dict[str, Any]) -> None:
+            nonlocal copied
+            obj = self.object_path(entry["sha256"])
+            if obj.exists():
+                return
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            # the same chunk can be stored by two threads at once, the object is only replaced by the same content
+            fd, tmp_name = tempfile.mkstemp(dir=obj.parent, prefix=f".{obj.name}.", suffix=".tmp")
+            try:
+                with open(model, "rb") as fin, os.fdopen(fd, "wb") as fout:
+                    gguf.copy_file_data(fin, fout, entry["offset"], 0, entry["nbytes"])
+                os.replace(tmp_name, obj)
+            except BaseException:
+                os.unlink(tmp_name)
+                raise
+            with lock:
+                copied += entry["nbytes"]
+
+        index = make_index(model, threads, store_chunk)
+        if old_index is not None and not force and old_index["chunks"] != index["chunks"]:
+            # the chunks which were copied are kept, they may be used by the file once it's stored under another name
+            raise FileExistsError(f"A different file is already stored as {name}, use --name to store {model} under another name, or --force to replace it")
+        # the index is written last, a file is only in the store once all its chunks are
+        write_json(index, index_path)
+        return copied
+
+    # Writes a file of the store back, byte for byte.
+    def rebuild(self, name: str, outfile: Path, threads: int, verify: bool = False) -> None:
+        index = read_index(self.index_path(name))
+        missing = [entry["name"] for entry in index["chunks"] if not self.object_path(entry["sha256"]).exists()]
+        if missing:
+            raise FileNotFoundError(f"The store is missing the data of {len(missing)} chunk(s) of {name}, e.g. {missing[0]!r}")
+
+        fd, tmp_name = tempfile.mkstemp(dir=outfile.parent, prefix=f".{outfile.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                # the padding which isn't in any chunk is zeros
+                f.truncate(index["size"])
+
+            def copy_chunk(entry: dict[str, Any]) -> None:
+                # one file object per copy, the fallbacks of copy_file_data seek
+                with open(self.object_path(entry["sha256"]), "rb") as fin, open(tmp_name, "r+b") as fout:
+                    gguf.copy_file_data(fin, fout, 0, entry["offset"], entry["nbytes"])
+                pbar.update(entry["nbytes"])
+
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                with tqdm(total=sum(entry["nbytes"] for entry in index["chunks"]), desc=f"Rebuilding {name}", unit="byte", unit_scale=True) as pbar:
+                    for _ in executor.map(copy_chunk, index["chunks"]):
+                        pass
+
+            if verify:
+                rebuilt = make_index(Path(tmp_name), threads)
+                if rebuilt["chunks"] != index["chunks"]:
+                    raise ValueError(f"The rebuilt {name} doesn't match its index")
+            with open(tmp_name, "rb+") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_name, outfile)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+
+
+def do_index(args: argparse.Namespace) -> None:
+    for model in args.model:
+        output = Path(f"{model}.index.json")
+        logger.info(f"* Indexing {model}")
+        write_json(make_index(Path(model), args.threads), output)
+        logger.info(f"* Wrote {output}")
+
+
+def do_store(args: argparse.Namespace) -> None:
+    if args.name is not None and len(args.model) > 1:
+        logger.error("--name can only be used when storing a single model")
+        sys.exit(1)
+    store = TensorStore(Path(args.store))
+    for model in args.model:
+        model = Path(model)
+        size = model.stat().st_size
+        logger.info(f"* Adding {model} to {store.path}")
+        try:
+            copied = store.add(model, args.threads, name=args.name, force=args.force)
+        except FileExistsError as e:
+            logger.error(e)
+            sys.exit(1)
+        logger.info(f"* Stored {copied} of {size} bytes, {size - copied} bytes were already in the store")
+
+
+def do_rebuild(args: argparse.Namespace) -> None:
+    store = TensorStore(Path(args.store))
+    outfile = Path(args.outfile if args.outfile is not None else args.name)
+    logger.info(f"* Rebuilding {args.name} from {store.path}")
+    store.rebuild(args.name, outfile, args.threads, verify=args.verify)
+    logger.info(f"* Wrote {outfile}")
+
+
+def do_list(args: argparse.Namespace) -> None:
+    store = TensorStore(Path(args.store))
+    objects = set()
+    total = 0
+    for name in store.models():
+        index = read_index(store.index_path(name))
+        objects.update((entry["sha256"], entry["nbytes"]) for entry in index["chunks"])
+        total += index["size"]
+        print(f"{index['size']:15} | {name}")  # noqa: NP100
+    stored = sum(nbytes for _, nbytes in objects)
+    print(f"* {total} bytes of models in {stored} bytes of unique chunks")  # noqa: NP100
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Hash the tensors of GGUF files, and store them with identical tensors only stored once")
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1, help="number of threads hashing and copying (default: number of CPUs)")
+    parser.add_argument("--verbose", action="store_true", help="increase output verbosity")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    index_parser = subparsers.add_parser("index", help="write the sha256 of the header and of each tensor of GGUF files to <model>.index.json")
+    index_parser.add_argument("model", type=str, nargs="+", help="GGUF format model filename(s)")
+    index_parser.set_defaults(func=do_index)
+
+    store_parser = subparsers.add_parser("store", help="add GGUF files to a store, only the tensors it doesn't have yet are copied")
+    store_parser.add_argument("store", type=str, help="store directory, created if needed")
+    store_parser.add_argument("model", type=str, nargs="+", help="GGUF format model filename(s)")
+    store_parser.add_argument("--name", type=str, default=None, help="name of the model in the store (default: its file name), with a single model")
+    store_parser.add_argument("--force", action="store_true", help="replace a different model already stored under the same name")
+    store_parser.set_defaults(func=do_store)
+
+    rebuild_parser = subparsers.add_parser("rebuild", help="write a GGUF file of a store back")
+    rebuild_parser.add_argument("store", type=str, help="store directory")
+    rebuild_parser.add_argument("name", type=str, help="name of the model in the store, see list")
+    rebuild_parser.add_argument("--outfile", type=str, default=None, help="output filename (default: the name of the model)")
+    rebuild_parser.add_argument("--verify", action="store_true", help="hash the rebuilt file and check it against the index")
+    rebuild_parser.set_defaults(func=do_rebuild)
+
+    list_parser = subparsers.add_parser("list", help="list the models of a store and how much space they take")
+    list_parser.add_argument("store", type=str, help="store directory")
+    list_parser.set_defaults(func=do_list)
+
+    args = parser.parse_args(None if len(sys.argv) > 1 else ["--help"])
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,15 @@ from __future__ import annotations
 
 import logging
 import argparse
+import contextlib
+import hashlib
+import io
+import json
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 import numpy as np
 
@@ -14,7 +19,7 @@ import numpy as np
 if "NO_LOCAL_GGUF" not in os.environ and (Path(__file__).parent.parent.parent / 'gguf-py').exists():
     sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from gguf import GGUFReader, GGUFValueType  # noqa: E402
+from gguf import GGUFReader, GGUFValueType, ReaderField  # noqa: E402
 
 logger = logging.getLogger("gguf-dump")
 
@@ -30,19 +35,21 @@ def get_file_host_endian(reader: GGUFReader) -> tuple[str, str]:
 
 # For more information about what field.parts and field.data represent,
 # please see the comments in the modify_gguf.py example.
+def get_pretty_type(field: ReaderField) -> str:
+    if not field.types:
+        return 'N/A'
+    if field.types[0] == GGUFValueType.ARRAY:
+        nest_count = len(field.types) - 1
+        return '[' * nest_count + str(field.types[-1].name) + ']' * nest_count
+    return str(field.types[-1].name)
+
+
 def dump_metadata(reader: GGUFReader, args: argparse.Namespace) -> None:
     host_endian, file_endian = get_file_host_endian(reader)
     print(f'* File is {file_endian} endian, script is running on a {host_endian} endian host.')  # noqa: NP100
     print(f'* Dumping {len(reader.fields)} key/value pair(s)')  # noqa: NP100
     for n, field in enumerate(reader.fields.values(), 1):
-        if not field.types:
-            pretty_type = 'N/A'
-        elif field.types[0] == GGUFValueType.ARRAY:
-            nest_count = len(field.types) - 1
-            pretty_type = '[' * nest_count + str(field.types[-1].name) + ']' * nest_count
-        else:
-            pretty_type = str(field.types[-1].name)
-
+        pretty_type = get_pretty_type(field)
         log_message = f'  {n:5}: {pretty_type:10} | {len(field.data):8} | {field.name}'
         if len(field.types) == 1:
             curr_type = field.types[0]
@@ -59,13 +66,12 @@ def dump_metadata(reader: GGUFReader, args: argparse.Namespace) -> None:
         print(f'  {n:5}: {tensor.n_elements:10} | {prettydims} | {tensor.tensor_type.name:7} | {tensor.name}')  # noqa: NP100
 
 
-def dump_metadata_json(reader: GGUFReader, args: argparse.Namespace) -> None:
-    import json
+def dump_metadata_json(reader: GGUFReader, args: argparse.Namespace, filename: str) -> None:
     host_endian, file_endian = get_file_host_endian(reader)
     metadata: dict[str, Any] = {}
     tensors: dict[str, Any] = {}
     result = {
-        "filename": args.model,
+        "filename": filename,
         "endian": file_endian,
         "metadata": metadata,
         "tensors": tensors,
@@ -81,15 +87,7 @@ def dump_metadata_json(reader: GGUFReader, args: argparse.Namespace) -> None:
             curr["array_types"] = [t.name for t in field.types][1:]
             if not args.json_array:
                 continue
-            itype = field.types[-1]
-            if itype == GGUFValueType.STRING:
-                curr["value"] = [str(bytes(field.parts[idx]), encoding="utf-8") for idx in field.data]
-            else:
-                curr["value"] = [pv for idx in field.data for pv in field.parts[idx].tolist()]
-        elif field.types[0] == GGUFValueType.STRING:
-            curr["value"] = str(bytes(field.parts[-1]), encoding="utf-8")
-        else:
-            curr["value"] = field.parts[-1].tolist()[0]
+        curr["value"] = field.contents()
     if not args.no_tensors:
         for idx, tensor in enumerate(reader.tensors):
             tensors[tensor.name] = {
@@ -101,27 +99,144 @@ def dump_metadata_json(reader: GGUFReader, args: argparse.Namespace) -> None:
     json.dump(result, sys.stdout)
 
 
+# Runs in the worker processes: the output of one file, as text.
+def dump_file(path: str, args: argparse.Namespace) -> str:
+    # only what gets dumped is decoded
+    reader = GGUFReader(path, 'r', lazy=True)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        if args.json:
+            dump_metadata_json(reader, args, path)
+            print()  # noqa: NP100
+        else:
+            # the outputs of several files follow each other on stdout
+            print(f'* File: {path}')  # noqa: NP100
+            dump_metadata(reader, args)
+    return out.getvalue()
+
+
+# One row per tensor, from the tensor infos only.
+# The offsets are relative to the start of the tensor data, they don't move when only the metadata changes.
+def tensor_rows(path: str) -> list[dict[str, Any]]:
+    reader = GGUFReader(path, 'r', lazy=True)
+    return [{
+        "file": path,
+        "index": idx,
+        "name": tensor.name,
+        "type": tensor.tensor_type.name,
+        "shape": tensor.shape.tolist(),
+        "n_elements": tensor.n_elements,
+        "n_bytes": tensor.n_bytes,
+        "offset": tensor.data_offset - reader.data_offset,
+    } for idx, tensor in enumerate(reader.tensors)]
+
+
+# What --diff compares: the type and value of each key, and the type, shape and offset of each tensor.
+# Arrays are only compared through a digest of their contents, so that big vocabs aren't sent between processes.
+def summarize_file(path: str) -> dict[str, Any]:
+    reader = GGUFReader(path, 'r', lazy=True)
+    metadata: dict[str, Any] = {}
+    for field in reader.fields.values():
+        value = field.contents()
+        if field.types[:1] == [GGUFValueType.ARRAY]:
+            digest = hashlib.sha256(json.dumps(value).encode('utf-8')).hexdigest()
+            value = f'<{len(value)} items, sha256 {digest[:16]}>'
+        metadata[field.name] = {"type": get_pretty_type(field), "value": value}
+    tensors = {row["name"]: {k: row[k] for k in ("type", "shape", "offset")} for row in tensor_rows(path)}
+    return {"metadata": metadata, "tensors": tensors}
+
+
+def diff_entries(a: dict[str, Any], b: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "removed": [key for key in a if key not in b],
+        "added": [key for key in b if key not in a],
+        "changed": {key: [a[key], b[key]] for key in a if key in b and a[key] != b[key]},
+    }
+
+
+def diff_files(a: dict[str, Any], b: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "metadata": diff_entries(a["metadata"], b["metadata"]),
+        "tensors": diff_entries(a["tensors"], b["tensors"]),
+    }
+
+
+def print_diff(diff: dict[str, Any], path_a: str, path_b: str) -> None:
+    print(f'--- {path_a}')  # noqa: NP100
+    print(f'+++ {path_b}')  # noqa: NP100
+    for section, describe in (("metadata", lambda v: f'{v["type"]} = {v["value"]!r}'),
+                              ("tensors", lambda v: f'{v["type"]} {v["shape"]} @ {v["offset"]}')):
+        entries = diff[section]
+        n_changes = len(entries["removed"]) + len(entries["added"]) + len(entries["changed"])
+        print(f'* {n_changes} {"key/value pair" if section == "metadata" else "tensor"}(s) differ')  # noqa: NP100
+        for key in entries["removed"]:
+            print(f'  - {key}')  # noqa: NP100
+        for key in entries["added"]:
+            print(f'  + {key}')  # noqa: NP100
+        for key, (old, new) in entries["changed"].items():
+            print(f'  ~ {key}: {describe(old)} -> {describe(new)}')  # noqa: NP100
+
+
+def write_parquet(rows: list[dict[str, Any]], path: str) -> None:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        logger.error('pyarrow is needed for --parquet, install it with: pip install pyarrow')
+        sys.exit(1)
+    pq.write_table(pa.Table.from_pylist(rows), path)
+
+
+# Applies func to each file in a process pool, the results are in the order of the files.
+def map_files(func: Callable[..., Any], paths: list[str], jobs: int, *args: Any) -> list[Any]:
+    if jobs <= 1 or len(paths) <= 1:
+        return [func(path, *args) for path in paths]
+    with ProcessPoolExecutor(max_workers=min(jobs, len(paths))) as executor:
+        return list(executor.map(func, paths, *([arg] * len(paths) for arg in args)))
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(description="Dump GGUF file metadata")
-    parser.add_argument("model",           type=str,            help="GGUF format model filename")
+    parser.add_argument("model",        type=str, nargs="+", help="GGUF format model filename(s)")
     parser.add_argument("--no-tensors", action="store_true", help="Don't dump tensor metadata")
-    parser.add_argument("--json",       action="store_true", help="Produce JSON output")
+    parser.add_argument("--json",       action="store_true", help="Produce JSON output, one line per file with several files")
     parser.add_argument("--json-array", action="store_true", help="Include full array values in JSON output (long)")
+    parser.add_argument("--ndjson",     action="store_true", help="Only dump the tensor table of all the files, as one JSON object per line")
+    parser.add_argument("--parquet",    type=str, metavar="PATH", help="Write the tensor table of all the files to a Parquet file (needs pyarrow)")
+    parser.add_argument("--diff",       action="store_true", help="Compare the metadata and the tensor infos of two files, without reading the tensor data")
+    parser.add_argument("--jobs",       type=int, default=os.cpu_count() or 1, help="Number of files scanned at once (default: number of CPUs)")
     parser.add_argument("--verbose",    action="store_true", help="increase output verbosity")
 
     args = parser.parse_args(None if len(sys.argv) > 1 else ["--help"])
 
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 
-    if not args.json:
-        logger.info(f'* Loading: {args.model}')
+    if args.diff:
+        if len(args.model) != 2:
+            parser.error("--diff needs exactly two files")
+        summary_a, summary_b = map_files(summarize_file, args.model, args.jobs)
+        diff = diff_files(summary_a, summary_b)
+        if args.json:
+            json.dump(diff, sys.stdout)
+        else:
+            print_diff(diff, *args.model)
+        return
 
-    reader = GGUFReader(args.model, 'r')
+    if args.ndjson or args.parquet:
+        rows = [row for file_rows in map_files(tensor_rows, args.model, args.jobs) for row in file_rows]
+        if args.parquet:
+            write_parquet(rows, args.parquet)
+        if args.ndjson:
+            for row in rows:
+                print(json.dumps(row))  # noqa: NP100
+        return
 
-    if args.json:
-        dump_metadata_json(reader, args)
-    else:
-        dump_metadata(reader, args)
+    if not args.json:
+        for path in args.model:
+            logger.info(f'* Loading: {path}')
+
+    for output in map_files(dump_file, args.model, args.jobs, args):
+        sys.stdout.write(output)
 
 
 if __name__ == '__main__':
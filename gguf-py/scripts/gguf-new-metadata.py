@@ -2,8 +2,10 @@
 import logging
 import argparse
 import os
+import shutil
 import sys
 import json
+import tempfile
 from pathlib import Path
 
 import numpy as np
@@ -18,6 +20,11 @@ import gguf
 
 logger = logging.getLogger("gguf-new-metadata")
 
+# Unused space in the metadata, so that it can grow without moving the tensor data (see rewrite_metadata_in_place).
+PADDING_KEY = 'general.padding'
+# size of the padding field without its value: key length, key, value type and string length
+PADDING_OVERHEAD = 8 + len(PADDING_KEY) + 4 + 8
+
 
 class MetadataDetails(NamedTuple):
     type: gguf.GGUFValueType
@@ -75,13 +82,28 @@ def find_token(token_list: Sequence[int], token: str) -> Sequence[int]:
     return token_ids
 
 
-def copy_with_new_metadata(reader: gguf.GGUFReader, writer: gguf.GGUFWriter, new_metadata: dict[str, MetadataDetails], remove_metadata: Sequence[str]) -> None:
+def make_writer(reader: gguf.GGUFReader, path: os.PathLike[str] | str) -> gguf.GGUFWriter:
+    writer = gguf.GGUFWriter(path, arch=get_field_data(reader, gguf.Keys.General.ARCHITECTURE), endianess=get_byteorder(reader))
+
+    alignment = get_field_data(reader, gguf.Keys.General.ALIGNMENT)
+    if alignment is not None:
+        logger.debug(f'Setting custom alignment: {alignment}')
+        writer.data_alignment = alignment
+
+    return writer
+
+
+def add_new_metadata(reader: gguf.GGUFReader, writer: gguf.GGUFWriter, new_metadata: dict[str, MetadataDetails], remove_metadata: Sequence[str]) -> None:
     for field in reader.fields.values():
         # Suppress virtual fields and fields written by GGUFWriter
         if field.name == gguf.Keys.General.ARCHITECTURE or field.name.startswith('GGUF.'):
             logger.debug(f'Suppressing {field.name}')
             continue
 
+        # The padding is sized again for the new metadata
+        if field.name == PADDING_KEY:
+            continue
+
         # Skip old chat templates if we have new ones
         if field.name.startswith(gguf.Keys.Tokenizer.CHAT_TEMPLATE) and gguf.Keys.Tokenizer.CHAT_TEMPLATE in new_metadata:
             logger.debug(f'Skipping {field.name}')
@@ -114,34 +136,92 @@ def copy_with_new_metadata(reader: gguf.GGUFReader, writer: gguf.GGUFWriter, new
         writer.add_key(key)
         writer.add_val(val.value, val.type)
 
-    total_bytes = 0
-
     for tensor in reader.tensors:
-        total_bytes += tensor.n_bytes
         # Dimensions are written in reverse order, so flip them first
         shape = np.flipud(tensor.shape).tolist()
+        if tensor.data.dtype == np.uint8:
+            # the rows of quantized tensors are given in bytes
+            block_size, type_size = gguf.GGML_QUANT_SIZES[tensor.tensor_type]
+            shape[-1] = shape[-1] // block_size * type_size
         writer.add_tensor_info(tensor.name, shape, tensor.data.dtype, tensor.data.nbytes, tensor.tensor_type)
 
+
+def copy_with_new_metadata(reader: gguf.GGUFReader, writer: gguf.GGUFWriter, new_metadata: dict[str, MetadataDetails], remove_metadata: Sequence[str], header_padding: int = 0) -> None:
+    add_new_metadata(reader, writer, new_metadata, remove_metadata)
+    if header_padding > 0:
+        writer.add_string(PADDING_KEY, ' ' * header_padding)
+
+    total_bytes = sum(tensor.n_bytes for tensor in reader.tensors)
     bar = tqdm(desc="Writing", total=total_bytes, unit="byte", unit_scale=True)
 
     writer.write_header_to_file()
     writer.write_kv_data_to_file()
     writer.write_ti_data_to_file()
 
+    # the tensor data is copied by the kernel, without going through this process
+    assert reader.data.filename is not None
     for tensor in reader.tensors:
-        writer.write_tensor_data(tensor.data)
+        writer.copy_tensor_data(tensor.name, reader.data.filename, tensor.data_offset)
         bar.update(tensor.n_bytes)
 
     writer.close()
 
 
+# When the new metadata and tensor infos fit before the tensor data, only they are written, in place,
+# followed by a padding field taking up the rest of the space. Returns False when they don't fit.
+# Unlike the rest of the file, the metadata isn't written atomically.
+def rewrite_metadata_in_place(reader: gguf.GGUFReader, writer: gguf.GGUFWriter, path: os.PathLike[str] | str) -> bool:
+    # the tensor data must stay where it is
+    for tensor, info in zip(reader.tensors, writer.tensor_infos.values()):
+        if reader.data_offset + info.offset != tensor.data_offset:
+            return False
+
+    header = writer.header_data()
+    if writer.ggml_pad(len(header), writer.data_alignment) != reader.data_offset:
+        padding = reader.data_offset - len(header) - PADDING_OVERHEAD
+        if padding < 0:
+            return False
+        writer.add_string(PADDING_KEY, ' ' * padding)
+        header = writer.header_data()
+        assert len(header) == reader.data_offset
+
+    with open(path, 'r+b') as f:
+        f.write(header)
+        f.write(bytes(reader.data_offset - len(header)))
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+
+def edit_in_place(reader: gguf.GGUFReader, path: Path, new_metadata: dict[str, MetadataDetails], remove_metadata: Sequence[str], header_padding: int = 0) -> None:
+    writer = make_writer(reader, path)
+    add_new_metadata(reader, writer, dict(new_metadata), remove_metadata)
+    if rewrite_metadata_in_place(reader, writer, path):
+        logger.info('* Rewrote the metadata in place')
+        return
+
+    # The file is written again next to the original, which it only replaces once complete.
+    logger.info('* The new metadata doesn\'t fit before the tensor data, moving the tensor data')
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        copy_with_new_metadata(reader, make_writer(reader, tmp_name), new_metadata, remove_metadata, header_padding)
+        with open(tmp_name, 'rb+') as f:
+            os.fsync(f.fileno())
+        shutil.copymode(path, tmp_name)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
 def main() -> None:
     tokenizer_metadata = (getattr(gguf.Keys.Tokenizer, n) for n in gguf.Keys.Tokenizer.__dict__.keys() if not n.startswith('_'))
     token_names = dict((n.split('.')[-1][:-len('_token_id')], n) for n in tokenizer_metadata if n.endswith('_token_id'))
 
-    parser = argparse.ArgumentParser(description="Make a copy of a GGUF file with new metadata")
+    parser = argparse.ArgumentParser(description="Make a copy of a GGUF file with new metadata, or edit its metadata in place")
     parser.add_argument("input",                                       type=Path, help="GGUF format model input filename")
-    parser.add_argument("output",                                      type=Path, help="GGUF format model output filename")
+    parser.add_argument("output",                                      type=Path, help="GGUF format model output filename, the same as the input to edit it in place (only the metadata is rewritten when it fits before the tensor data)")
     parser.add_argument("--general-name",                              type=str,  help="The models general.name", metavar='"name"')
     parser.add_argument("--general-description",                       type=str,  help="The models general.description", metavar='"Description ..."')
     parser.add_argument("--chat-template",                             type=str,  help="Chat template string (or JSON string containing templates)", metavar='"{% ... %} ..."')
@@ -149,6 +229,7 @@ def main() -> None:
     parser.add_argument("--remove-metadata",      action="append",     type=str,  help="Remove metadata (by key name) from output model", metavar='general.url')
     parser.add_argument("--special-token",        action="append",     type=str,  help="Special token by value", nargs=2, metavar=(' | '.join(token_names.keys()), '"<token>"'))
     parser.add_argument("--special-token-by-id",  action="append",     type=str,  help="Special token by id", nargs=2, metavar=(' | '.join(token_names.keys()), '0'))
+    parser.add_argument("--header-padding",       type=int,  default=0,           help="Bytes of padding to reserve in the metadata of a written file, so that later in-place edits can grow the metadata by as much without moving the tensor data", metavar='4096')
     parser.add_argument("--force",                action="store_true",            help="Bypass warnings without confirmation")
     parser.add_argument("--verbose",              action="store_true",            help="Increase output verbosity")
     args = parser.parse_args(None if len(sys.argv) > 2 else ["--help"])
@@ -189,9 +270,6 @@ def main() -> None:
     logger.info(f'* Loading: {args.input}')
     reader = gguf.GGUFReader(args.input, 'r')
 
-    arch = get_field_data(reader, gguf.Keys.General.ARCHITECTURE)
-    endianess = get_byteorder(reader)
-
     token_list = get_field_data(reader, gguf.Keys.Tokenizer.LIST) or []
 
     for name, token in args.special_token or []:
@@ -218,7 +296,9 @@ def main() -> None:
             else:
                 raise LookupError(f'Token ID {id_int} is not within token list!')
 
-    if os.path.isfile(args.output) and not args.force:
+    in_place = args.output.exists() and args.output.samefile(args.input)
+
+    if os.path.isfile(args.output) and not in_place and not args.force:
         logger.warning('*** Warning *** Warning *** Warning **')
         logger.warning(f'* The "{args.output}" GGUF file already exists, it will be overwritten!')
         logger.warning('* Enter exactly YES if you are positive you want to proceed:')
@@ -227,15 +307,12 @@ def main() -> None:
             logger.info("You didn't enter YES. Okay then, see ya!")
             sys.exit(0)
 
-    logger.info(f'* Writing: {args.output}')
-    writer = gguf.GGUFWriter(args.output, arch=arch, endianess=endianess)
-
-    alignment = get_field_data(reader, gguf.Keys.General.ALIGNMENT)
-    if alignment is not None:
-        logger.debug(f'Setting custom alignment: {alignment}')
-        writer.data_alignment = alignment
-
-    copy_with_new_metadata(reader, writer, new_metadata, remove_metadata)
+    if in_place:
+        logger.info(f'* Editing in place: {args.output}')
+        edit_in_place(reader, args.output, new_metadata, remove_metadata, args.header_padding)
+    else:
+        logger.info(f'* Writing: {args.output}')
+        copy_with_new_metadata(reader, make_writer(reader, args.output), new_metadata, remove_metadata, args.header_padding)
 
 
 if __name__ == '__main__':
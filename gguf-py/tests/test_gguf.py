@@ -1,3 +1,23 @@
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import io
+import json
+import pickle
+import shutil
+import struct
+import subprocess
+import sys
+import types
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, NamedTuple
+
+import numpy as np
+import pytest
+
 import gguf  # noqa: F401
 
 # TODO: add tests
@@ -5,3 +25,859 @@ import gguf  # noqa: F401
 
 def test_write_gguf() -> None:
     pass
+
+
+def _write_example(path: Path, tensors: dict[str, np.ndarray], streaming: bool) -> None:
+    writer = gguf.GGUFWriter(path, "llama")
+    writer.add_block_count(1)
+    if streaming:
+        for name, tensor in tensors.items():
+            writer.add_tensor_info(name, tensor.shape, tensor.dtype, tensor.nbytes)
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_ti_data_to_file()
+        # the data can be written in any order once the tensor infos are known
+        for name in reversed(list(tensors)):
+            writer.add_tensor(name, tensors[name])
+    else:
+        for name, tensor in tensors.items():
+            writer.add_tensor(name, tensor)
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_tensors_to_file()
+    writer.close()
+
+
+def test_streaming_writer(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    tensors = {f"blk.{i}.ffn_up.weight": rng.standard_normal((i + 3, 7), dtype=np.float32) for i in range(4)}
+
+    _write_example(tmp_path / "buffered.gguf", tensors, streaming=False)
+    _write_example(tmp_path / "streamed.gguf", tensors, streaming=True)
+
+    assert (tmp_path / "buffered.gguf").read_bytes() == (tmp_path / "streamed.gguf").read_bytes()
+
+    reader = gguf.GGUFReader(tmp_path / "streamed.gguf")
+    for tensor in reader.tensors:
+        np.testing.assert_array_equal(tensor.data.reshape(tensors[tensor.name].shape), tensors[tensor.name])
+
+
+def test_streaming_writer_mixed(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    tensors = {f"blk.{i}.ffn_up.weight": rng.standard_normal((i + 3, 7), dtype=np.float32) for i in range(4)}
+    _write_example(tmp_path / "buffered.gguf", tensors, streaming=False)
+
+    names = list(tensors)
+    for use_temp_file in (False, True):
+        path = tmp_path / f"mixed-{use_temp_file}.gguf"
+        writer = gguf.GGUFWriter(path, "llama", use_temp_file=use_temp_file)
+        writer.add_block_count(1)
+        # some tensors are added with their data before the header is written, e.g. rope factors
+        for name in names:
+            if name in names[::2]:
+                writer.add_tensor(name, tensors[name])
+            else:
+                writer.add_tensor_info(name, tensors[name].shape, tensors[name].dtype, tensors[name].nbytes)
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_ti_data_to_file()
+        for name in names[1::2]:
+            writer.write_tensor_data(tensors[name], name=name)
+        writer.close()
+
+        assert path.read_bytes() == (tmp_path / "buffered.gguf").read_bytes()
+
+
+def test_pack_arrays(tmp_path: Path) -> None:
+    writer = gguf.GGUFWriter(tmp_path / "be.gguf", "llama", endianess=gguf.GGUFEndian.BIG)
+    assert writer._pack_val(["ab", b"\xff"]) == bytes.fromhex("00000009 00000008 0000000000000002 0000000000000002") + b"ab" + bytes.fromhex("0000000000000001 ff")
+    assert writer._pack_val([1, -2], add_vtype=False) == bytes.fromhex("00000005 0000000000000002 00000001 fffffffe")
+    # the same errors as when packing the items one by one
+    with pytest.raises(struct.error):
+        writer._pack_val([2**31])
+    with pytest.raises(OverflowError):
+        writer._pack_val([1e39])
+    with pytest.raises(ValueError):
+        writer._pack_val([1, 2.0])
+
+    tokens = [f"tok{i}ü" for i in range(1000)]
+    writer = gguf.GGUFWriter(tmp_path / "le.gguf", "llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores([float(-i) for i in range(1000)])
+    writer.add_token_types([gguf.TokenType.NORMAL] * 999 + [gguf.TokenType.CONTROL])
+    writer.add_array("test.bools", [True, False])
+    writer.add_array("test.nested", [[1, 2], ["a"]])
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.close()
+
+    reader = gguf.GGUFReader(tmp_path / "le.gguf")
+    field = reader.fields[gguf.Keys.Tokenizer.LIST]
+    assert [bytes(field.parts[i]).decode() for i in field.data] == tokens
+    field = reader.fields[gguf.Keys.Tokenizer.TOKEN_TYPE]
+    assert [int(field.parts[i][0]) for i in field.data][-2:] == [gguf.TokenType.NORMAL, gguf.TokenType.CONTROL]
+    field = reader.fields["test.bools"]
+    assert [bool(field.parts[i][0]) for i in field.data] == [True, False]
+
+
+def test_header_data(tmp_path: Path) -> None:
+    tensors = {"a": np.ones((3, 5), dtype=np.float32), "b": np.zeros(7, dtype=np.float16)}
+    writer = gguf.GGUFWriter(tmp_path / "model.gguf", "llama")
+    writer.add_chat_template("{{ messages }}")
+    for name, tensor in tensors.items():
+        writer.add_tensor_info(name, tensor.shape, tensor.dtype, tensor.nbytes)
+    header = writer.header_data()
+    # nothing is written until write_header_to_file
+    assert not (tmp_path / "model.gguf").exists()
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_ti_data_to_file()
+    for name, tensor in tensors.items():
+        writer.write_tensor_data(tensor, name)
+    writer.close()
+
+    assert (tmp_path / "model.gguf").read_bytes()[:len(header)] == header
+    assert gguf.GGUFReader(tmp_path / "model.gguf").data_offset == writer.ggml_pad(len(header), writer.data_alignment)
+
+
+def _reference_q8_0(data: np.ndarray) -> np.ndarray:
+    # straightforward port of quantize_row_q8_0_reference from ggml-quants.c
+    blocks = data.reshape((-1, 32)).astype(np.float32)
+    d = abs(blocks).max(axis=1, keepdims=True) / 127
+    with np.errstate(divide="ignore"):
+        id = np.where(d == 0, 0, 1 / d)
+    qs = gguf.np_roundf(blocks * id).astype(np.int8)
+    out = np.concatenate([d.astype(np.float16).view(np.uint8), qs.view(np.uint8)], axis=1)
+    return out.reshape((*data.shape[:-1], data.shape[-1] // 32 * 34))
+
+
+def test_quantize_q8_0_threads() -> None:
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((600, 4096), dtype=np.float32)
+    data[0] = 0
+    data[1] = np.round(data[1] * 100) / 2  # exact halves, to check the rounding
+
+    expected = _reference_q8_0(data)
+    for n_threads in (1, 3):
+        np.testing.assert_array_equal(gguf.quantize_q8_0(data, n_threads=n_threads), expected)
+
+
+def _reference_q4_q5_block(x: np.ndarray, qtype: gguf.GGMLQuantizationType) -> bytes:
+    # straightforward port of quantize_row_q4_0_reference, q4_1, q5_0 and q5_1 from ggml-quants.c
+    f32 = np.float32
+    nmax = 15 if qtype in (gguf.GGMLQuantizationType.Q4_0, gguf.GGMLQuantizationType.Q4_1) else 31
+    symmetric = qtype in (gguf.GGMLQuantizationType.Q4_0, gguf.GGMLQuantizationType.Q5_0)
+    if symmetric:
+        amax, vmax = f32(0), f32(0)
+        for v in x:
+            if amax < abs(v):
+                amax, vmax = abs(v), v
+        d = vmax / f32(-(nmax + 1) // 2)
+        vmin = f32(0)
+        offset = f32(nmax // 2 + 1.5)
+    else:
+        vmin, vmax = f32(np.finfo(np.float32).max), f32(-np.finfo(np.float32).max)
+        for v in x:
+            if v < vmin:
+                vmin = v
+            if v > vmax:
+                vmax = v
+        d = (vmax - vmin) / f32(nmax)
+        offset = f32(0.5)
+    id = f32(1) / d if d else f32(0)
+    qi = [min(int((v - vmin) * id + offset), nmax) for v in x]
+
+    out = np.float16(d).tobytes()
+    if not symmetric:
+        out += np.float16(vmin).tobytes()
+    if nmax == 31:
+        qh = sum(((q >> 4) & 1) << j for j, q in enumerate(qi))
+        out += qh.to_bytes(4, "little")
+    return out + bytes((qi[j] & 0xF) | ((qi[j + 16] & 0xF) << 4) for j in range(16))
+
+
+def test_quantize_q4_q5() -> None:
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((8, 256), dtype=np.float32)
+    data[0] = 0
+    data[1] = rng.integers(-8, 8, 256) / 2  # ties for the min and max
+    data[2, :32] = 1
+
+    for qtype in (gguf.GGMLQuantizationType.Q4_0, gguf.GGMLQuantizationType.Q4_1,
+                  gguf.GGMLQuantizationType.Q5_0, gguf.GGMLQuantizationType.Q5_1):
+        expected = b"".join(_reference_q4_q5_block(block, qtype) for block in data.reshape((-1, 32)))
+        assert gguf.quantize(data, qtype).tobytes() == expected, qtype.name
+
+
+def test_quantize_from_bf16() -> None:
+    BF16 = gguf.GGMLQuantizationType.BF16
+    # every bf16 value, including the NaNs, infinities and subnormals
+    bits = np.arange(1 << 16, dtype=np.uint32).astype(np.uint16).reshape((-1, 64))
+    np.testing.assert_array_equal(gguf.quantize_bf16(bits, src_qtype=BF16), gguf.quantize_bf16(gguf.dequantize(bits, BF16)))
+
+    rng = np.random.default_rng(0)
+    bits = gguf.quantize_bf16(rng.standard_normal((600, 4096), dtype=np.float32))
+    for qtype in (gguf.GGMLQuantizationType.Q8_0, gguf.GGMLQuantizationType.Q4_1):
+        expected = gguf.quantize(gguf.dequantize(bits, BF16), qtype)
+        for n_threads in (1, 3):
+            np.testing.assert_array_equal(gguf.quantize(bits, qtype, n_threads=n_threads, src_qtype=BF16), expected)
+
+
+def test_reader_to_float(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((32, 64), dtype=np.float32)
+    qtypes = (gguf.GGMLQuantizationType.Q8_0, gguf.GGMLQuantizationType.Q4_0, gguf.GGMLQuantizationType.Q4_1,
+              gguf.GGMLQuantizationType.Q5_0, gguf.GGMLQuantizationType.Q5_1)
+
+    writer = gguf.GGUFWriter(tmp_path / "quants.gguf", "llama")
+    writer.add_tensor("f32", data)
+    writer.add_tensor("f16", data.astype(np.float16))
+    writer.add_tensor("bf16", gguf.quantize_bf16(data), raw_dtype=gguf.GGMLQuantizationType.BF16)
+    for qtype in qtypes:
+        writer.add_tensor(qtype.name, gguf.quantize(data, qtype), raw_dtype=qtype)
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+    reader = gguf.GGUFReader(tmp_path / "quants.gguf")
+    tensors = {tensor.name: tensor for tensor in reader.tensors}
+    np.testing.assert_array_equal(tensors["f32"].to_float(), data)
+    np.testing.assert_array_equal(tensors["f16"].to_float(), data.astype(np.float16).astype(np.float32))
+    np.testing.assert_allclose(tensors["bf16"].to_float(), data, rtol=1 / 128)
+    for qtype in qtypes:
+        values = tensors[qtype.name].to_float()
+        assert values.shape == data.shape
+        # dequantized values are quantized back to the same blocks
+        np.testing.assert_array_equal(gguf.quantize(values, qtype), gguf.quantize(data, qtype))
+        np.testing.assert_array_equal(tensors[qtype.name].to_float(rows=slice(2, 4)), values[2:4])
+
+
+def test_lazy_reader(tmp_path: Path) -> None:
+    tokens = [f"tok{i} é" for i in range(100)]
+    writer = gguf.GGUFWriter(tmp_path / "vocab.gguf", "llama")
+    writer.add_token_list(tokens)
+    writer.add_token_scores([float(i) for i in range(len(tokens))])
+    writer.add_array("test.nested", [[1, 2], [3]])
+    writer.add_name("test")
+    writer.add_tensor("x", np.arange(64, dtype=np.float32).reshape((2, 32)))
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+    eager = gguf.GGUFReader(tmp_path / "vocab.gguf")
+    lazy = gguf.GGUFReader(tmp_path / "vocab.gguf", lazy=True)
+
+    assert list(lazy.fields) == list(eager.fields)
+    for name, field in eager.fields.items():
+        lazy_field = lazy.get_field(name)
+        assert lazy_field is not None
+        assert lazy_field.offset == field.offset
+        assert lazy_field.types == field.types
+        assert list(lazy_field.data) == field.data
+        assert [part.tolist() for part in lazy_field.parts] == [part.tolist() for part in field.parts]
+        assert lazy_field.contents() == field.contents()
+
+    assert lazy.fields["tokenizer.ggml.tokens"].contents() == tokens
+    assert lazy.fields["general.name"].contents() == "test"
+    assert [tensor.name for tensor in lazy.tensors] == ["x"]
+    np.testing.assert_array_equal(lazy.tensors[0].data, eager.tensors[0].data)
+
+
+def test_reader_tensor_lookup(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((40, 64), dtype=np.float32)
+    writer = gguf.GGUFWriter(tmp_path / "rows.gguf", "llama")
+    writer.add_tensor("f16", data.astype(np.float16))
+    writer.add_tensor("q4_1", gguf.quantize(data, gguf.GGMLQuantizationType.Q4_1), raw_dtype=gguf.GGMLQuantizationType.Q4_1)
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+    reader = gguf.GGUFReader(tmp_path / "rows.gguf", lazy=True)
+    assert reader.tensor_index == {"f16": 0, "q4_1": 1}
+    tensor = reader.get_tensor("q4_1")
+    assert tensor is reader.get_tensor(1)
+    assert tensor.name == "q4_1" and tensor.tensor_type == gguf.GGMLQuantizationType.Q4_1
+
+    for name in ("f16", "q4_1"):
+        tensor = reader.get_tensor(name)
+        rows = reader.read_rows(name, 30, 35)
+        np.testing.assert_array_equal(rows, tensor.data.reshape((40, -1))[30:35])
+        np.testing.assert_array_equal(gguf.dequantize(rows, tensor.tensor_type), tensor.to_float()[30:35])
+    assert reader.read_rows("f16", 3, 3).shape == (0, 64)
+
+
+def test_split_writer(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    tensors = {f"blk.{i}.ffn_up.weight": rng.standard_normal((i + 3, 7), dtype=np.float32) for i in range(5)}
+
+    for streaming in (False, True):
+        path = tmp_path / f"split-{streaming}.gguf"
+        writer = gguf.GGUFWriter(path, "llama", split_max_tensors=2)
+        writer.add_block_count(1)
+        if streaming:
+            for name, tensor in tensors.items():
+                writer.add_tensor_info(name, tensor.shape, tensor.dtype, tensor.nbytes)
+            writer.write_header_to_file()
+            writer.write_kv_data_to_file()
+            writer.write_ti_data_to_file()
+            for name in reversed(list(tensors)):
+                writer.write_tensor_data(tensors[name], name=name)
+        else:
+            for name, tensor in tensors.items():
+                writer.add_tensor(name, tensor)
+            writer.write_header_to_file()
+            writer.write_kv_data_to_file()
+            writer.write_tensors_to_file()
+        writer.close()
+
+        paths = [tmp_path / f"split-{streaming}-{i:05d}-of-00003.gguf" for i in (1, 2, 3)]
+        assert [writer.shard_path(i) for i in range(3)] == [str(p) for p in paths]
+        assert not path.exists()
+
+        last = gguf.GGUFReader(paths[2])
+        assert last.fields["split.no"].contents() == 2
+        assert last.fields["split.count"].contents() == 3
+        assert last.fields["split.tensors.count"].contents() == 5
+        assert [tensor.name for tensor in last.tensors] == ["blk.4.ffn_up.weight"]
+
+        reader = gguf.GGUFSplitReader(paths[0])
+        assert reader.get_field(gguf.Keys.LLM.BLOCK_COUNT.format(arch="llama")).contents() == 1
+        assert list(reader.tensor_index) == list(tensors)
+        for name, tensor in tensors.items():
+            np.testing.assert_array_equal(reader.get_tensor(name).data.reshape(tensor.shape), tensor)
+
+
+def test_resumable_writer(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    tensors = {f"blk.{i}.ffn_up.weight": rng.standard_normal((i + 3, 7), dtype=np.float32) for i in range(5)}
+    _write_example(tmp_path / "expected.gguf", tensors, streaming=True)
+
+    def start(path: Path) -> gguf.GGUFWriter:
+        writer = gguf.GGUFWriter(path, "llama", journal=True)
+        writer.add_block_count(1)
+        for name, tensor in tensors.items():
+            writer.add_tensor_info(name, tensor.shape, tensor.dtype, tensor.nbytes)
+        writer.write_header_to_file()
+        writer.write_kv_data_to_file()
+        writer.write_ti_data_to_file()
+        return writer
+
+    path = tmp_path / "resumed.gguf"
+    writer = start(path)
+    names = list(tensors)
+    for name in names[:3]:
+        writer.write_tensor_data(tensors[name], name=name)
+    # interrupted before the end, with the data of one of the written tensors lost
+    writer.flush()
+    with open(path, "r+b") as f:
+        f.seek(writer.shards[0].data_offset + writer.tensor_infos[names[1]].offset)
+        f.write(b"\0" * 4)
+
+    writer = start(path)
+    assert writer.written_tensors == {names[0], names[2]}
+    for name in names:
+        writer.write_tensor_data(tensors[name], name=name)
+    writer.close()
+
+    assert path.read_bytes() == (tmp_path / "expected.gguf").read_bytes()
+    assert not Path(writer.journal_path).exists()
+
+
+def test_copy_tensor_data(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    tensors = {f"blk.{i}.ffn_up.weight": rng.standard_normal((i + 3, 7), dtype=np.float32) for i in range(4)}
+    _write_example(tmp_path / "old.gguf", tensors, streaming=False)
+    tensors["blk.1.ffn_up.weight"] = tensors["blk.1.ffn_up.weight"] + 1
+    _write_example(tmp_path / "expected.gguf", tensors, streaming=True)
+
+    old = gguf.GGUFSplitReader(tmp_path / "old.gguf")
+    writer = gguf.GGUFWriter(tmp_path / "new.gguf", "llama")
+    writer.add_block_count(1)
+    for name, tensor in tensors.items():
+        writer.add_tensor_info(name, tensor.shape, tensor.dtype, tensor.nbytes)
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_ti_data_to_file()
+    for name in reversed(list(tensors)):
+        if name == "blk.1.ffn_up.weight":
+            writer.write_tensor_data(tensors[name], name=name)
+        else:
+            writer.copy_tensor_data(name, old.tensor_path(name), old.get_tensor(name).data_offset)
+    writer.close()
+
+    assert (tmp_path / "new.gguf").read_bytes() == (tmp_path / "expected.gguf").read_bytes()
+
+
+def test_lazy_memory_budget() -> None:
+    budget = gguf.MemoryBudget(1024 * 1024)
+    gguf.LazyBase.memory_budget = budget
+    try:
+        x = gguf.LazyNumpyTensor.from_eager(np.ones((256, 256), dtype=np.float32))
+        y = (x * 2).astype(np.float16)
+        data = gguf.LazyNumpyTensor.to_eager(y)
+        np.testing.assert_array_equal(data, np.full((256, 256), 2, dtype=np.float16))
+
+        # the float32 intermediate result is freed once the float16 one is computed
+        assert budget.in_use == data.nbytes
+        assert budget.peak == 3 * data.nbytes
+        assert budget.thread_peak() == 3 * data.nbytes
+        assert budget.thread_peak() is None
+        del data, y
+        assert budget.in_use == 0
+        assert budget.reserved == 0
+    finally:
+        gguf.LazyBase.memory_budget = None
+
+
+def test_lazy_memory_budget_threads() -> None:
+    gguf.LazyBase.memory_budget = gguf.MemoryBudget(1024 * 1024 * 1024)
+    switch_interval = sys.getswitchinterval()
+    # switch threads as often as possible, to interleave the evaluation with the building of the graph
+    sys.setswitchinterval(1e-6)
+    try:
+        for _ in range(10):
+            x = gguf.LazyNumpyTensor.from_eager(np.ones((4, 4), dtype=np.float32))
+            outputs = [x * float(i) for i in range(100)]
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                # like the next outputs of modify_tensors, built on the same graph while the first one is evaluated
+                future = executor.submit(gguf.LazyNumpyTensor.to_eager, outputs[0])
+                outputs += [x * float(i) for i in range(100, 1000)]
+                np.testing.assert_array_equal(future.result(), np.zeros((4, 4), dtype=np.float32))
+            np.testing.assert_array_equal(gguf.LazyNumpyTensor.to_eager(outputs[-1]), np.full((4, 4), 999, dtype=np.float32))
+    finally:
+        sys.setswitchinterval(switch_interval)
+        gguf.LazyBase.memory_budget = None
+
+
+def test_safetensors_reader(tmp_path: Path) -> None:
+    rng = np.random.default_rng(0)
+    f32 = rng.standard_normal((3, 4), dtype=np.float32)
+    bf16 = (f32.view(np.uint32) >> 16).astype(np.uint16)
+    header = {
+        "__metadata__": {"format": "pt"},
+        "a": {"dtype": "F32", "shape": [3, 4], "data_offsets": [0, f32.nbytes]},
+        "b": {"dtype": "BF16", "shape": [3, 4], "data_offsets": [f32.nbytes, f32.nbytes + bf16.nbytes]},
+    }
+    encoded = json.dumps(header).encode("utf-8")
+    encoded += b" " * (-len(encoded) % 8)
+    (tmp_path / "model.safetensors").write_bytes(len(encoded).to_bytes(8, "little") + encoded + f32.tobytes() + bf16.tobytes())
+
+    reader = gguf.SafetensorsReader(tmp_path / "model.safetensors")
+    assert reader.metadata == {"format": "pt"}
+    assert reader.keys() == ["a", "b"]
+    np.testing.assert_array_equal(reader.get_tensor("a"), f32)
+    tensor = reader.tensors["b"]
+    assert tensor.dtype == "BF16" and tensor.shape == (3, 4) and tensor.data.dtype == np.uint16
+    np.testing.assert_array_equal(tensor.data, bf16)
+    # views of the file, not copies
+    assert isinstance(tensor.data.base, np.memmap)
+
+
+def test_profiler(tmp_path: Path) -> None:
+    data = np.random.default_rng(0).standard_normal((64, 256), dtype=np.float32)
+    gguf.quantize(data, gguf.GGMLQuantizationType.Q8_0)  # not profiled
+
+    with gguf.Profiler() as profiler:
+        with gguf.profile_tensor("blk.0.ffn_up.weight"), gguf.profile("transform"):
+            gguf.quantize(data, gguf.GGMLQuantizationType.Q8_0)
+        with gguf.profile("write", 1234, tensor="blk.1.ffn_up.weight"):
+            pass
+    assert gguf.Profiler.current is None
+
+    by_stage = {e.stage: e for e in profiler.events}
+    assert len(profiler.events) == 3
+    transform, quantize, write = by_stage["transform"], by_stage["quantize"], by_stage["write"]
+    assert transform.tensor == quantize.tensor == "blk.0.ffn_up.weight"
+    assert write.tensor == "blk.1.ffn_up.weight" and write.nbytes == 1234
+    assert quantize.nbytes == data.nbytes
+    # the nested quantization is excluded from the transform time
+    assert abs(transform.self_time - (transform.duration - quantize.duration)) < 1e-9
+
+    summary = profiler.summary()
+    assert "quantize" in summary and "blk.0.ffn_up.weight" in summary
+
+    profiler.write_chrome_trace(tmp_path / "trace.json")
+    with open(tmp_path / "trace.json") as f:
+        trace = json.load(f)
+    assert sorted(e["cat"] for e in trace["traceEvents"]) == ["quantize", "transform", "write"]
+    assert all(e["ph"] == "X" and e["dur"] >= 0 for e in trace["traceEvents"])
+
+
+def test_tensor_name_map() -> None:
+    tmap = gguf.get_tensor_name_map(gguf.MODEL_ARCH.LLAMA, 32)
+    assert tmap.get_name("model.embed_tokens") == "token_embd"
+    assert tmap.get_name("model.layers.31.self_attn.q_proj.weight", try_suffixes=(".weight", ".bias")) == "blk.31.attn_q.weight"
+    assert tmap.get_type("layers.7.feed_forward.w1") == gguf.MODEL_TENSOR.FFN_GATE
+    assert tmap["blk.0.ffn_up"] == "blk.0.ffn_up"
+    # out of range or not formatted like a block number
+    assert tmap.get_name("model.layers.32.self_attn.q_proj") is None
+    assert "model.layers.01.self_attn.q_proj" not in tmap
+    # the architecture-specific names don't leak into the maps of other architectures
+    gguf.get_tensor_name_map(gguf.MODEL_ARCH.ARCTIC, 2)
+    assert gguf.get_tensor_name_map(gguf.MODEL_ARCH.LLAMA, 2).get_name("model.layers.0.post_attention_layernorm") == "blk.0.ffn_norm"
+
+    mapping = gguf.get_tensor_name_map(gguf.MODEL_ARCH.LLAMA, 2).mapping
+    assert mapping["model.layers.1.mlp.down_proj"] == (gguf.MODEL_TENSOR.FFN_DOWN, "blk.1.ffn_down")
+    assert "model.layers.2.mlp.down_proj" not in mapping
+
+
+def test_vocab_cache(tmp_path: Path) -> None:
+    tokenizer_file = tmp_path / "qwen.tiktoken"
+    tokenizer_file.write_bytes(b"IQ== 0\n")
+    cache = gguf.VocabCache(tmp_path / "cache")
+    key = cache.key("qwen", [tokenizer_file], vocab_size=8)
+    assert cache.load(key) is None
+    entry = {
+        "tokens": ["!", "ü", ""], "pieces": [b"\x00", b"\xff\xfe"], "scores": [0.0, -1000.0, 0.1], "toktypes": [1, 3, -1],
+        "tokpre": "qwen2", "added_tokens": {"<|im_start|>": 3}, "merges": [],
+    }
+    cache.store(key, entry)
+    loaded = cache.load(key)
+    assert loaded == entry
+    assert loaded is not None and [type(v) for v in loaded["scores"]] == [float] * 3
+    assert [p.name for p in (tmp_path / "cache").iterdir()] == [f"{key}.npz"]
+    # any change of the tokenizer files or of the parameters is another entry
+    assert cache.key("qwen", [tokenizer_file], vocab_size=16) != key
+    tokenizer_file.write_bytes(b"IQ== 1\n")
+    assert cache.key("qwen", [tokenizer_file], vocab_size=8) != key
+    # as is a change of the converter, e.g. of its pre-tokenizer table
+    converter = tmp_path / "convert.py"
+    converter.write_text("PRE = {'a': 'llama-bpe'}\n")
+    key = cache.key("qwen", [tokenizer_file], converter=gguf.VocabCache.file_hash(converter))
+    converter.write_text("PRE = {'a': 'qwen2'}\n")
+    assert cache.key("qwen", [tokenizer_file], converter=gguf.VocabCache.file_hash(converter)) != key
+
+
+# The scripts have dashes in their names, they can't be imported as modules.
+def _load_script(name: str) -> Any:
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), Path(__file__).parent.parent / "scripts" / f"{name}.py")
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _write_build(path: Path, tensors: dict[str, np.ndarray], qtypes: dict[str, gguf.GGMLQuantizationType] = {}, name: str = "test") -> None:
+    writer = gguf.GGUFWriter(path, "llama")
+    writer.add_name(name)
+    writer.add_token_list(["a", "b", "ü"])
+    for tensor_name, tensor in tensors.items():
+        qtype = qtypes.get(tensor_name)
+        if qtype is not None:
+            writer.add_tensor(tensor_name, gguf.quantize(tensor, qtype), raw_dtype=qtype)
+        else:
+            writer.add_tensor(tensor_name, tensor)
+    writer.write_header_to_file()
+    writer.write_kv_data_to_file()
+    writer.write_tensors_to_file()
+    writer.close()
+
+
+def test_convert_endian(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    script = _load_script("gguf-convert-endian")
+    rng = np.random.default_rng(0)
+    tensors = {
+        "f32": rng.standard_normal((4, 64), dtype=np.float32),
+        "f16": rng.standard_normal((4, 64), dtype=np.float32).astype(np.float16),
+        "q8_0": rng.standard_normal((4, 64), dtype=np.float32),
+    }
+    _write_build(tmp_path / "le.gguf", tensors, {"q8_0": gguf.GGMLQuantizationType.Q8_0})
+
+    def convert_args(model: Path, order: str, outfile: Path | None) -> argparse.Namespace:
+        return argparse.Namespace(model=str(model), order=order, outfile=outfile, dry_run=False, threads=2)
+
+    script.convert_to_new_file(gguf.GGUFReader(tmp_path / "le.gguf"), convert_args(tmp_path / "le.gguf", "big", tmp_path / "be.gguf"))
+    assert (tmp_path / "be.gguf").read_bytes() != (tmp_path / "le.gguf").read_bytes()
+    assert gguf.GGUFReader(tmp_path / "be.gguf").byte_order == "S"
+    # the swapped file decodes to the same values, including the scales of the quantized blocks
+    le, be = gguf.GGUFReader(tmp_path / "le.gguf"), gguf.GGUFReader(tmp_path / "be.gguf")
+    for name in tensors:
+        np.testing.assert_array_equal(be.get_tensor(name).to_float(), le.get_tensor(name).to_float())
+        np.testing.assert_array_equal(be.get_tensor(name).to_float(slice(1, 3)), le.get_tensor(name).to_float(slice(1, 3)))
+
+    # --outfile gives the same file as the conversion in place
+    shutil.copyfile(tmp_path / "le.gguf", tmp_path / "inplace.gguf")
+    monkeypatch.setattr("builtins.input", lambda prompt: "YES")
+    reader = gguf.GGUFReader(tmp_path / "inplace.gguf", "r+")
+    script.convert_byteorder(reader, convert_args(tmp_path / "inplace.gguf", "big", None))
+    reader.data.flush()
+    del reader
+    assert (tmp_path / "inplace.gguf").read_bytes() == (tmp_path / "be.gguf").read_bytes()
+
+    script.convert_to_new_file(gguf.GGUFReader(tmp_path / "be.gguf"), convert_args(tmp_path / "be.gguf", "little", tmp_path / "back.gguf"))
+    assert (tmp_path / "back.gguf").read_bytes() == (tmp_path / "le.gguf").read_bytes()
+
+
+def test_dump_diff(tmp_path: Path) -> None:
+    script = _load_script("gguf-dump")
+    rng = np.random.default_rng(0)
+    tensors = {"a": rng.standard_normal((4, 64), dtype=np.float32), "b": rng.standard_normal(8, dtype=np.float32)}
+    _write_build(tmp_path / "old.gguf", tensors, name="old")
+    _write_build(tmp_path / "new.gguf", tensors, {"a": gguf.GGMLQuantizationType.Q8_0}, name="new")
+
+    old = script.summarize_file(str(tmp_path / "old.gguf"))
+    assert script.diff_files(old, old) == {
+        "metadata": {"removed": [], "added": [], "changed": {}},
+        "tensors": {"removed": [], "added": [], "changed": {}},
+    }
+    diff = script.diff_files(old, script.summarize_file(str(tmp_path / "new.gguf")))
+    assert diff["metadata"] == {
+        "removed": [], "added": [],
+        "changed": {"general.name": [{"type": "STRING", "value": "old"}, {"type": "STRING", "value": "new"}]},
+    }
+    assert diff["tensors"] == {
+        "removed": [], "added": [],
+        "changed": {
+            "a": [{"type": "F32", "shape": [64, 4], "offset": 0}, {"type": "Q8_0", "shape": [64, 4], "offset": 0}],
+            # moved, after the smaller quantized tensor
+            "b": [{"type": "F32", "shape": [8], "offset": 1024}, {"type": "F32", "shape": [8], "offset": 288}],
+        },
+    }
+
+
+def test_dedup_store(tmp_path: Path) -> None:
+    script = _load_script("gguf-dedup")
+    rng = np.random.default_rng(0)
+    tensors = {f"blk.{i}.ffn_up.weight": rng.standard_normal((8, 32), dtype=np.float32) for i in range(4)}
+    builds = [tmp_path / "round1" / "model.gguf", tmp_path / "round2" / "model.gguf"]
+    for n, path in enumerate(builds):
+        path.parent.mkdir()
+        # only the last tensor changes between the builds
+        tensors["blk.3.ffn_up.weight"] = np.full((8, 32), n, dtype=np.float32)
+        _write_build(path, tensors, name=f"round {n + 1}")
+
+    store = script.TensorStore(tmp_path / "store")
+    copied = store.add(builds[0], threads=2)
+    # only its header and the changed tensor are copied
+    assert store.add(builds[1], threads=2, name="round2.gguf") == copied - 3 * 8 * 32 * 4
+    # a different file isn't stored under the same name
+    with pytest.raises(FileExistsError):
+        store.add(builds[1], threads=2)
+    assert store.models() == ["model.gguf", "round2.gguf"]
+    assert len(list(store.objects_dir.glob("*/*"))) == 2 + 4 + 1
+
+    for name, path in zip(store.models(), builds):
+        store.rebuild(name, tmp_path / "rebuilt.gguf", threads=2, verify=True)
+        assert (tmp_path / "rebuilt.gguf").read_bytes() == path.read_bytes()
+
+
+# The converters are scripts at the root of the repository, convert-hf-to-gguf imports convert from there.
+# They're added to sys.modules while they're loaded, the dataclasses of convert need it.
+def _load_converter(name: str, monkeypatch: pytest.MonkeyPatch) -> Any:
+    root = Path(__file__).parent.parent.parent
+    monkeypatch.syspath_prepend(str(root))
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), root / f"{name}.py")
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    monkeypatch.setitem(sys.modules, spec.name, module)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _write_safetensors(path: Path, tensors: dict[str, np.ndarray]) -> None:
+    header: dict[str, Any] = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        header[name] = {"dtype": {np.float32: "F32", np.float16: "F16"}[tensor.dtype.type], "shape": list(tensor.shape), "data_offsets": [offset, offset + tensor.nbytes]}
+        offset += tensor.nbytes
+    encoded = json.dumps(header).encode("utf-8")
+    encoded += b" " * (-len(encoded) % 8)
+    path.write_bytes(len(encoded).to_bytes(8, "little") + encoded + b"".join(np.ascontiguousarray(t).tobytes() for t in tensors.values()))
+
+
+# A tiny Hugging Face Llama model with a SentencePiece tokenizer, its tensors in f16 in n_parts safetensors files.
+def _write_hf_llama(path: Path, n_parts: int = 1) -> dict[str, np.ndarray]:
+    # also needed by the converters
+    sentencepiece = pytest.importorskip("sentencepiece")
+
+    n_vocab, n_embd, n_ff, n_head, n_head_kv = 40, 64, 96, 4, 2
+    path.mkdir(parents=True, exist_ok=True)
+    with open(path / "config.json", "w") as f:
+        json.dump({
+            "architectures": ["LlamaForCausalLM"], "model_type": "llama", "vocab_size": n_vocab, "hidden_size": n_embd,
+            "intermediate_size": n_ff, "num_hidden_layers": 2, "num_attention_heads": n_head, "num_key_value_heads": n_head_kv,
+            "max_position_embeddings": 128, "rms_norm_eps": 1e-5, "rope_theta": 10000.0, "torch_dtype": "float16",
+        }, f)
+    with open(path / "tokenizer.model", "wb") as f:
+        sentences = ["hello world", "the quick brown fox jumps over the lazy dog"] * 20
+        sentencepiece.SentencePieceTrainer.train(sentence_iterator=iter(sentences), model_writer=f, vocab_size=n_vocab, model_type="bpe", minloglevel=2)
+
+    rng = np.random.default_rng(0)
+    n_embd_kv = n_embd // n_head * n_head_kv
+    shapes = {"model.embed_tokens.weight": (n_vocab, n_embd)}
+    for i in range(2):
+        shapes.update({
+            f"model.layers.{i}.input_layernorm.weight": (n_embd,),
+            f"model.layers.{i}.self_attn.q_proj.weight": (n_embd, n_embd),
+            f"model.layers.{i}.self_attn.k_proj.weight": (n_embd_kv, n_embd),
+            f"model.layers.{i}.self_attn.v_proj.weight": (n_embd_kv, n_embd),
+            f"model.layers.{i}.self_attn.o_proj.weight": (n_embd, n_embd),
+            f"model.layers.{i}.post_attention_layernorm.weight": (n_embd,),
+            f"model.layers.{i}.mlp.gate_proj.weight": (n_ff, n_embd),
+            f"model.layers.{i}.mlp.up_proj.weight": (n_ff, n_embd),
+            f"model.layers.{i}.mlp.down_proj.weight": (n_embd, n_ff),
+        })
+    shapes.update({"model.norm.weight": (n_embd,), "lm_head.weight": (n_vocab, n_embd)})
+    tensors = {name: rng.standard_normal(shape, dtype=np.float32).astype(np.float16) for name, shape in shapes.items()}
+
+    names = list(tensors)
+    parts = [names[i::n_parts] for i in range(n_parts)]
+    if n_parts == 1:
+        _write_safetensors(path / "model.safetensors", tensors)
+        return tensors
+    weight_map = {}
+    for i, part in enumerate(parts):
+        part_name = f"model-{i + 1:05d}-of-{n_parts:05d}.safetensors"
+        _write_safetensors(path / part_name, {name: tensors[name] for name in part})
+        weight_map.update({name: part_name for name in part})
+    with open(path / "model.safetensors.index.json", "w") as f:
+        json.dump({"metadata": {}, "weight_map": weight_map}, f)
+    return tensors
+
+
+def test_merge_adapter(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    torch = pytest.importorskip("torch")
+
+    converter = _load_converter("convert-hf-to-gguf", monkeypatch)
+    tensors = _write_hf_llama(tmp_path / "model")
+    rng = np.random.default_rng(1)
+    rank, merged = 2, ["model.layers.0.self_attn.q_proj.weight", "model.layers.1.mlp.down_proj.weight"]
+    lora = {name: (rng.standard_normal((rank, tensors[name].shape[1]), dtype=np.float32),
+                   rng.standard_normal((tensors[name].shape[0], rank), dtype=np.float32)) for name in merged}
+
+    # PEFT: lora_A is (rank, in) and lora_B is (out, rank), scaled by lora_alpha / r
+    peft = tmp_path / "peft"
+    peft.mkdir()
+    (peft / "adapter_config.json").write_text(json.dumps({"r": rank, "lora_alpha": 8}))
+    _write_safetensors(peft / "adapter_model.safetensors",
+                       {f"base_model.model.{name.removesuffix('.weight')}.lora_{ab}.weight": m for name, (a, b) in lora.items() for ab, m in (("A", a), ("B", b))})
+    # mlx_lm: the transposes, lora_a is (in, rank) and lora_b is (rank, out)
+    mlx = tmp_path / "mlx"
+    mlx.mkdir()
+    (mlx / "adapter_config.json").write_text(json.dumps({"fine_tune_type": "lora", "lora_parameters": {"rank": rank, "scale": 4.0}}))
+    _write_safetensors(mlx / "adapters.safetensors",
+                       {f"{name.removesuffix('.weight')}.lora_{ab}": m.T for name, (a, b) in lora.items() for ab, m in (("a", a), ("b", b))})
+
+    for adapter in (peft / "adapter_model.safetensors", mlx / "adapters.safetensors"):
+        for eager in (True, False):
+            model = converter.LlamaModel(tmp_path / "model", gguf.LlamaFileType.MOSTLY_F16, tmp_path / "out.gguf", False, False, eager, adapter=adapter)
+            assert model.adapter_scale == 4.0
+            assert set(model.adapter) == set(merged)
+            for name, data in model.get_tensors():
+                if isinstance(data, gguf.LazyBase):
+                    data = type(data).to_eager(data)
+                assert data.dtype == torch.float16
+                expected = tensors[name]
+                if name in lora:
+                    a, b = lora[name]
+                    expected = (expected.astype(np.float32) + 4.0 * b @ a).astype(np.float16)
+                np.testing.assert_allclose(data.numpy().astype(np.float32), expected.astype(np.float32), rtol=1e-3, atol=1e-3)
+
+
+def test_convert_hf_threads(tmp_path: Path) -> None:
+    pytest.importorskip("torch")
+
+    _write_hf_llama(tmp_path / "model", n_parts=2)
+    script = Path(__file__).parent.parent.parent / "convert-hf-to-gguf.py"
+    for outtype in ("f16", "q8_0"):
+        outputs = []
+        for threads in (1, 3):
+            outfile = tmp_path / f"{outtype}-{threads}.gguf"
+            subprocess.run([sys.executable, str(script), str(tmp_path / "model"), "--outfile", str(outfile), "--outtype", outtype,
+                            "--threads", str(threads), "--no-vocab-cache"], check=True)
+            outputs.append(outfile.read_bytes())
+        # the tensors are evaluated out of order by the threads, but written at their own offsets
+        assert outputs[0] == outputs[1]
+
+
+# A checkpoint in the zip format of torch.save, with a storage per tensor, written without torch:
+# the pickle only refers to torch by name, stand-ins are registered while it's written.
+def _write_torch_zip(path: Path, tensors: dict[str, np.ndarray], compression: int, monkeypatch: pytest.MonkeyPatch) -> None:
+    torch = types.ModuleType("torch")
+    torch_utils = types.ModuleType("torch._utils")
+    torch.FloatStorage = type("FloatStorage", (), {"__module__": "torch"})  # type: ignore[attr-defined]
+
+    def _rebuild_tensor_v2(*args: Any) -> None:
+        pass
+    _rebuild_tensor_v2.__module__, _rebuild_tensor_v2.__qualname__ = "torch._utils", "_rebuild_tensor_v2"
+    torch_utils._rebuild_tensor_v2 = _rebuild_tensor_v2  # type: ignore[attr-defined]
+
+    class Storage(NamedTuple):
+        key: str
+        numel: int
+
+    class Tensor(NamedTuple):
+        storage: Storage
+        shape: tuple[int, ...]
+
+        def __reduce__(self) -> Any:
+            stride = tuple(int(np.prod(self.shape[i + 1:])) for i in range(len(self.shape)))
+            return (_rebuild_tensor_v2, (self.storage, 0, self.shape, stride, False, None))
+
+    class Pickler(pickle.Pickler):
+        def persistent_id(self, obj: Any) -> Any:
+            if isinstance(obj, Storage):
+                return ("storage", torch.FloatStorage, obj.key, "cpu", obj.numel)  # type: ignore[attr-defined]
+            return None
+
+    buf = io.BytesIO()
+    with monkeypatch.context() as m:
+        m.setitem(sys.modules, "torch", torch)
+        m.setitem(sys.modules, "torch._utils", torch_utils)
+        Pickler(buf, protocol=2).dump({name: Tensor(Storage(str(i), t.size), t.shape) for i, (name, t) in enumerate(tensors.items())})
+    with zipfile.ZipFile(path, "w", compression=compression) as zf:
+        zf.writestr("archive/data.pkl", buf.getvalue())
+        for i, tensor in enumerate(tensors.values()):
+            zf.writestr(f"archive/data/{i}", np.ascontiguousarray(tensor, dtype=np.float32).tobytes())
+
+
+def test_load_some_model_safetensors(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    tensors = _write_hf_llama(tmp_path / "model", n_parts=2)
+    convert = _load_converter("convert", monkeypatch)
+
+    model_plus = convert.load_some_model(tmp_path / "model", concurrency=2)
+    assert {p.name for p in model_plus.paths} == {"model-00001-of-00002.safetensors", "model-00002-of-00002.safetensors"}
+    # the parts are loaded concurrently, like they were one after the other
+    sequential = convert.merge_multifile_models([convert.lazy_load_file(p) for p in model_plus.paths])
+    assert list(model_plus.model) == list(sequential.model)
+    for name, lazy_tensor in model_plus.model.items():
+        np.testing.assert_array_equal(lazy_tensor.load().ndarray, tensors[name])
+        np.testing.assert_array_equal(lazy_tensor.load().ndarray, sequential.model[name].load().ndarray)
+
+
+def test_load_some_model_torch(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    rng = np.random.default_rng(0)
+    tensors = {
+        "tok_embeddings.weight": rng.standard_normal((10, 8), dtype=np.float32),
+        "layers.0.attention.wq.weight": rng.standard_normal((8, 8), dtype=np.float32),
+        "norm.weight": rng.standard_normal(8, dtype=np.float32),
+    }
+    # sharded like the original LLaMA checkpoints, the embeddings by columns, the others by rows
+    for n, compression in enumerate((zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+        part = {
+            "tok_embeddings.weight": tensors["tok_embeddings.weight"][:, n * 4:(n + 1) * 4],
+            "layers.0.attention.wq.weight": tensors["layers.0.attention.wq.weight"][n * 4:(n + 1) * 4],
+            "norm.weight": tensors["norm.weight"],
+        }
+        _write_torch_zip(tmp_path / f"consolidated.0{n}.pth", part, compression, monkeypatch)
+    convert = _load_converter("convert", monkeypatch)
+
+    # the stored entries are read straight from the file, at the offset of their data
+    with zipfile.ZipFile(tmp_path / "consolidated.00.pth") as zf:
+        info = zf.getinfo("archive/data/1")
+        offset = convert.zip_data_offset(zf, info)
+    assert (tmp_path / "consolidated.00.pth").read_bytes()[offset:offset + info.file_size] == tensors["layers.0.attention.wq.weight"][:4].tobytes()
+
+    model_plus = convert.load_some_model(tmp_path, concurrency=2)
+    assert model_plus.format == "torch"
+    sequential = convert.merge_multifile_models([convert.lazy_load_file(p) for p in model_plus.paths])
+    assert list(model_plus.model) == list(tensors)
+    for name, lazy_tensor in model_plus.model.items():
+        # the sharded tensors are concatenated from both parts, the others are taken from the first one
+        assert lazy_tensor.shape == list(tensors[name].shape)
+        np.testing.assert_array_equal(lazy_tensor.load().ndarray, tensors[name])
+        np.testing.assert_array_equal(lazy_tensor.load().ndarray, sequential.model[name].load().ndarray)
@@ -10,11 +10,10 @@ HF_ENDPOINT=https://hf-mirror.com mlx_lm.lora --model Qwen/Qwen2.5-72B-Instruct
 #HF_ENDPOINT=https://hf-mirror.com mlx_lm.lora --model Qwen/Qwen2.5-72B-Instruct  --data data/ --train --iters 2480 --batch-size 4 --lora-layers 16  --adapter-path adapters/Qwen2-72B-$1 --max-seq-length 4096
 
 date
-# fuse model
-mlx_lm.fuse --model Qwen/Qwen2.5-72B-Instruct --adapter-path adapters/Qwen2-72B-$1  --save-path gguf-models/Qwen2-72B-$1
-date
-# transfer to gguf
-python convert-hf-to-gguf.py gguf-models/Qwen2-72B-$1 --outtype q8_0
+# transfer to gguf, merging the adapter into the base model during the conversion instead of fusing it first,
+# and copying the tensors which didn't change from the previous round ($2) when given
+mkdir -p gguf-models/Qwen2-72B-$1
+python convert-hf-to-gguf.py --base "$(HF_ENDPOINT=https://hf-mirror.com huggingface-cli download Qwen/Qwen2.5-72B-Instruct)" --adapter adapters/Qwen2-72B-$1/adapters.safetensors --outfile gguf-models/Qwen2-72B-$1/ggml-model-q8_0.gguf --outtype q8_0 --source-index ${2:+--reuse gguf-models/Qwen2-72B-$2/ggml-model-q8_0.gguf}
 date
 # copy modelfile
 cp qwen_modelfile.txt gguf-models/Qwen2-72B-$1